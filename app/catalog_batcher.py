@@ -0,0 +1,107 @@
+import asyncio, logging, os
+
+from app.spotify_api import SpotifyClient
+
+
+# How long to hold the first id of a batch open for other syncs to join
+CATALOG_BATCH_WINDOW_MS = float(os.getenv("CATALOG_BATCH_WINDOW_MS", "50"))
+
+
+class CatalogBatcher:
+    """Coalesces catalog lookups (tracks, artists, albums) from concurrent syncs.
+
+    Ids requested within CATALOG_BATCH_WINDOW_MS of each other are sent as full
+    batches of `batch_size`, an id already being fetched is awaited rather than
+    requested again, and each caller gets back only the objects it asked for.
+    Catalog objects are not user-specific, so any requester's token can fetch
+    a batch; the most recent one is used.
+    """
+
+    def __init__(self, name: str, batch_size: int, response_key: str, fetch):
+        self.name = name
+        self.batch_size = batch_size
+        self.response_key = response_key
+        self._fetch = fetch  # (SpotifyClient, ids) -> Spotify response dict
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._pending: list[str] = []
+        self._token: str | None = None
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()  # keeps running batches referenced
+        self.requests = 0  # API calls made
+        self.ids_requested = 0  # ids asked for by callers, before dedupe
+
+    async def get(self, ids: list[str], token: str) -> dict[str, dict | None]:
+        """{id: Spotify object, or None if Spotify returned nothing for it}."""
+        loop = asyncio.get_running_loop()
+        self._token = token
+        self.ids_requested += len(ids)
+
+        futures = {}
+        for item_id in dict.fromkeys(ids):
+            future = self._in_flight.get(item_id)
+            if future is None:
+                future = loop.create_future()
+                self._in_flight[item_id] = future
+                self._pending.append(item_id)
+            futures[item_id] = future
+
+        while len(self._pending) >= self.batch_size:
+            self._flush(self.batch_size)
+        if self._pending and self._flush_handle is None:
+            self._flush_handle = loop.call_later(CATALOG_BATCH_WINDOW_MS / 1000, self._flush_all)
+
+        # Shielded: one caller being cancelled must not cancel a future other syncs share
+        results = await asyncio.gather(*(asyncio.shield(f) for f in futures.values()), return_exceptions=True)
+        out = {}
+        for item_id, result in zip(futures, results):
+            if isinstance(result, Exception):
+                logging.warning(f"[CatalogBatcher] {self.name} {item_id} failed: {result}")
+                result = None
+            out[item_id] = result
+        return out
+
+    def _flush_all(self):
+        self._flush_handle = None
+        while self._pending:
+            self._flush(self.batch_size)
+
+    def _flush(self, size: int):
+        batch, self._pending = self._pending[:size], self._pending[size:]
+        if not self._pending and self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        task = asyncio.create_task(self._run_batch(batch, self._token))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: list[str], token: str):
+        self.requests += 1
+        try:
+            response = await self._fetch(SpotifyClient(token), batch)
+            objects = {obj["id"]: obj for obj in (response or {}).get(self.response_key, []) if obj}
+            for item_id in batch:
+                future = self._in_flight.pop(item_id, None)
+                if future is not None and not future.done():
+                    future.set_result(objects.get(item_id))
+        except Exception as e:
+            for item_id in batch:
+                future = self._in_flight.pop(item_id, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+
+    def stats(self) -> dict:
+        return {
+            "api_requests": self.requests,
+            "ids_requested": self.ids_requested,
+            "in_flight": len(self._in_flight),
+        }
+
+
+# Spotify's batch limits: 50 tracks, 50 artists, 20 albums per request
+track_batcher = CatalogBatcher("tracks", 50, "tracks", lambda client, ids: client.get_track(ids))
+artist_batcher = CatalogBatcher("artists", 50, "artists", lambda client, ids: client.get_all_artists(ids))
+album_batcher = CatalogBatcher("albums", 20, "albums", lambda client, ids: client.get_all_albums(ids))
+
+
+def get_batcher_stats() -> dict:
+    return {b.name: b.stats() for b in (track_batcher, artist_batcher, album_batcher)}
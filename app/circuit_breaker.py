@@ -0,0 +1,117 @@
+import os, random, time
+from collections import deque
+
+
+# A family trips when at least BREAKER_MIN_REQUESTS calls in the last BREAKER_WINDOW_SECONDS
+# were made and BREAKER_ERROR_RATE of them failed (5xx or network error).
+BREAKER_WINDOW_SECONDS = float(os.getenv("BREAKER_WINDOW_SECONDS", "30"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+# How long an open breaker fails fast before letting one probe through. Doubles each
+# time a probe fails, up to BREAKER_MAX_OPEN_SECONDS.
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("BREAKER_MAX_OPEN_SECONDS", "300"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """Error-rate circuit breaker shared by every caller of one Spotify endpoint family."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self._outcomes: deque[tuple[float, bool]] = deque()  # (monotonic time, succeeded)
+        self._opened_at = 0.0
+        self._open_for = BREAKER_OPEN_SECONDS
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _trim(self, now: float):
+        while self._outcomes and self._outcomes[0][0] < now - BREAKER_WINDOW_SECONDS:
+            self._outcomes.popleft()
+
+    def error_rate(self) -> float:
+        self._trim(time.monotonic())
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def allow(self) -> bool:
+        """Whether a call may go out now. In half-open only a single probe is let through."""
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN and now - self._opened_at >= self._open_for:
+            self.state = HALF_OPEN
+        # A probe whose caller was cancelled never reports back; let another through eventually
+        if self.state == HALF_OPEN and (not self._probe_in_flight or now - self._probe_started >= self._open_for):
+            self._probe_in_flight = True
+            self._probe_started = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            # Probe succeeded: close and forget the outage
+            self.state = CLOSED
+            self._probe_in_flight = False
+            self._open_for = BREAKER_OPEN_SECONDS
+            self._outcomes.clear()
+        self._outcomes.append((now, True))
+        self._trim(now)
+
+    def record_failure(self):
+        now = time.monotonic()
+        if self.state == HALF_OPEN:
+            # Probe failed: stay open, and wait longer before the next probe
+            self._probe_in_flight = False
+            self._open_for = min(self._open_for * 2, BREAKER_MAX_OPEN_SECONDS)
+            self._trip(now)
+            return
+
+        self._outcomes.append((now, False))
+        self._trim(now)
+        if self.state == CLOSED and len(self._outcomes) >= BREAKER_MIN_REQUESTS and self.error_rate() >= BREAKER_ERROR_RATE:
+            self._trip(now)
+
+    def _trip(self, now: float):
+        if self.state != OPEN:
+            self.times_opened += 1
+        self.state = OPEN
+        self._opened_at = now
+
+    def retry_delay(self, attempt: int) -> float:
+        """Backoff between retries of one call: exponential with full jitter, capped, so callers spread out."""
+        return random.uniform(0, min(2 ** attempt, 8))
+
+    def stats(self) -> dict:
+        retry_in = 0.0
+        if self.state == OPEN:
+            retry_in = max(self._opened_at + self._open_for - time.monotonic(), 0.0)
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "calls_in_window": len(self._outcomes),
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+            "next_probe_in": round(retry_in, 1),
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(family: str) -> CircuitBreaker:
+    breaker = _breakers.get(family)
+    if breaker is None:
+        breaker = _breakers[family] = CircuitBreaker(family)
+    return breaker
+
+
+def get_breaker_states() -> dict:
+    return {name: breaker.stats() for name, breaker in sorted(_breakers.items())}
@@ -1,13 +1,27 @@
-from app.database import get_db_connection
+from app.database import AsyncSessionLocal, db_session
 from app.spotify_api import SpotifyClient
-import json, time
+from app import queries
+from app.catalog_batcher import track_batcher, artist_batcher, album_batcher
+from app.partitions import ensure_partitions
+from app.metrics import ingest_duration, ingest_rows
+import json, logging, os, time
 from datetime import datetime, timedelta, timezone
 from sqlalchemy import text
 
 from sqlalchemy import delete, select
 from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.sql import text
-from app.db import UsersTopArtists, Artist, UsersTopTracks, Track, Album, TrackArtist
+from app.db import UsersTopArtists, UsersTopTracks, Track, Album, TrackArtist, ListeningHistory, UserTopRankHistory
+
+
+# Passes over the same track ids before giving up on the ones Spotify returns nothing for
+# (removed or local tracks); they keep the names we already have
+TRACK_DETAILS_ATTEMPTS = int(os.getenv("TRACK_DETAILS_ATTEMPTS", "2"))
+
+# entity -> (users_top_* model, its item id column)
+TOP_ITEM_TABLES = {
+    "artists": (UsersTopArtists, UsersTopArtists.artist_id),
+    "tracks": (UsersTopTracks, UsersTopTracks.track_id),
+}
 
 
 class SpotifyDataSaver:
@@ -17,11 +31,12 @@ class SpotifyDataSaver:
         self.db = None
 
     async def connect_db(self):
-        self.db = await get_db_connection()
+        self.db = AsyncSessionLocal()
 
     async def close_db(self):
         if self.db:
-            await self.db.close()  # or .disconnect(), depending on your DB driver
+            await self.db.close()  # returns the connection to the pool
+            self.db = None
 
     async def __aenter__(self):
         await self.connect_db()
@@ -30,63 +45,133 @@ class SpotifyDataSaver:
     async def __aexit__(self, exc_type, exc, tb):
         await self.close_db()
 
+    async def mark_synced(self, data_type: str, time_range: str = "", cursor: int | None = None):
+        """Record a successful save in user_sync_state; runs in the caller's transaction."""
+        await self.db.execute(queries.MARK_SYNCED, {
+            "user_id": self.user_id,
+            "data_type": data_type,
+            "time_range": time_range,
+            "last_synced_at": datetime.now(timezone.utc),
+            "cursor": cursor
+        })
+
+
+
+    async def profile_to_database(self, profile: dict):
+        """Update the user's profile columns from a /me response, with the sync state, in one transaction."""
+        images = profile.get("images") or []
+        async with self.db.begin():
+            await self.db.execute(queries.UPDATE_USER_PROFILE, {
+                "user_id": self.user_id,
+                "display_name": profile.get("display_name"),
+                "profile_url": profile.get("external_urls", {}).get("spotify"),
+                "image_url": images[0].get("url") if images else None,
+                "email": profile.get("email"),
+                "country": profile.get("country"),
+                "product": profile.get("product"),
+                "followers": str(profile.get("followers", {}).get("total", 0)),
+                "external_urls": profile.get("external_urls", {}).get("spotify"),
+                "href": profile.get("href"),
+                "uri": profile.get("uri")
+            })
+            await self.mark_synced("profile")
 
 
-    async def top_artists_to_database(self, top_artists: dict, time_range: str, current_time: datetime):
-        try:
-            # Get all existing artist IDs
-            result = await self.db.execute(select(Artist.artist_id))
-            existing_artist_ids = {row[0] for row in result.all()}
-
-            new_artist_ids = [artist["id"] for artist in top_artists["items"] if artist["id"] not in existing_artist_ids]
-
-            if new_artist_ids:
-                await self.update_artist_details(new_artist_ids)
-
-                result = await self.db.execute(select(Artist.artist_id))
-                existing_artist_ids = {row[0] for row in result.all()}
-
-            current_time = datetime.now(timezone.utc)
-            if current_time.tzinfo is not None:
-                current_time = current_time.replace(tzinfo=None)
-
-
-            # Delete existing user artist rankings for this time_range
-            await self.db.execute(
-                delete(UsersTopArtists)
-                .where(UsersTopArtists.user_id == self.user_id)
-                .where(UsersTopArtists.time_range == time_range)
-            )
-
-            # Prepare records to insert
-            top_artist_records = [
-                {
-                    "user_id": self.user_id,
-                    "artist_id": artist["id"],
-                    "rank": index + 1,
-                    "time_range": time_range,
-                    "last_updated": current_time
-                }
-                for index, artist in enumerate(top_artists["items"])
-                if artist["id"] in existing_artist_ids
-            ]
-
-            if top_artist_records:
-                stmt = insert(UsersTopArtists).values(top_artist_records)
-                await self.db.execute(stmt)
-                print("Top artists data inserted successfully.")
 
+    async def top_artists_to_database(self, top_artists: dict, time_range: str, current_time: datetime = None):
+        await self.save_top_items("artists", top_artists, time_range)
+
+
+
+    async def save_top_items(self, entity: str, top_items: dict, time_range: str):
+        """Apply a fetched top-50 list to users_top_{entity} as a diff against the stored ranking.
+
+        Unchanged ranks are not touched. New, moved and dropped items are upserted or
+        deleted and each movement is logged in user_top_rank_history, all in one
+        transaction with the sync-state update.
+        """
+        table, item_column = TOP_ITEM_TABLES[entity]
+        ranking = {}
+        for index, item in enumerate(top_items.get("items", []) if top_items else []):
+            if item and item.get("id") and item["id"] not in ranking:
+                ranking[item["id"]] = index + 1
+
+        try:
+            # Enrich only catalog entries we have never seen (outside the ranking transaction)
+            known_query = queries.KNOWN_ARTIST_IDS if entity == "artists" else queries.KNOWN_TRACK_IDS
+            result = await self.db.execute(known_query, {"ids": list(ranking)})
+            known_ids = {row[0] for row in result}
             await self.db.commit()
 
+            unknown_ids = [item_id for item_id in ranking if item_id not in known_ids]
+            if unknown_ids:
+                if entity == "artists":
+                    await self.update_artist_details(unknown_ids)
+                else:
+                    await self.update_tracks_details(unknown_ids)
+
+                result = await self.db.execute(known_query, {"ids": unknown_ids})
+                known_ids.update(row[0] for row in result)
+                await self.db.commit()
+
+            # Items Spotify could not give us details for cannot satisfy the foreign key
+            ranking = {item_id: rank for item_id, rank in ranking.items() if item_id in known_ids}
+
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            async with self.db.begin():
+                result = await self.db.execute(
+                    select(item_column, table.rank)
+                    .where(table.user_id == self.user_id, table.time_range == time_range)
+                    .with_for_update()
+                )
+                stored = {row[0]: row[1] for row in result}
+
+                changed = {item_id: rank for item_id, rank in ranking.items() if stored.get(item_id) != rank}
+                dropped = [item_id for item_id in stored if item_id not in ranking]
+
+                if changed:
+                    stmt = insert(table).values([
+                        {"user_id": self.user_id, "time_range": time_range, item_column.key: item_id,
+                         "rank": rank, "last_updated": now}
+                        for item_id, rank in changed.items()
+                    ])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=["user_id", "time_range", item_column.key],
+                        set_={"rank": stmt.excluded.rank, "last_updated": stmt.excluded.last_updated}
+                    )
+                    await self.db.execute(stmt)
+
+                if dropped:
+                    await self.db.execute(
+                        delete(table)
+                        .where(table.user_id == self.user_id, table.time_range == time_range)
+                        .where(item_column.in_(dropped))
+                    )
+
+                history = [
+                    {"user_id": self.user_id, "entity_type": entity, "time_range": time_range, "item_id": item_id,
+                     "rank": rank, "previous_rank": stored.get(item_id), "changed_at": now}
+                    for item_id, rank in changed.items()
+                ] + [
+                    {"user_id": self.user_id, "entity_type": entity, "time_range": time_range, "item_id": item_id,
+                     "rank": None, "previous_rank": stored[item_id], "changed_at": now}
+                    for item_id in dropped
+                ]
+                if history:
+                    await self.db.execute(insert(UserTopRankHistory).values(history))
+
+                await self.mark_synced(f"top_{entity}", time_range)
+
+            logging.debug(f"[Saver] Top {entity} ({time_range}) for {self.user_id}: {len(changed)} changed, {len(dropped)} dropped, "
+                          f"{len(ranking) - len(changed)} unchanged")
+
         except Exception as e:
             await self.db.rollback()
-            print(f"[error] save_top_artists: {e}")       
+            logging.error(f"[Saver] save_top_items ({entity}, {time_range}) failed for {self.user_id}: {e}")
 
 
 
     async def update_artist_details(self, artist_ids: list[str]):
-        print("Enriching artist details in the database...")
-
         if not self.db:
             raise Exception("Database connection not initialized.")
 
@@ -95,11 +180,11 @@ class SpotifyDataSaver:
                 batch = artist_ids[i:i+50]
 
                 try:
-                    client = SpotifyClient(self.token)
-                    data = await client.get_all_artists(batch)
-                    artists_list = data.get("artists", [])
+                    # Coalesced with other syncs' lookups; ids Spotify has no data for come back as None
+                    artists = await artist_batcher.get(batch, self.token)
+                    artists_list = [artist for artist in artists.values() if artist]
                 except Exception as e:
-                    print(f"Failed to fetch artist batch: {e}")
+                    logging.warning(f"[Saver] Failed to fetch artist batch: {e}")
                     continue
 
                 if not artists_list:
@@ -148,69 +233,30 @@ class SpotifyDataSaver:
 
         except Exception as e:
             await self.db.rollback()
-            print(f"Database insertion error in update_artist_details: {e}")
+            logging.error(f"[Saver] Database insertion error in update_artist_details: {e}")
 
 
 
     async def top_tracks_to_database(self, top_tracks: dict, time_range: str):
-        print("Inserting top tracks data into the database...")
-
-        try:
-            # Step 1: Delete existing top tracks for this user and time range
-            delete_existing_data_query = text("""
-                DELETE FROM users_top_tracks 
-                WHERE user_id = :user_id AND time_range = :time_range;
-            """)
-            await self.db.execute(delete_existing_data_query, {
-                "user_id": self.user_id,
-                "time_range": time_range
-            })
-
-            # Step 2: Prepare new top tracks data
-            top_records = []
-            top_track_ids = []
-
-            for index, track in enumerate(top_tracks["items"]):
-                track_id = track["id"]
-                rank = index + 1
-
-                top_records.append({
-                    "user_id": self.user_id,
-                    "track_id": track_id,
-                    "rank": rank,
-                    "time_range": time_range,
-                    "last_updated": datetime.now().date()
-                })
-                top_track_ids.append(track_id)
-
-            # Step 3: Ensure track metadata exists
-            if top_track_ids:
-                await self.update_tracks_details(top_track_ids)
-
-            # Step 4: Insert top tracks into `users_top_tracks`
-            if top_records:
-                insert_query = text("""
-                    INSERT INTO users_top_tracks 
-                    (user_id, track_id, rank, time_range, last_updated) 
-                    VALUES (:user_id, :track_id, :rank, :time_range, :last_updated)
-                """)
-                for record in top_records:
-                    await self.db.execute(insert_query, record)
-
-                print("Top tracks data inserted successfully.")
-            else:
-                print("No top tracks to insert.")
-
-            await self.db.commit()
-
-        except Exception as e:
-            print(f"[error] top_tracks_to_database: {e}")  
+        await self.save_top_items("tracks", top_tracks, time_range)
 
 
 
 
     async def update_tracks_details(self, track_ids: list[str]):
-        print("Enriching tracks database with new track details...")
+        """Fetch and store Spotify's details for `track_ids`, retrying only those still missing them."""
+        pending = list(track_ids)
+        for attempt in range(TRACK_DETAILS_ATTEMPTS):
+            await self.save_tracks_details(pending)
+            pending = await self.tracks_missing_details(pending)
+            if not pending:
+                return
+            logging.info(f"[Saver] {len(pending)} tracks still have no artist after attempt {attempt + 1}")
+        logging.warning(f"[Saver] Giving up on details for {len(pending)} tracks after {TRACK_DETAILS_ATTEMPTS} attempts")
+
+    async def save_tracks_details(self, track_ids: list[str]):
+        """One pass: fetch `track_ids` from Spotify in batches of 50 and upsert them."""
+        logging.debug(f"[Saver] Enriching {len(track_ids)} tracks")
 
         if not self.db:
             raise Exception("Database session not initialized.")
@@ -226,10 +272,9 @@ class SpotifyDataSaver:
 
             for batch in track_id_batches:
                 try:
-                    client = SpotifyClient(self.token)
-                    tracks_details = await client.get_track(batch)
+                    tracks_details = await track_batcher.get(batch, self.token)
 
-                    for track in tracks_details.get("tracks", []):
+                    for track in tracks_details.values():
                         if not track:
                             continue
 
@@ -279,7 +324,7 @@ class SpotifyDataSaver:
                             })
 
                 except Exception as batch_error:
-                    print(f"Error fetching details for batch {batch}: {batch_error}")
+                    logging.warning(f"[Saver] Error fetching details for a batch of {len(batch)} tracks: {batch_error}")
                     continue
 
             if artists_id_to_add:
@@ -289,7 +334,6 @@ class SpotifyDataSaver:
                 await self.all_albums_to_database(list(album_ids_to_add))
 
             if track_updates:
-                print("Inserting/updating track details into the database...")
                 async with self.db.begin():
                     for data in track_updates:
                         stmt = insert(Track).values(**data)
@@ -312,40 +356,26 @@ class SpotifyDataSaver:
                         )
                         await self.db.execute(stmt)
 
-                    print("Track details inserted/updated successfully.")
-
             if track_artist_relationships:
-                print("Inserting track-artist relationships into the database...")
-
                 async with self.db.begin():
                     for rel in track_artist_relationships:
                         stmt = insert(TrackArtist).values(**rel)
                         stmt = stmt.on_conflict_do_nothing()
                         await self.db.execute(stmt)
 
-                print("Track-artist relationships inserted successfully.")
-            else:
-                print("No track-artist relationships to insert.")
-
-            await self.retry_update_tracks_if_needed()
-
         except Exception as e:
-            print(f"[error] update_tracks_details: {e}")        
-
+            logging.error(f"[Saver] save_tracks_details failed: {e}")
 
 
-    async def retry_update_tracks_if_needed(self):
-        query = text("""
-            SELECT track_id FROM tracks
-            WHERE artist_name IS NULL OR artist_name = 'Unknown'
-        """)
-        result = await self.db.execute(query)
-        rows = result.mappings().all()
 
-        if rows:
-            missing_track_ids = [row['track_id'] for row in rows]
-            print(f"Retrying update for tracks with missing artist names: {missing_track_ids}")
-            await self.update_tracks_details(missing_track_ids)
+    async def tracks_missing_details(self, track_ids: list[str]) -> list[str]:
+        """Of `track_ids`, the ones still stored without an artist name."""
+        if not track_ids:
+            return []
+        result = await self.db.execute(queries.TRACKS_MISSING_DETAILS, {"ids": list(track_ids)})
+        missing = [row[0] for row in result]
+        await self.db.commit()
+        return missing
 
 
     def parse_release_date(self, release_date_str):
@@ -361,75 +391,140 @@ class SpotifyDataSaver:
             else:  # Full date (e.g., "2008-06-15")
                 return datetime.strptime(release_date_str, "%Y-%m-%d").date()
         except ValueError as e:
-            print(f"Error parsing release date '{release_date_str}': {e}")
+            logging.warning(f"[Saver] Error parsing release date '{release_date_str}': {e}")
             return None  # Return None if there's an unexpected format
 
 
 
 
     async def recents_to_database(self, recent_tracks):
+        """Save plays fetched with the `after` cursor: enrich unknown tracks, insert, advance the cursor.
+
+        An empty fetch writes nothing; the freshness check simply asks Spotify again next time.
+        """
         if not recent_tracks:
-            print("No recent tracks to process.")
+            logging.debug(f"[Saver] No recent tracks to process for {self.user_id}")
             return
 
-        track_id_to_add = set()
-
         if isinstance(recent_tracks, str):
             try:
                 recent_tracks = json.loads(recent_tracks)
             except json.JSONDecodeError as e:
-                print(f"Error decoding JSON: {e}")
+                logging.error(f"[Saver] Error decoding recent tracks JSON: {e}")
                 return
 
         if not isinstance(recent_tracks, list) or not all(isinstance(track, dict) for track in recent_tracks):
-            print(f"Invalid format for recent_tracks: {type(recent_tracks)}")
+            logging.error(f"[Saver] Invalid format for recent_tracks: {type(recent_tracks)}")
+            return
+
+        plays = []
+        for track in recent_tracks:
+            track_data = track.get("track")
+            if not track_data or "id" not in track_data or "played_at" not in track:
+                continue
+            try:
+                played_at = datetime.fromisoformat(track["played_at"].replace('Z', '+00:00'))
+            except ValueError as e:
+                logging.warning(f"[Saver] Error parsing datetime: {e}")
+                continue
+            plays.append({
+                "user_id": self.user_id,
+                "track_id": track_data["id"],
+                "played_at": played_at.astimezone(timezone.utc).replace(tzinfo=None)
+            })
+
+        if not plays:
             return
 
-        track_ids = {track["track"]["id"] for track in recent_tracks if "track" in track and "id" in track["track"]}
+        # ✅ STEP 1: Enrich only tracks we have never seen (run outside transaction!)
+        track_ids = list({play["track_id"] for play in plays})
+        result = await self.db.execute(queries.KNOWN_TRACK_IDS, {"ids": track_ids})
+        known_ids = {row[0] for row in result}
+        await self.db.commit()
 
-        # ✅ STEP 1: Ensure track details are in DB (run outside transaction!)
-        if track_ids:
-            print("FROM RECENT TO TRACKS UPDATE IDS: ", track_ids)
-            await self.update_tracks_details(list(track_ids))
+        unknown_ids = [track_id for track_id in track_ids if track_id not in known_ids]
+        if unknown_ids:
+            await self.update_tracks_details(unknown_ids)
             await self.db.commit()
 
+        # Newest saved play, as the unix-ms value Spotify's `after` parameter expects
+        newest = max(play["played_at"] for play in plays)
+        cursor = int(newest.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
         try:
-            # ✅ STEP 2: Insert into listening_history (new transaction)
-            insert_query = text("""
-                INSERT INTO listening_history (user_id, track_id, played_at)
-                VALUES (:user_id, :track_id, :played_at)
-                ON CONFLICT (user_id, track_id, played_at) DO NOTHING;
-            """)
+            # ✅ STEP 2: One multi-row insert plus the cursor, in one transaction
+            with ingest_duration.time("recently_played"):
+                async with self.db.begin():
+                    await self.db.execute(
+                        insert(ListeningHistory).values(plays).on_conflict_do_nothing(
+                            index_elements=["user_id", "track_id", "played_at"]
+                        )
+                    )
+                    await self.mark_synced("recent_tracks", cursor=cursor)
+            ingest_rows.inc("recently_played", amount=len(plays))
 
-            async with self.db.begin():
-                for track in recent_tracks:
-                    track_data = track.get("track")
-                    if track_data and "id" in track_data and "played_at" in track:
-                        track_id = track_data["id"]
-                        track_id_to_add.add(track_id)
-
-                        played_at_str = track["played_at"]
-                        try:
-                            played_at = datetime.fromisoformat(played_at_str.replace('Z', '+00:00'))
-                            played_at = played_at.replace(tzinfo=None)
-                        except ValueError as e:
-                            print(f"Error parsing datetime: {e}")
-                            continue
+        except Exception as e:
+            logging.error(f"[Saver] Database insertion error in recents_to_database: {e}")
+
+
+    async def streaming_history_to_database(self, entries, chunk_size: int = 5000) -> tuple[int, list[str]]:
+        """Save entries from a Spotify streaming history export (the StreamingHistory JSON files).
+
+        Tracks we have never seen are stored with only the names from the export; filling
+        them in from Spotify (update_tracks_details) is left to the caller.
+        Returns the number of plays inserted (plays already stored are skipped) and the
+        ids of the tracks stored as such stubs.
+        """
+        plays = {}
+        stub_tracks = {}
+        for entry in entries:
+            uri = entry.get("spotify_track_uri")
+            if not uri or not entry.get("master_metadata_track_name") or not entry.get("ts"):
+                continue  # Podcasts, audiobooks and entries without track info
+            try:
+                played_at = datetime.fromisoformat(entry["ts"].replace('Z', '+00:00'))
+            except ValueError as e:
+                logging.warning(f"[Saver] Error parsing datetime: {e}")
+                continue
 
-                        await self.db.execute(insert_query, {
-                            "user_id": self.user_id,
-                            "track_id": track_id,
-                            "played_at": played_at
-                        })
+            track_id = uri.removeprefix("spotify:track:")
+            played_at = played_at.astimezone(timezone.utc).replace(tzinfo=None)
+            plays[(track_id, played_at)] = {"user_id": self.user_id, "track_id": track_id, "played_at": played_at}
+            stub_tracks.setdefault(track_id, {
+                "track_id": track_id,
+                "name": entry["master_metadata_track_name"],
+                "album_name": entry.get("master_metadata_album_album_name"),
+            })
 
-        except Exception as e:
-            print(f"Database insertion error in recents_to_database: {e}")
+        if not plays:
+            return 0, []
+        plays = list(plays.values())
+        await ensure_partitions(min(p["played_at"] for p in plays), max(p["played_at"] for p in plays))
+
+        stub_tracks = list(stub_tracks.values())
+        new_track_ids, inserted = [], 0
+        with ingest_duration.time("history_upload"):
+            async with self.db.begin():
+                for i in range(0, len(stub_tracks), chunk_size):
+                    result = await self.db.execute(
+                        insert(Track).values(stub_tracks[i:i + chunk_size]).on_conflict_do_nothing().returning(Track.track_id)
+                    )
+                    new_track_ids.extend(row[0] for row in result)
+                for i in range(0, len(plays), chunk_size):
+                    result = await self.db.execute(
+                        insert(ListeningHistory).values(plays[i:i + chunk_size]).on_conflict_do_nothing(
+                            index_elements=["user_id", "track_id", "played_at"]
+                        )
+                    )
+                    inserted += result.rowcount
+        ingest_rows.inc("history_upload", amount=len(plays))
+        # Only the stubs this upload created; tracks Spotify already described are left alone
+        return inserted, new_track_ids
 
 
 
 
     async def all_albums_to_database(self, album_ids):
-        print("Fetching album details from Spotify...")
         tot_albums = []
         new_artists = set()
 
@@ -437,14 +532,11 @@ class SpotifyDataSaver:
         album_chunks = [album_ids[i:i + 20] for i in range(0, len(album_ids), 20)]
 
         for chunk in album_chunks:
-            client = SpotifyClient(self.token)
-            album_details_response = await client.get_all_albums(chunk)
+            album_details_response = await album_batcher.get(chunk, self.token)
 
-            if "albums" not in album_details_response:
-                print(f"Unexpected response format: {album_details_response}")
-                continue
-
-            for album_details in album_details_response["albums"]:
+            for album_details in album_details_response.values():
+                if not album_details:
+                    continue
                 album_id = album_details.get("id")
                 name = album_details.get("name")
                 artist_id = album_details["artists"][0]["id"] if album_details.get("artists") else None
@@ -453,7 +545,7 @@ class SpotifyDataSaver:
                 total_tracks = album_details.get("total_tracks", 0)
 
                 if not album_id or not name or not artist_id:
-                    print(f"Missing required album data for album {album_id}")
+                    logging.warning(f"[Saver] Missing required album data for album {album_id}")
                     continue
 
                 new_artists.add(artist_id)
@@ -465,7 +557,6 @@ class SpotifyDataSaver:
             for artist_chunk in artist_chunks:
                 await self.update_artist_details(artist_chunk)
 
-        print("Inserting into database...")
 
         # Now begin DB transaction
         try:
@@ -487,10 +578,10 @@ class SpotifyDataSaver:
                             "total_tracks": album[5]
                         })
 
-            print("Album details inserted successfully.")
+            logging.debug(f"[Saver] Stored {len(tot_albums)} albums")
 
         except Exception as e:
-            print(f"Error processing albums: {e}")
+            logging.error(f"[Saver] Error processing albums: {e}")
 
 
 
@@ -504,38 +595,32 @@ class SpotifyDataSaver:
 
 
 async def all_artist_id_and_image_url_into_database(track_data, user_id):
-    db = await get_db_connection()
-    cursor = await db.cursor()
-
-    try:
-        for track in track_data:
-            track_id = track.get("id")
-            album = track.get("album", {})
-            artists = album.get("artists", [])
-            images = album.get("images", [])
-
-            if not track_id or not artists:
-                continue  # Skip if no valid data
-
-            artist_id = artists[0].get("id") if artists else None
-            image_url = images[0]["url"] if images else None
-
-            if artist_id:
-                await cursor.execute(
-                    "UPDATE listening_history SET artist_id = %s, album_image_url = %s WHERE user_id = %s AND track_id = %s",
-                    (artist_id, image_url, user_id, track_id)
-                )
+    async with db_session() as db:
+        try:
+            for track in track_data:
+                track_id = track.get("id")
+                album = track.get("album", {})
+                artists = album.get("artists", [])
+                images = album.get("images", [])
 
-        db.commit()
-        print("Database updated successfully all artists_id album_url in database.")
+                if not track_id or not artists:
+                    continue  # Skip if no valid data
 
-    except Exception as e:
-        print(f"Database update error all artists_id album_url in database: {e}")
-        db.rollback()
-    
-    finally:
-        cursor.close()
-        db.close()
+                artist_id = artists[0].get("id") if artists else None
+                image_url = images[0]["url"] if images else None
+
+                if artist_id:
+                    await db.execute(
+                        text("UPDATE listening_history SET artist_id = :artist_id, album_image_url = :image_url "
+                             "WHERE user_id = :user_id AND track_id = :track_id"),
+                        {"artist_id": artist_id, "image_url": image_url, "user_id": user_id, "track_id": track_id}
+                    )
+
+            await db.commit()
+
+        except Exception as e:
+            logging.error(f"[Saver] Database update error for artist ids and album urls: {e}")
+            await db.rollback()
 
 
 
@@ -544,10 +629,10 @@ def process_data(data):
     """Processes the API response data."""
     if "tracks" in data:
         for track in data["tracks"]:
-            print(f"Processing track: {track.get('name', 'Unknown')} by {track.get('artists', 'Unknown')}")
+            logging.debug(f"Processing track: {track.get('name', 'Unknown')}")
             # You can save track info to a database or a list
     else:
-        print("Unexpected response format:", data)
+        logging.warning("Unexpected response format in process_data")
 
 
 
@@ -561,7 +646,7 @@ async def get_tracks(token, track_ids):
         
         if response.status_code == 429:  # Too many requests
             retry_after = int(response.headers.get("Retry-After", 5))  # Get wait time from response
-            print(f"Rate limit hit. Waiting {retry_after} seconds...")
+            logging.warning(f"Rate limit hit. Waiting {retry_after} seconds...")
             time.sleep(retry_after)  # Wait before retrying
             continue  # Retry the same batch
 
@@ -569,7 +654,7 @@ async def get_tracks(token, track_ids):
             await process_data(response.json())  # Process the successful response
         
         else:
-            print(f"Error fetching batch {i}-{i+batch_size}: {response.status_code}")
+            logging.error(f"Error fetching batch {i}-{i+batch_size}: {response.status_code}")
 
 
 
@@ -1,7 +1,11 @@
-import os
+import os, time
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
+from fastapi import Request
+from sqlalchemy import exc
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from typing import AsyncGenerator
 
 # Load environment variables
@@ -13,14 +17,173 @@ DB_PASSWORD = os.getenv("POSTGRES_PASSWORD")
 DB_HOST = os.getenv("POSTGRES_HOST", "127.0.0.1")
 DB_PORT = os.getenv("POSTGRES_PORT", "5432")
 
+# Pool sizing: size the pool per worker process, so
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) must stay below Postgres max_connections.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds before a connection is replaced
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+
+# Statement reuse: asyncpg keeps an LRU of prepared statements per connection, and
+# SQLAlchemy caches the compiled SQL of every statement object it has seen. The hot
+# queries live in app/queries.py so both caches stay warm. Set the prepared statement
+# cache to 0 behind a transaction-pooling pgbouncer, which cannot share them.
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", "500"))
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "1200"))
+
 # Async SQLAlchemy database URL
 DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Optional read replica for analytics reads. Unset values fall back to the primary's,
+# so a second role on the same database (POSTGRES_REPLICA_USER only) works locally.
+REPLICA_CONFIGURED = any(os.getenv(name) for name in (
+    "POSTGRES_REPLICA_HOST", "POSTGRES_REPLICA_PORT", "POSTGRES_REPLICA_DB", "POSTGRES_REPLICA_USER"
+))
+REPLICA_DATABASE_URL = (
+    f"postgresql+asyncpg://{os.getenv('POSTGRES_REPLICA_USER') or DB_USER}:{os.getenv('POSTGRES_REPLICA_PASSWORD') or DB_PASSWORD}"
+    f"@{os.getenv('POSTGRES_REPLICA_HOST') or DB_HOST}:{os.getenv('POSTGRES_REPLICA_PORT') or DB_PORT}"
+    f"/{os.getenv('POSTGRES_REPLICA_DB') or DB_NAME}"
+)
+
+# After a user's data is written, their reads stay on the primary for this long so they
+# never see a replica that has not caught up yet. 0 disables the fallback.
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "30"))
+
+
+class PoolStats:
+    """Checkout-wait and usage counters for one engine's pool."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_wait(self, seconds: float, timed_out: bool = False):
+        self.checkouts += 1
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+        if timed_out:
+            self.timeouts += 1
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited for a free connection."""
+
+    stats: PoolStats
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            # Only a full pool counts; connection refused or bad credentials are not checkout timeouts
+            timed_out = True
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start, timed_out)
+
+
+def make_engine(url: str, **server_settings):
+    # A subclass per engine so each pool keeps its own stats, and they survive pool.recreate()
+    pool_class = type("InstrumentedPool", (InstrumentedPool,), {"stats": PoolStats()})
+    return create_async_engine(
+        url,
+        echo=False,
+        poolclass=pool_class,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+        query_cache_size=DB_QUERY_CACHE_SIZE,
+        connect_args={
+            "prepared_statement_cache_size": DB_PREPARED_STATEMENT_CACHE_SIZE,
+            "server_settings": {
+                "statement_timeout": str(DB_STATEMENT_TIMEOUT_MS),
+                "application_name": "spotify-stats",
+                **server_settings,
+            },
+        },
+    )
+
+
 # Create async engine and session factory
-engine = create_async_engine(DATABASE_URL, echo=False)
+engine = make_engine(DATABASE_URL)
 AsyncSessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
-# Dependency for getting DB session in FastAPI
-async def get_db_connection() -> AsyncSession:
+# Read-only engine for stats and page reads; the primary doubles as the replica when none is configured
+replica_engine = make_engine(REPLICA_DATABASE_URL, default_transaction_read_only="on") if REPLICA_CONFIGURED else engine
+ReplicaSessionLocal = sessionmaker(bind=replica_engine, class_=AsyncSession, expire_on_commit=False)
+
+# user_id -> monotonic time of that user's last write to the primary (per worker process),
+# oldest write first so mark_primary_write can prune expired entries from the front
+_recent_writes: dict[str, float] = {}
+
+
+# Dependency for getting DB session in FastAPI; the session is closed (and its
+# connection returned to the pool) once the response has been sent.
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+# The same guarantee for code outside a request (scheduler jobs, savers, scripts)
+@asynccontextmanager
+async def db_session() -> AsyncGenerator[AsyncSession, None]:
     async with AsyncSessionLocal() as session:
-        return session
+        yield session
+
+
+def mark_primary_write(user_id: str):
+    """Record that `user_id`'s data just changed on the primary (see READ_YOUR_WRITES_SECONDS)."""
+    if READ_YOUR_WRITES_SECONDS > 0 and user_id:
+        now = time.monotonic()
+        # Background syncs write for users who may never read again; drop expired entries as we go
+        _recent_writes.pop(user_id, None)
+        _recent_writes[user_id] = now
+        while _recent_writes:
+            oldest_user, written_at = next(iter(_recent_writes.items()))
+            if now - written_at < READ_YOUR_WRITES_SECONDS:
+                break
+            del _recent_writes[oldest_user]
+
+
+def wrote_recently(user_id: str | None) -> bool:
+    written_at = _recent_writes.get(user_id) if user_id else None
+    if written_at is None:
+        return False
+    if time.monotonic() - written_at < READ_YOUR_WRITES_SECONDS:
+        return True
+    _recent_writes.pop(user_id, None)
+    return False
+
+
+def read_sessionmaker(user_id: str | None = None) -> sessionmaker:
+    """Replica session factory, or the primary's if `user_id` wrote within the read-your-writes window."""
+    return AsyncSessionLocal if wrote_recently(user_id) else ReplicaSessionLocal
+
+
+# Dependency for read-only handlers: routes analytics and page reads to the replica
+async def get_read_db(request: Request) -> AsyncGenerator[AsyncSession, None]:
+    async with read_sessionmaker(request.session.get("user_id"))() as session:
+        yield session
+
+
+def get_pool_stats(target=engine) -> dict:
+    """Snapshot of pool usage, for sizing DB_POOL_SIZE against the worker count."""
+    pool = target.sync_engine.pool
+    stats = pool.stats
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "checkouts": stats.checkouts,
+        "checkout_timeouts": stats.timeouts,
+        "avg_checkout_wait_ms": round(stats.total_wait / stats.checkouts * 1000, 3) if stats.checkouts else 0.0,
+        "max_checkout_wait_ms": round(stats.max_wait * 1000, 3),
+    }
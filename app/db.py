@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, TIMESTAMP, ForeignKey, Boolean, Date, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, BigInteger, String, TIMESTAMP, ForeignKey, Boolean, Date, DateTime, Text, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
@@ -26,6 +26,15 @@ class ListeningHistory(Base):
     users = relationship("User", back_populates="listening_history")
     tracks = relationship("Track", back_populates="listening_history")
 
+    __table_args__ = (
+        # Per-user history ordered by time; INCLUDE lets the track join run index-only
+        Index("ix_listening_history_user_played_at", "user_id", text("played_at DESC"), postgresql_include=["track_id"]),
+        # FK index, also serves COUNT(DISTINCT user_id) per track on album/artist pages
+        Index("ix_listening_history_track_user", "track_id", "user_id"),
+        # Monthly partitions are created by app.partitions (see migration 0002)
+        {"postgresql_partition_by": "RANGE (played_at)"},
+    )
+
 
 class User(Base):
     __tablename__ = "users"
@@ -64,6 +73,11 @@ class User(Base):
     followings = relationship("UserConnection", foreign_keys="[UserConnection.user_id]", back_populates="user", cascade="all, delete-orphan")
     followers = relationship("UserConnection", foreign_keys="[UserConnection.friend_id]", back_populates="friend", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Token refresher scans only refreshable tokens ordered by expiry
+        Index("ix_users_token_expires", "token_expires", "user_id", postgresql_where=text("refresh_token IS NOT NULL")),
+    )
+
 
 class Track(Base):
     __tablename__ = "tracks"
@@ -92,6 +106,16 @@ class Track(Base):
     primary_artist = relationship("Artist", foreign_keys=[artist_id]) # Relationship with primary artist (if needed, otherwise can be removed)
     global_stats = relationship("GlobalTrackStats", back_populates="track", uselist=False)
 
+    __table_args__ = (
+        Index("ix_tracks_artist_id", "artist_id"),
+        Index("ix_tracks_album_id_track_number", "album_id", "track_number"),
+        # Tracks still waiting for Spotify's details (see SpotifyDataSaver.tracks_missing_details)
+        Index(
+            "ix_tracks_missing_artist_name", "track_id",
+            postgresql_where=text("artist_name IS NULL OR artist_name = 'Unknown'")
+        ),
+    )
+
 
 
 
@@ -115,6 +139,10 @@ class Artist(Base):
     global_stats = relationship("GlobalArtistStats", back_populates="artist", uselist=False)
     followers = relationship("UserFollowedArtist", back_populates="artist")
 
+    __table_args__ = (
+        Index("ix_artists_genres", "genres", postgresql_using="gin"),  # genres @> / ANY() lookups
+    )
+
 
 
 class Album(Base):
@@ -133,6 +161,10 @@ class Album(Base):
     tracks = relationship("Track", back_populates="albums")  # Relationship with Tracks
     artists = relationship("Artist", back_populates="albums") # Relationship with Artist (optional, since artist_id can be NULL)
 
+    __table_args__ = (
+        Index("ix_albums_artist_id", "artist_id"),
+    )
+
 
 
 class UsersTopArtists(Base):
@@ -141,13 +173,18 @@ class UsersTopArtists(Base):
     user_id = Column(String, ForeignKey("users.user_id"), nullable=False, primary_key=True)  # Foreign key to User
     artist_id = Column(String, ForeignKey("artists.artist_id"), nullable=False, primary_key=True)  # Foreign key to Artist
     rank = Column(Integer, nullable=False)  # Rank of the artist in the user's top artists
-    time_range = Column(String, nullable=False)  # Time range for the top artists (e.g., "short_term", "medium_term", "long_term")
+    time_range = Column(String, nullable=False, primary_key=True)  # Time range for the top artists (e.g., "short_term", "medium_term", "long_term")
     last_updated = Column(TIMESTAMP, default=func.now())  # Default value 'now()' for timestamp (correct usage)
 
     # Relationships to User and Artist (if needed)
     users = relationship("User", back_populates="users_top_artists")
     artists = relationship("Artist", back_populates="users_top_artists")
 
+    __table_args__ = (
+        Index("ix_users_top_artists_user_range_rank", "user_id", "time_range", "rank", postgresql_include=["artist_id"]),
+        Index("ix_users_top_artists_artist_id", "artist_id"),
+    )
+
 
 class UsersTopTracks(Base):
     __tablename__ = "users_top_tracks"
@@ -155,12 +192,46 @@ class UsersTopTracks(Base):
     user_id = Column(String, ForeignKey("users.user_id"), nullable=False, primary_key=True)  # Foreign key to User
     track_id = Column(String, ForeignKey("tracks.track_id"), nullable=False, primary_key=True)  # Foreign key to Track
     rank = Column(Integer, nullable=False)  # Rank of the track in the user's top tracks
-    time_range = Column(String, nullable=False)  # Time range for the top tracks (e.g., "short_term", "medium_term", "long_term")
+    time_range = Column(String, nullable=False, primary_key=True)  # Time range for the top tracks (e.g., "short_term", "medium_term", "long_term")
     last_updated = Column(TIMESTAMP, default=func.now())  # Default value 'now()' for timestamp (correct usage)
 
     users = relationship("User", back_populates="users_top_tracks")
     tracks = relationship("Track", back_populates="users_top_tracks")  # Relationship to Track (if needed)
 
+    __table_args__ = (
+        Index("ix_users_top_tracks_user_range_rank", "user_id", "time_range", "rank", postgresql_include=["track_id"]),
+        Index("ix_users_top_tracks_track_id", "track_id"),
+    )
+
+
+
+class UserSyncState(Base):
+    __tablename__ = "user_sync_state"
+
+    user_id = Column(String, ForeignKey("users.user_id"), primary_key=True)
+    data_type = Column(String, primary_key=True)  # "top_artists", "top_tracks" or "recent_tracks"
+    time_range = Column(String, primary_key=True, default="")  # "" for data types without a time range
+    last_synced_at = Column(DateTime(timezone=True), nullable=False)  # Last successful save from Spotify
+    cursor = Column(BigInteger, nullable=True)  # recent_tracks: newest saved played_at, unix ms (Spotify `after`)
+
+
+
+class UserTopRankHistory(Base):
+    __tablename__ = "user_top_rank_history"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(String, ForeignKey("users.user_id"), nullable=False)
+    entity_type = Column(String, nullable=False)  # "artists" or "tracks"
+    time_range = Column(String, nullable=False)
+    item_id = Column(String, nullable=False)  # artist_id or track_id
+    rank = Column(Integer, nullable=True)  # NULL when the item dropped out of the top list
+    previous_rank = Column(Integer, nullable=True)  # NULL when the item is new to the top list
+    changed_at = Column(TIMESTAMP, nullable=False, default=func.now())
+
+    __table_args__ = (
+        Index("ix_user_top_rank_history_user_item", "user_id", "entity_type", "time_range", "item_id", "changed_at"),
+    )
+
 
 
 class TrackArtist(Base):
@@ -173,6 +244,10 @@ class TrackArtist(Base):
     tracks = relationship('Track', back_populates='track_artists')
     artists = relationship('Artist', back_populates='track_artists')
 
+    __table_args__ = (
+        Index("ix_track_artists_artist_id", "artist_id"),
+    )
+
 
 class UserConnection(Base):
     __tablename__ = "user_connections"
@@ -183,6 +258,10 @@ class UserConnection(Base):
     user = relationship("User", foreign_keys=[user_id], back_populates="followings")
     friend = relationship("User", foreign_keys=[friend_id], back_populates="followers")
 
+    __table_args__ = (
+        Index("ix_user_connections_friend_id", "friend_id"),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
@@ -197,6 +276,11 @@ class Message(Base):
     sender = relationship("User", back_populates="sent_messages", foreign_keys=[sender_id])
     receiver = relationship("User", back_populates="received_messages", foreign_keys=[receiver_id])
 
+    __table_args__ = (
+        Index("ix_messages_sender_id", "sender_id"),
+        Index("ix_messages_receiver_unread", "receiver_id", postgresql_where=text("is_read = false")),
+    )
+
 
 
 class GlobalArtistStats(Base):
@@ -0,0 +1,71 @@
+import hmac, os
+
+from fastapi import Request, Depends, HTTPException
+from fastapi.responses import RedirectResponse, JSONResponse
+from sqlalchemy import select
+
+from app.cache import auth_context_cache
+from app.database import get_db
+from app.db import User
+
+
+# Who may use the /debug endpoints: logged-in Spotify user ids (comma separated), and/or
+# anyone sending ADMIN_TOKEN as X-Admin-Token (scripts, scrapers). With neither set they are closed.
+ADMIN_USER_IDS = {user_id.strip() for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+async def load_auth_context(user_id: str, db) -> dict | None:
+    """The stored token and profile fields for `user_id`, from the cache or one primary-key read."""
+    context = auth_context_cache.get(user_id)
+    if context is not None:
+        return context
+
+    result = await db.execute(
+        select(User.access_token, User.display_name, User.image_url).where(User.user_id == user_id)
+    )
+    row = result.one_or_none()
+    if row is None or not row.access_token:
+        return None
+
+    context = {
+        "token": row.access_token,
+        "user_id": user_id,
+        "display_name": row.display_name,
+        "image_url": row.image_url,
+    }
+    auth_context_cache.set(user_id, context)
+    return context
+
+
+async def get_current_user(request: Request, db=Depends(get_db)) -> dict | RedirectResponse | JSONResponse:
+    """Authenticated-user dependency: session identity plus the cached token and profile.
+
+    No Spotify call happens here. The profile is fetched from Spotify at login
+    and refreshed by the background sync; the access token is kept current by
+    the token refresh scheduler.
+    """
+    user_id = request.session.get("user_id")
+    if not request.session.get("spotify_token") or not user_id:
+        return RedirectResponse(url="/login")
+
+    context = await load_auth_context(user_id, db)
+    if context is None:
+        return JSONResponse(content={"error": "User not found in DB."}, status_code=404)
+
+    # Keep the session's copy in step with the refreshed token
+    if request.session.get("spotify_token") != context["token"]:
+        request.session["spotify_token"] = context["token"]
+
+    return dict(context)
+
+
+async def require_admin(request: Request):
+    """Route dependency for operator-only endpoints; everyone else gets a 403."""
+    token = request.headers.get("x-admin-token")
+    if ADMIN_TOKEN and token and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return
+    user_id = request.session.get("user_id")
+    if user_id and request.session.get("spotify_token") and user_id in ADMIN_USER_IDS:
+        return
+    raise HTTPException(status_code=403, detail="Admin only")
@@ -0,0 +1,485 @@
+"""Local stand-in for the Spotify Web API and accounts service, for load and integration testing.
+
+Run it as a server and point the app at it:
+
+    uvicorn app.fake_spotify:app --port 9090
+    SPOTIFY_API_URL=http://127.0.0.1:9090/v1 \\
+    SPOTIFY_TOKEN_URL=http://127.0.0.1:9090/api/token \\
+    SPOTIFY_AUTH_URL=http://127.0.0.1:9090/authorize \\
+    uvicorn app.main:app
+
+or, for benchmarks and scripts, set SPOTIFY_FAKE_IN_PROCESS=1 and the shared
+HTTP client talks to this app directly through an ASGI transport (no server,
+no network; the default URLs work as-is).
+
+The catalog is generated from FAKE_SPOTIFY_SEED, so the same seed always gives
+the same artists, albums and tracks, and the same user always gets the same top
+items and listening history. Each user's plays follow a Zipf-like distribution
+over their own pool of favourite tracks, like real listening.
+
+Latency and failures are set per endpoint family (the circuit breaker families,
+plus "token") or for "all", at startup through the env vars below or at runtime:
+
+    curl -X POST '127.0.0.1:9090/_control/latency?ms=80&jitter_ms=40'
+    curl -X POST '127.0.0.1:9090/_control/faults?family=top&error_rate=0.2&status=503'
+    curl -X POST '127.0.0.1:9090/_control/faults?family=all&rate_limit_rate=0.05&retry_after=2'
+    curl -X POST '127.0.0.1:9090/_control/outage?family=catalog&mode=timeout'
+    curl -X POST '127.0.0.1:9090/_control/reset'
+    curl 127.0.0.1:9090/_control/state
+"""
+import asyncio, itertools, math, os, random, string, time
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, urlencode
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, RedirectResponse, Response
+
+from app.spotify_api import ENDPOINT_FAMILIES
+
+
+FAKE_SPOTIFY_SEED = int(os.getenv("FAKE_SPOTIFY_SEED", "42"))
+FAKE_SPOTIFY_ARTISTS = int(os.getenv("FAKE_SPOTIFY_ARTISTS", "2000"))
+FAKE_SPOTIFY_ALBUMS = int(os.getenv("FAKE_SPOTIFY_ALBUMS", "6000"))
+FAKE_SPOTIFY_TRACKS = int(os.getenv("FAKE_SPOTIFY_TRACKS", "50000"))
+# Tracks in each user's pool of favourites, and how skewed plays are towards the top of it
+FAKE_SPOTIFY_USER_POOL = int(os.getenv("FAKE_SPOTIFY_USER_POOL", "400"))
+FAKE_SPOTIFY_ZIPF_S = float(os.getenv("FAKE_SPOTIFY_ZIPF_S", "1.1"))
+# Minutes between a user's plays in the generated listening history
+FAKE_SPOTIFY_PLAY_INTERVAL_MINUTES = int(os.getenv("FAKE_SPOTIFY_PLAY_INTERVAL_MINUTES", "4"))
+FAKE_SPOTIFY_TOKEN_EXPIRES = int(os.getenv("FAKE_SPOTIFY_TOKEN_EXPIRES", "3600"))
+# Startup defaults for family "all"; adjust at runtime through /_control
+FAKE_SPOTIFY_LATENCY_MS = float(os.getenv("FAKE_SPOTIFY_LATENCY_MS", "0"))
+FAKE_SPOTIFY_JITTER_MS = float(os.getenv("FAKE_SPOTIFY_JITTER_MS", "0"))
+FAKE_SPOTIFY_ERROR_RATE = float(os.getenv("FAKE_SPOTIFY_ERROR_RATE", "0"))
+FAKE_SPOTIFY_RATE_LIMIT_RATE = float(os.getenv("FAKE_SPOTIFY_RATE_LIMIT_RATE", "0"))
+# How long a "timeout" outage holds a request; longer than the app's HTTP_TIMEOUT
+TIMEOUT_HOLD_SECONDS = 60
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+GENRES = [
+    "pop", "rock", "indie", "hip hop", "rap", "r&b", "soul", "jazz", "blues", "classical",
+    "electronic", "house", "techno", "ambient", "metal", "punk", "folk", "country", "reggae", "latin",
+    "k-pop", "afrobeats", "trap", "lo-fi", "synthwave", "funk", "disco", "gospel", "grunge", "shoegaze",
+]
+WORDS = [
+    "midnight", "river", "neon", "golden", "echo", "paper", "wild", "silent", "electric", "summer",
+    "ghost", "velvet", "northern", "broken", "crystal", "lonely", "fire", "ocean", "city", "dream",
+    "static", "honey", "violet", "winter", "thunder", "glass", "desert", "satellite", "ember", "lights",
+]
+
+
+class FakeCatalog:
+    """Seeded synthetic artists, albums and tracks, plus per-user listening taste."""
+
+    def __init__(self, seed: int = FAKE_SPOTIFY_SEED, artists: int = FAKE_SPOTIFY_ARTISTS,
+                 albums: int = FAKE_SPOTIFY_ALBUMS, tracks: int = FAKE_SPOTIFY_TRACKS):
+        self.seed = seed
+        rng = random.Random(seed)
+        self.artists: dict[str, dict] = {}
+        self.albums: dict[str, dict] = {}
+        self.tracks: dict[str, dict] = {}
+
+        for _ in range(artists):
+            artist_id = self._new_id(rng)
+            self.artists[artist_id] = {
+                "id": artist_id,
+                "name": self._title(rng, 2),
+                "genres": rng.sample(GENRES, rng.randint(0, 3)),
+                "images": self._images(artist_id),
+                "external_urls": {"spotify": f"https://open.spotify.com/artist/{artist_id}"},
+                "followers": {"href": None, "total": int(rng.paretovariate(1.2) * 1000)},
+                "popularity": rng.randint(0, 100),
+                "type": "artist",
+                "uri": f"spotify:artist:{artist_id}",
+            }
+        artist_list = list(self.artists.values())
+
+        for _ in range(albums):
+            album_id = self._new_id(rng)
+            artist = rng.choice(artist_list)
+            self.albums[album_id] = {
+                "id": album_id,
+                "name": self._title(rng, rng.randint(1, 3)),
+                "album_type": "album",
+                "artists": [{"id": artist["id"], "name": artist["name"]}],
+                "images": self._images(album_id),
+                "release_date": f"{rng.randint(1965, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "release_date_precision": "day",
+                "total_tracks": 0,
+                "external_urls": {"spotify": f"https://open.spotify.com/album/{album_id}"},
+                "uri": f"spotify:album:{album_id}",
+            }
+        album_list = list(self.albums.values())
+
+        # Track order is global popularity rank: listeners pick tracks with Zipf weights over it
+        for index in range(tracks):
+            track_id = self._new_id(rng)
+            album = rng.choice(album_list)
+            album["total_tracks"] += 1
+            artists = list(album["artists"])
+            if rng.random() < 0.15:
+                featured = rng.choice(artist_list)
+                if featured["id"] != artists[0]["id"]:
+                    artists.append({"id": featured["id"], "name": featured["name"]})
+            self.tracks[track_id] = {
+                "id": track_id,
+                "name": self._title(rng, rng.randint(1, 4)),
+                "artists": artists,
+                "album": album,
+                "duration_ms": rng.randint(90_000, 420_000),
+                "explicit": rng.random() < 0.2,
+                "popularity": max(0, 100 - int(15 * math.log10(index + 1)) - rng.randint(0, 5)),
+                "track_number": album["total_tracks"],
+                "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+                "type": "track",
+                "uri": f"spotify:track:{track_id}",
+            }
+        self._track_ids = list(self.tracks)
+        self._track_cum_weights = list(itertools.accumulate(1 / rank ** FAKE_SPOTIFY_ZIPF_S for rank in range(1, tracks + 1)))
+        self._pools: dict[str, list[str]] = {}
+        self._zipf_cum_weights: list[float] = []
+
+    @staticmethod
+    def _new_id(rng: random.Random) -> str:
+        return "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+    @staticmethod
+    def _title(rng: random.Random, words: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(words)).title()
+
+    @staticmethod
+    def _images(seed: str):
+        return [
+            {"url": f"https://picsum.photos/seed/{seed}/640", "height": 640, "width": 640},
+            {"url": f"https://picsum.photos/seed/{seed}/300", "height": 300, "width": 300},
+        ]
+
+    def user_pool(self, user_id: str) -> list[str]:
+        """The user's favourite tracks, most played first."""
+        pool = self._pools.get(user_id)
+        if pool is None:
+            rng = random.Random(f"{self.seed}:{user_id}")
+            size = min(FAKE_SPOTIFY_USER_POOL, len(self._track_ids))
+            # Popular tracks end up in most pools, the long tail in few; the draw order is the user's own ranking
+            picked = {}
+            while len(picked) < size:
+                for track_id in rng.choices(self._track_ids, cum_weights=self._track_cum_weights, k=size):
+                    picked.setdefault(track_id, None)
+            pool = list(picked)[:size]
+            self._pools[user_id] = pool
+        return pool
+
+    def forget_user(self, user_id: str):
+        """Drop the cached pool; it is rebuilt identically if the user comes back."""
+        self._pools.pop(user_id, None)
+
+    def zipf_pick(self, rng: random.Random, pool: list):
+        # Rank r is picked with weight 1 / r^s
+        if len(self._zipf_cum_weights) != len(pool):
+            self._zipf_cum_weights = list(itertools.accumulate(1 / rank ** FAKE_SPOTIFY_ZIPF_S for rank in range(1, len(pool) + 1)))
+        return rng.choices(pool, cum_weights=self._zipf_cum_weights)[0]
+
+    def top_tracks(self, user_id: str, time_range: str, limit: int) -> list[dict]:
+        pool = self.user_pool(user_id)
+        # Longer ranges stay close to the user's all-time order; short_term reshuffles more
+        noise = {"short_term": 0.6, "medium_term": 0.3, "long_term": 0.1}[time_range]
+        rng = random.Random(f"{self.seed}:{user_id}:{time_range}")
+        ranked = sorted(range(len(pool)), key=lambda rank: (rank + 1) * (1 + rng.random() * noise * 4))
+        return [self.tracks[pool[rank]] for rank in ranked[:limit]]
+
+    def top_artists(self, user_id: str, time_range: str, limit: int) -> list[dict]:
+        artists = {}
+        for track in self.top_tracks(user_id, time_range, len(self.user_pool(user_id))):
+            for artist in track["artists"]:
+                artists.setdefault(artist["id"], self.artists[artist["id"]])
+            if len(artists) >= limit:
+                break
+        return list(artists.values())[:limit]
+
+    def play_at(self, user_id: str, slot: int) -> dict:
+        """The track `user_id` played in listening slot `slot` (deterministic)."""
+        rng = random.Random(f"{self.seed}:{user_id}:{slot}")
+        return self.tracks[self.zipf_pick(rng, self.user_pool(user_id))]
+
+
+_catalog: FakeCatalog | None = None
+
+
+def get_catalog() -> FakeCatalog:
+    global _catalog
+    if _catalog is None:
+        _catalog = FakeCatalog()
+    return _catalog
+
+
+app = FastAPI(title="Fake Spotify")
+
+# family -> {"latency_ms", "jitter_ms", "error_rate", "status", "rate_limit_rate", "retry_after", "timeout"}
+DEFAULT_FAULTS = {
+    "latency_ms": 0.0, "jitter_ms": 0.0, "error_rate": 0.0, "status": 503,
+    "rate_limit_rate": 0.0, "retry_after": 1, "timeout": False,
+}
+faults: dict[str, dict] = {}
+request_counts: Counter = Counter()  # family -> requests
+response_counts: Counter = Counter()  # status code -> responses
+_fault_rng = random.Random(FAKE_SPOTIFY_SEED)
+
+
+def reset_faults():
+    faults.clear()
+    faults["all"] = {
+        **DEFAULT_FAULTS,
+        "latency_ms": FAKE_SPOTIFY_LATENCY_MS,
+        "jitter_ms": FAKE_SPOTIFY_JITTER_MS,
+        "error_rate": FAKE_SPOTIFY_ERROR_RATE,
+        "rate_limit_rate": FAKE_SPOTIFY_RATE_LIMIT_RATE,
+    }
+    _fault_rng.seed(FAKE_SPOTIFY_SEED)
+
+
+reset_faults()
+
+
+def family_for(path: str) -> str:
+    if path.startswith(("/api/token", "/authorize")):
+        return "token"
+    path = path.removeprefix("/v1")
+    for prefix, family in ENDPOINT_FAMILIES:
+        if path.startswith(prefix):
+            return family
+    return "other"
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    if request.url.path.startswith("/_control"):
+        return await call_next(request)
+
+    family = family_for(request.url.path)
+    request_counts[family] += 1
+    config = faults.get(family, faults["all"])
+
+    delay = config["latency_ms"] + _fault_rng.uniform(-1, 1) * config["jitter_ms"]
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+
+    if config["timeout"]:
+        await asyncio.sleep(TIMEOUT_HOLD_SECONDS)
+    if _fault_rng.random() < config["rate_limit_rate"]:
+        response = JSONResponse(
+            status_code=429,
+            content={"error": {"status": 429, "message": "API rate limit exceeded"}},
+            headers={"Retry-After": str(config["retry_after"])},
+        )
+    elif config["timeout"] or _fault_rng.random() < config["error_rate"]:
+        status = config["status"]
+        response = JSONResponse(status_code=status, content={"error": {"status": status, "message": "Injected failure"}})
+    else:
+        response = await call_next(request)
+
+    response_counts[response.status_code] += 1
+    return response
+
+
+# --- Control ---------------------------------------------------------------
+
+def _family_config(family: str) -> dict:
+    if family not in faults:
+        faults[family] = dict(faults["all"])
+    return faults[family]
+
+
+@app.post("/_control/latency")
+async def set_latency(ms: float = 0, jitter_ms: float = 0, family: str = "all"):
+    config = _family_config(family)
+    config["latency_ms"], config["jitter_ms"] = ms, jitter_ms
+    return {"faults": faults}
+
+
+@app.post("/_control/faults")
+async def set_faults(family: str = "all", error_rate: float = 0, status: int = 503,
+                     rate_limit_rate: float = 0, retry_after: int = 1):
+    config = _family_config(family)
+    config.update(error_rate=error_rate, status=status, rate_limit_rate=rate_limit_rate, retry_after=retry_after, timeout=False)
+    return {"faults": faults}
+
+
+@app.post("/_control/outage")
+async def set_outage(family: str = "all", mode: str = "error", status: int = 503):
+    """Shorthand: "error" fails every request, "timeout" hangs them, "off" restores the family."""
+    if mode == "off":
+        if family == "all":
+            reset_faults()
+        else:
+            faults.pop(family, None)
+    elif mode in ("error", "timeout"):
+        config = _family_config(family)
+        config.update(error_rate=1.0 if mode == "error" else 0.0, status=status, timeout=mode == "timeout")
+    else:
+        raise HTTPException(status_code=400, detail="mode must be error, timeout or off")
+    return {"faults": faults}
+
+
+@app.get("/_control/state")
+async def control_state():
+    return {"faults": faults, "requests": dict(request_counts), "responses": dict(response_counts)}
+
+
+@app.post("/_control/reset")
+async def control_reset():
+    reset_faults()
+    request_counts.clear()
+    response_counts.clear()
+    return {"faults": faults}
+
+
+# --- Accounts service ------------------------------------------------------
+
+def _user_id(request: Request) -> str:
+    # Tokens issued below are "fake.<user_id>.<issued_at>"; any other token maps to a stable made-up user
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if token.startswith("fake."):
+        return token.split(".")[1]
+    return f"user{random.Random(token).randrange(100_000)}"
+
+
+def _issue_token(user_id: str) -> dict:
+    return {
+        "access_token": f"fake.{user_id}.{time.time_ns()}",
+        "token_type": "Bearer",
+        "expires_in": FAKE_SPOTIFY_TOKEN_EXPIRES,
+        "refresh_token": f"fake-refresh.{user_id}",
+        "scope": "user-read-email user-read-private user-top-read user-read-recently-played user-read-playback-state",
+    }
+
+
+@app.get("/authorize")
+async def authorize(redirect_uri: str, state: str = "", user: str | None = None):
+    """Skips the consent screen: redirects straight back with a code for `user` (default: a new one)."""
+    user_id = user or f"user{random.randrange(100_000)}"
+    return RedirectResponse(f"{redirect_uri}?{urlencode({'code': f'fake-code.{user_id}', 'state': state})}")
+
+
+@app.post("/api/token")
+async def token(request: Request):
+    form = {key: values[0] for key, values in parse_qs((await request.body()).decode()).items()}
+    grant_type = form.get("grant_type")
+    if grant_type == "authorization_code":
+        code = form.get("code", "")
+        user_id = code.split(".", 1)[1] if code.startswith("fake-code.") else f"user{random.Random(code).randrange(100_000)}"
+    elif grant_type == "refresh_token":
+        refresh_token = form.get("refresh_token", "")
+        if not refresh_token.startswith("fake-refresh."):
+            return JSONResponse(status_code=400, content={"error": "invalid_grant", "error_description": "Invalid refresh token"})
+        user_id = refresh_token.split(".", 1)[1]
+    else:
+        return JSONResponse(status_code=400, content={"error": "unsupported_grant_type"})
+    return _issue_token(user_id)
+
+
+# --- Web API ---------------------------------------------------------------
+
+def _ids(ids: str) -> list[str]:
+    return [item_id for item_id in ids.split(",") if item_id]
+
+
+@app.get("/v1/me")
+async def me(request: Request):
+    user_id = _user_id(request)
+    return {
+        "id": user_id,
+        "display_name": f"Listener {user_id.removeprefix('user')}",
+        "email": f"{user_id}@example.com",
+        "country": "GE",
+        "product": "premium",
+        "images": FakeCatalog._images(user_id),
+        "followers": {"href": None, "total": random.Random(user_id).randrange(500)},
+        "external_urls": {"spotify": f"https://open.spotify.com/user/{user_id}"},
+        "href": f"https://api.spotify.com/v1/users/{user_id}",
+        "type": "user",
+        "uri": f"spotify:user:{user_id}",
+    }
+
+
+@app.get("/v1/me/top/{kind}")
+async def top_items(kind: str, request: Request, time_range: str = "medium_term", limit: int = 20, offset: int = 0):
+    if time_range not in TIME_RANGES:
+        raise HTTPException(status_code=400, detail="Invalid time range")
+    catalog = get_catalog()
+    user_id = _user_id(request)
+    limit = min(limit, 50)
+    if kind == "artists":
+        items = catalog.top_artists(user_id, time_range, offset + limit)
+    elif kind == "tracks":
+        items = catalog.top_tracks(user_id, time_range, offset + limit)
+    else:
+        raise HTTPException(status_code=404, detail="Unknown top item type")
+    return {"items": items[offset:], "total": len(catalog.user_pool(user_id)), "limit": limit, "offset": offset}
+
+
+@app.get("/v1/me/player/recently-played")
+async def recently_played(request: Request, limit: int = 20, after: int | None = None, before: int | None = None):
+    catalog = get_catalog()
+    user_id = _user_id(request)
+    interval = FAKE_SPOTIFY_PLAY_INTERVAL_MINUTES * 60
+    newest_slot = int((before / 1000 if before else time.time()) // interval)
+    if before and newest_slot * interval * 1000 >= before:
+        newest_slot -= 1
+
+    items = []
+    for slot in range(newest_slot, newest_slot - min(limit, 50), -1):
+        played_at = datetime.fromtimestamp(slot * interval, tz=timezone.utc)
+        if after is not None and played_at.timestamp() * 1000 <= after:
+            break
+        items.append({
+            "track": catalog.play_at(user_id, slot),
+            "played_at": played_at.isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "context": None,
+        })
+    cursors = {"after": str(newest_slot * interval * 1000), "before": str((newest_slot - len(items) + 1) * interval * 1000)} if items else None
+    return {"items": items, "limit": limit, "cursors": cursors}
+
+
+@app.get("/v1/me/player/currently-playing")
+async def currently_playing(request: Request):
+    catalog = get_catalog()
+    user_id = _user_id(request)
+    interval = FAKE_SPOTIFY_PLAY_INTERVAL_MINUTES * 60
+    now = time.time()
+    # Nothing is playing half the time; otherwise it is the track recently-played will list next
+    slot = int(now // interval) + 1
+    if slot % 2:
+        return Response(status_code=204)
+    return {
+        "is_playing": True,
+        "progress_ms": int((now % interval) * 1000),
+        "item": catalog.play_at(user_id, slot),
+        "currently_playing_type": "track",
+        "timestamp": int(now * 1000),
+    }
+
+
+# Spotify returns null for ids it does not know
+@app.get("/v1/tracks")
+async def tracks(ids: str):
+    catalog = get_catalog()
+    return {"tracks": [catalog.tracks.get(track_id) for track_id in _ids(ids)[:50]]}
+
+
+@app.get("/v1/artists")
+async def artists(ids: str):
+    catalog = get_catalog()
+    return {"artists": [catalog.artists.get(artist_id) for artist_id in _ids(ids)[:50]]}
+
+
+@app.get("/v1/albums")
+async def albums(ids: str):
+    catalog = get_catalog()
+    return {"albums": [catalog.albums.get(album_id) for album_id in _ids(ids)[:20]]}
+
+
+def asgi_transport() -> httpx.ASGITransport:
+    """Transport that sends httpx requests straight into this app."""
+    return httpx.ASGITransport(app=app)
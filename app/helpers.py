@@ -2,19 +2,63 @@ from datetime import datetime, timedelta
 from fastapi import FastAPI, Depends
 from fastapi.responses import JSONResponse
 from collections import Counter
-from sqlalchemy import text, select, bindparam
+from sqlalchemy import select, tuple_
 
-from app.spotify_api import SpotifyClient
+from app.spotify_api import SpotifyClient, TokenRevokedError
 from app.crud import SpotifyDataSaver
-from app.database import get_db_connection
+from app import queries
+from app.database import mark_primary_write
+from app.cache import auth_context_cache
 from app.db import User
+from app.partitions import month_start, add_months
 
 
 from collections import defaultdict
 from datetime import timedelta
-from sqlalchemy import text
 
-import pytz, logging
+import pytz, logging, asyncio, os
+
+
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+PROFILE_REFRESH_HOURS = int(os.getenv("PROFILE_REFRESH_HOURS", "24"))
+
+
+def day_bounds(day):
+    """[start, end) datetimes for a calendar day, for partition-prunable played_at filters."""
+    day_start = datetime(day.year, day.month, day.day)
+    return day_start, day_start + timedelta(days=1)
+
+
+TIME_PERIODS = ("Today", "Yesterday", "This Week", "This Month", "Older")
+
+
+def time_period_classifier(now=None):
+    """played_at -> one of TIME_PERIODS, with the period boundaries worked out once for many rows.
+
+    Each period is everything since its start that no earlier period took, so rows in
+    played_at DESC order move through TIME_PERIODS in order and never return to one
+    (the streamed /listening-history page relies on this). When the week started
+    before the month, "This Month" is empty: those plays are already "This Week".
+    """
+    now = now or datetime.now()
+    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    cutoffs = (
+        ("Today", today_start),
+        ("Yesterday", today_start - timedelta(days=1)),
+        ("This Week", today_start - timedelta(days=today_start.weekday())),
+        ("This Month", today_start.replace(day=1)),
+    )
+
+    def period_of(played_at):
+        if isinstance(played_at, str):
+            played_at = datetime.fromisoformat(played_at)
+        for period, start in cutoffs:
+            if played_at >= start:
+                return period
+        return "Older"
+
+    return period_of
+
 
 class MusicDataService:
     def __init__(self, user_id, db):
@@ -23,7 +67,7 @@ class MusicDataService:
 
     async def get_user_info(self):
         try:
-            query = text("SELECT * FROM users WHERE user_id = :user_id")
+            query = queries.USER_INFO
             result = await self.db.execute(query, {"user_id": self.user_id})
             row = result.fetchone() 
             return dict(row._mapping) if row else None
@@ -32,13 +76,7 @@ class MusicDataService:
             return None
 
     async def get_top_artists_db(self, time_range):
-        query = text("""
-            SELECT a.name, a.image_url, a.spotify_url, uta.rank
-            FROM users_top_artists uta
-            JOIN artists a ON uta.artist_id = a.artist_id
-            WHERE uta.user_id = :user_id AND uta.time_range = :time_range
-            ORDER BY uta.rank ASC;
-        """)
+        query = queries.USER_TOP_ARTISTS
         result = await self.db.execute(query, {
             "user_id": self.user_id,
             "time_range": time_range
@@ -47,101 +85,56 @@ class MusicDataService:
         return [dict(row._mapping) for row in rows]
 
     async def get_top_tracks_db(self, time_range):
-        query = text ("""
-            SELECT t.name, a.name AS artist_name, t.album_image_url, t.spotify_url, utt.rank
-            FROM users_top_tracks utt
-            JOIN tracks t ON utt.track_id = t.track_id
-            JOIN artists a ON t.artist_id = a.artist_id
-            WHERE utt.user_id = :user_id AND utt.time_range = :time_range
-            ORDER BY utt.rank ASC;
-        """)
+        query = queries.USER_TOP_TRACKS
         result = await self.db.execute(query, {"user_id": self.user_id, "time_range": time_range})
         rows = result.fetchall()
         return [dict(row._mapping) for row in rows]
 
     async def get_track_play_counts(self):
-        query = text("""
-            SELECT t.name, t.artist_name, t.album_image_url, COUNT(*) AS track_play_counts
-            FROM listening_history lh 
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            GROUP BY t.name, t.artist_name, t.album_image_url 
-            ORDER BY track_play_counts DESC 
-            LIMIT 10;
-        """)
+        query = queries.TRACK_PLAY_COUNTS
         result = await self.db.execute(query, {"user_id": self.user_id})
         rows = result.fetchall()
         return [dict(row._mapping) for row in rows]
 
     async def get_daily_play_counts(self):
-        query = text("""
-            SELECT DATE(lh.played_at) AS play_date, COUNT(*) AS daily_play_count
-            FROM listening_history lh
-            WHERE lh.user_id = :user_id
-            GROUP BY play_date
-            ORDER BY play_date DESC;
-        """)
+        query = queries.DAILY_PLAY_COUNTS
         result = await self.db.execute(query, {"user_id": self.user_id})
         rows = result.fetchall()
         return [dict(row._mapping) for row in rows]
 
     async def get_total_play_today(self):
-        today = datetime.today().date()
-        query = text("""SELECT COUNT(*) FROM listening_history WHERE user_id = :user_id AND DATE(played_at) = :today;""")
-        result = await self.db.scalar(query, {"user_id": self.user_id, "today": today})
+        day_start, day_end = day_bounds(datetime.today().date())
+        # Range predicate (not DATE(played_at) = ...) so the planner prunes to the current month's partition
+        query = queries.PLAYS_IN_RANGE
+        result = await self.db.scalar(query, {"user_id": self.user_id, "day_start": day_start, "day_end": day_end})
         return result or 0
 
     async def get_total_play_count(self):
-        query = text("""SELECT COUNT(*) FROM listening_history WHERE user_id = :user_id;""")
+        query = queries.TOTAL_PLAY_COUNT
         result = await self.db.scalar(query, {"user_id": self.user_id})
         return result or 0
 
     async def get_total_listening_time(self):
-        query = text("""
-            SELECT SUM(t.duration_ms)
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id AND t.duration_ms IS NOT NULL;
-        """)
+        query = queries.TOTAL_LISTENING_TIME
         result = await self.db.execute(query, {"user_id": self.user_id})
         total_ms = result.scalar() or 0
         return total_ms // 60000, total_ms // 3600000
 
     async def get_total_listening_time_today(self):
-        today = datetime.today().date()
-        query = text("""
-            SELECT SUM(t.duration_ms)
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id AND DATE(lh.played_at) = :today AND t.duration_ms IS NOT NULL;
-        """)
-        result = await self.db.execute(query, {"user_id": self.user_id, "today": today})
+        day_start, day_end = day_bounds(datetime.today().date())
+        query = queries.LISTENING_TIME_IN_RANGE
+        result = await self.db.execute(query, {"user_id": self.user_id, "day_start": day_start, "day_end": day_end})
         total_ms = result.scalar() or 0
         return total_ms // 60000, total_ms // 3600000
 
     async def get_daily_listening_time(self):
-        query = text("""
-            SELECT DATE(lh.played_at) AS play_date,
-                SUM(t.duration_ms) / 60000 AS total_minutes
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id AND t.duration_ms IS NOT NULL
-            GROUP BY play_date
-            ORDER BY play_date DESC;
-        """)
+        query = queries.DAILY_LISTENING_TIME
         result = await self.db.execute(query, {"user_id": self.user_id})
         rows = result.all()
         return [{"play_date": row[0], "total_minutes": row[1]} for row in rows]
 
     async def complete_listening_history(self, limit, offset):
-        query = text("""
-            SELECT lh.played_at, t.name, t.artist_name, t.duration_ms
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            ORDER BY lh.played_at DESC 
-            LIMIT :limit OFFSET :offset;
-        """)
+        query = queries.LISTENING_HISTORY_PAGE
         result = await self.db.execute(query, {
             "user_id": self.user_id,
             "limit": limit,
@@ -151,49 +144,12 @@ class MusicDataService:
         return self.group_by_time_period(rows)
 
     def group_by_time_period(self, records):
-        now = datetime.now()
-        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        yesterday_start = today_start - timedelta(days=1)
-        start_of_week = today_start - timedelta(days=today_start.weekday())
-        start_of_last_week = start_of_week - timedelta(weeks=1)
-        end_of_last_week = start_of_week - timedelta(days=1)
-        start_of_this_month = today_start.replace(day=1)
-        end_of_this_month = (start_of_this_month.replace(
-            month=(now.month % 12 + 1) if now.month < 12 else 1,
-            year=now.year if now.month < 12 else now.year + 1,
-            day=1
-        ) - timedelta(days=1))
-
-        time_groups = {
-            "Today": {"tracks": [], "streams": 0, "total_duration": 0},
-            "Yesterday": {"tracks": [], "streams": 0, "total_duration": 0},
-            "This Week": {"tracks": [], "streams": 0, "total_duration": 0},
-            "This Month": {"tracks": [], "streams": 0, "total_duration": 0},
-            "Older": {"tracks": [], "streams": 0, "total_duration": 0},
-        }
+        period_of = time_period_classifier()
+        time_groups = {period: {"tracks": [], "streams": 0, "total_duration": 0} for period in TIME_PERIODS}
 
         for track in records:
-            played_at = track['played_at']
-            if isinstance(played_at, str):
-                played_at = datetime.fromisoformat(played_at)
-
-            duration = track.get("duration_ms", 0)
-
-            if played_at.date() == today_start.date():
-                group = "Today"
-            elif played_at.date() == yesterday_start.date():
-                group = "Yesterday"
-            elif start_of_week <= played_at < today_start:
-                group = "This Week"
-            elif start_of_last_week <= played_at <= end_of_last_week:
-                if not (start_of_this_month <= played_at <= end_of_this_month):
-                    group = "This Week"
-                else:
-                    group = "Older"
-            elif start_of_this_month <= played_at <= end_of_this_month:
-                group = "This Month"
-            else:
-                group = "Older"
+            group = period_of(track['played_at'])
+            duration = track.get("duration_ms") or 0  # upload stubs have no duration until enriched
 
             time_groups[group]["tracks"].append(track)
             time_groups[group]["streams"] += 1
@@ -202,13 +158,7 @@ class MusicDataService:
         return time_groups
 
     async def get_top_genres(self):
-        query = text("""
-            SELECT a.genres
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            JOIN artists a ON t.artist_id = a.artist_id
-            WHERE lh.user_id = :user_id;
-        """)
+        query = queries.USER_GENRE_ROWS
         result = await self.db.execute(query, {"user_id": self.user_id})
         rows = result.mappings().all()
 
@@ -221,12 +171,7 @@ class MusicDataService:
     
     #Calculate the number of consecutive days a user has listened to any track.
     async def get_consecutive_days_listened(self):
-        query = text("""
-            SELECT DISTINCT DATE(played_at) AS play_date
-            FROM listening_history
-            WHERE user_id = :user_id
-            ORDER BY play_date DESC;
-        """)
+        query = queries.DISTINCT_PLAY_DATES
         result = await self.db.execute(query, {"user_id": self.user_id})
         rows = result.scalars().all()
 
@@ -248,13 +193,7 @@ class MusicDataService:
     #Calculate the streak of the one song a user has listened to the most.
     async def get_most_listened_song_streak(self):
         # Get the full listening history grouped by date
-        query = text("""
-            SELECT DATE(lh.played_at) as play_date, t.name, t.artist_name
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            ORDER BY play_date
-        """)
+        query = queries.DAILY_SONGS
         result = await self.db.execute(query, {"user_id": self.user_id})
         rows = result.fetchall()
 
@@ -308,15 +247,7 @@ class MusicDataService:
 
         # Count total streams of the song during the streak
         song_name, artist_name = best_streak_song
-        stream_count_query = text("""
-            SELECT COUNT(*) 
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            AND t.name = :song_name
-            AND t.artist_name = :artist_name
-            AND DATE(played_at) IN :streak_dates
-        """).bindparams(bindparam("streak_dates", expanding=True))
+        stream_count_query = queries.SONG_STREAMS_ON_DATES
 
         result = await self.db.execute(stream_count_query, {
             "user_id": self.user_id,
@@ -336,15 +267,7 @@ class MusicDataService:
 
     #Calculate sogn that was on streak every day with other songs playing in between
     async def get_streak_of_song_played_inbetween(self):
-        query = text("""
-            SELECT t.name, t.artist_name, COUNT(*) AS play_count
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            GROUP BY t.name, t.artist_name
-            ORDER BY play_count DESC
-            LIMIT 1;
-        """)
+        query = queries.MOST_PLAYED_SONG
         result = await self.db.execute(query, {"user_id": self.user_id})
         row = result.fetchone()
         
@@ -355,13 +278,7 @@ class MusicDataService:
         artist_name = row[1]
 
         # Get play dates (descending)
-        streak_query = text("""
-            SELECT DISTINCT DATE(played_at) AS play_date
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id AND t.name = :song_name AND t.artist_name = :artist_name
-            ORDER BY play_date DESC;
-        """)
+        streak_query = queries.SONG_PLAY_DATES
         
         result = await self.db.execute(streak_query, {
             "user_id": self.user_id,
@@ -388,29 +305,7 @@ class MusicDataService:
             last_date = current_date
 
         # Count how many times the song was played during those streak days
-        stream_count_query = text("""
-            SELECT COUNT(*) 
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            AND t.name = :song_name
-            AND t.artist_name = :artist_name
-            AND DATE(played_at) = ANY(:streak_dates);
-        """)
-
-        # SQLAlchemy can't bind an array of dates directly with `ANY()` unless formatted correctly
-        # Workaround: use `IN (...)` with expanding bind
-        stream_count_query = text("""
-            SELECT COUNT(*) 
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            AND t.name = :song_name
-            AND t.artist_name = :artist_name
-            AND DATE(played_at) IN :streak_dates;
-        """).bindparams(
-            bindparam("streak_dates", expanding=True)
-        )
+        stream_count_query = queries.SONG_STREAMS_ON_DATES
 
         result = await self.db.execute(stream_count_query, {
             "user_id": self.user_id,
@@ -429,24 +324,14 @@ class MusicDataService:
 
     #Compute the average popularity score of songs a user has listened to.
     async def get_average_popularity(self):
-        query = text("""
-            SELECT AVG(t.popularity) AS average_popularity
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id;
-        """)
+        query = queries.AVERAGE_POPULARITY
         result = await self.db.execute(query, {"user_id": self.user_id})
         row = result.fetchone()
         return row[0] if row else 0
 
     #Calculate the average release date of albums from tracks the user has listened to.
     async def get_average_release_date(self):
-        query = text("""
-            SELECT AVG(EXTRACT(EPOCH FROM t.album_release_date)) AS average_release_date
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id AND t.album_release_date IS NOT NULL;
-        """)
+        query = queries.AVERAGE_RELEASE_EPOCH
         result = await self.db.execute(query, {"user_id": self.user_id})
         row = result.fetchone()
         
@@ -456,87 +341,43 @@ class MusicDataService:
 
     #Show global popularity of an artist/track based on all users’ listening history.
     async def get_top_artists(self, limit=10):
-        query = text("""
-            SELECT 
-                a.artist_id,
-                a.name,
-                COUNT(*) AS total_streams
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            JOIN artists a ON t.artist_id = a.artist_id
-            GROUP BY a.artist_id, a.name
-            ORDER BY total_streams DESC
-            LIMIT :limit;
-        """)
+        query = queries.GLOBAL_TOP_ARTISTS
         result = await self.db.execute(query, {"limit": limit})
         return [dict(row._mapping) for row in result.fetchall()]
 
     async def get_top_tracks(self, limit=10):
-        query = text("""
-            SELECT 
-                t.track_id,
-                t.name,
-                COUNT(*) AS total_streams
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            GROUP BY t.track_id, t.name
-            ORDER BY total_streams DESC
-            LIMIT :limit;
-        """)
+        query = queries.GLOBAL_TOP_TRACKS
         result = await self.db.execute(query, {"limit": limit})
         return [dict(row._mapping) for row in result.fetchall()]
 
 
     #Show how many songs a user listened to from each artist, and how often.
     async def get_user_artist_stats(self, user_id: int):
-        query = text("""
-            SELECT 
-                t.artist_id,
-                a.name AS artist_name,
-                COUNT(*) AS total_streams,
-                SUM(t.duration_ms) AS total_duration_ms,
-                COUNT(DISTINCT t.track_id) AS distinct_tracks_listened
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            JOIN artists a ON t.artist_id = a.artist_id
-            WHERE lh.user_id = :user_id
-            GROUP BY t.artist_id, a.name
-            ORDER BY total_streams DESC;
-        """)
+        query = queries.USER_ARTIST_STATS
         result = await self.db.execute(query, {"user_id": user_id})
         return [dict(row._mapping) for row in result.fetchall()]
 
 
     #Display distinct genres a user has listened to.
     async def get_user_genre_stats(self, user_id: int):
-        query = text("""
-            SELECT 
-                a.genres AS genre,
-                COUNT(*) AS total_streams
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            JOIN artists a ON t.artist_id = a.artist_id
-            WHERE lh.user_id = :user_id AND a.genres IS NOT NULL
-            GROUP BY a.genres
-            ORDER BY total_streams DESC;
-        """)
+        query = queries.USER_GENRE_STATS
         result = await self.db.execute(query, {"user_id": user_id})
         return [dict(row._mapping) for row in result.fetchall()]
     
     #songs listened by month and min/hours listened by month
-    async def get_monthly_stats(self, user_id: int):
-        query = text("""
-            SELECT 
-                DATE_TRUNC('month', lh.played_at) AS month,
-                COUNT(*) AS total_songs_listened,
-                SUM(t.duration_ms) AS total_duration_ms
-            FROM listening_history lh
-            JOIN tracks t ON lh.track_id = t.track_id
-            WHERE lh.user_id = :user_id
-            GROUP BY month
-            ORDER BY month DESC;
-        """)
-        result = await self.db.execute(query, {"user_id": user_id})
+    #pass `month` (any date inside it) to read a single month, which only scans that month's partition
+    async def get_monthly_stats(self, user_id: int, month=None):
+        if month is None:
+            query = queries.MONTHLY_STATS
+            result = await self.db.execute(query, {"user_id": user_id})
+        else:
+            query = queries.MONTH_STATS
+            first_day = month_start(month)
+            result = await self.db.execute(query, {
+                "user_id": user_id,
+                "month_start": datetime.combine(first_day, datetime.min.time()),
+                "month_end": datetime.combine(add_months(first_day, 1), datetime.min.time())
+            })
         rows = result.fetchall()
         
         monthly_stats = []
@@ -552,70 +393,13 @@ class MusicDataService:
         return monthly_stats
     
     # the information about first/last song user listened
+    async def get_last_synced(self):
+        """When this user's Spotify data was last saved successfully (any data type)."""
+        result = await self.db.execute(queries.LAST_SYNCED_AT, {"user_id": self.user_id})
+        return result.scalar()
+
     async def get_first_and_last_listened(self):
-        query = text("""
-            WITH first_play AS (
-                SELECT lh.played_at, t.track_id, t.name AS track_name, t.album_image_url AS track_image, t.spotify_url AS track_url,
-                    a.artist_id, a.name AS artist_name, a.image_url AS artist_image, a.spotify_url AS artist_url,
-                    al.album_id, al.name AS album_name, al.image_url AS album_image, al.spotify_url AS album_url
-                FROM listening_history lh
-                JOIN tracks t ON lh.track_id = t.track_id
-                JOIN artists a ON t.artist_id = a.artist_id
-                JOIN albums al ON t.album_id = al.album_id
-                WHERE lh.user_id = :user_id
-                ORDER BY lh.played_at ASC
-                LIMIT 1
-            ),
-            last_play AS (
-                SELECT lh.played_at, t.track_id, t.name AS track_name, t.album_image_url AS track_image, t.spotify_url AS track_url,
-                    a.artist_id, a.name AS artist_name, a.image_url AS artist_image, a.spotify_url AS artist_url,
-                    al.album_id, al.name AS album_name, al.image_url AS album_image, al.spotify_url AS album_url
-                FROM listening_history lh
-                JOIN tracks t ON lh.track_id = t.track_id
-                JOIN artists a ON t.artist_id = a.artist_id
-                JOIN albums al ON t.album_id = al.album_id
-                WHERE lh.user_id = :user_id
-                ORDER BY lh.played_at DESC
-                LIMIT 1
-            )
-            SELECT 
-                fp.played_at AS first_played,
-                fp.track_id AS first_track_id,
-                fp.track_name AS first_track_name,
-                fp.album_id AS first_album_id,
-                fp.album_name AS first_album_name,
-                fp.artist_id AS first_artist_id,
-                fp.artist_name AS first_artist_name,
-                fp.album_image AS first_album_image,
-                fp.album_url AS first_album_url,
-                fp.artist_image AS first_artist_image,
-                fp.artist_url AS first_artist_url,
-                fp.track_image AS first_track_image,
-                fp.track_url AS first_track_url,
-                (
-                    SELECT COUNT(*) FROM listening_history
-                    WHERE user_id = :user_id AND track_id = fp.track_id
-                ) AS first_track_play_count,
-
-                lp.played_at AS last_played,
-                lp.track_id AS last_track_id,
-                lp.track_name AS last_track_name,
-                lp.album_id AS last_album_id,
-                lp.album_name AS last_album_name,
-                lp.artist_id AS last_artist_id,
-                lp.artist_name AS last_artist_name,
-                lp.album_image AS last_album_image,
-                lp.album_url AS last_album_url,
-                lp.artist_image AS last_artist_image,
-                lp.artist_url AS last_artist_url,
-                lp.track_image AS last_track_image,
-                lp.track_url AS last_track_url,
-                (
-                    SELECT COUNT(*) FROM listening_history
-                    WHERE user_id = :user_id AND track_id = lp.track_id
-                ) AS last_track_play_count
-            FROM first_play fp, last_play lp;
-        """)
+        query = queries.FIRST_AND_LAST_LISTENED
         result = await self.db.execute(query, {"user_id": self.user_id})
         row = result.fetchone()
         return dict(row._mapping) if row else None
@@ -626,36 +410,7 @@ class MusicDataService:
     # unique number of artists listened to
     # unique number of genres listened to
     async def get_unique_listening_counts(self):
-        query = text("""
-            SELECT
-                -- Unique tracks listened by user
-                (SELECT COUNT(DISTINCT lh.track_id)
-                FROM listening_history lh
-                WHERE lh.user_id = :user_id) AS unique_tracks,
-
-                -- Unique albums listened by user (via track -> album)
-                (SELECT COUNT(DISTINCT t.album_id)
-                FROM listening_history lh
-                JOIN tracks t ON lh.track_id = t.track_id
-                WHERE lh.user_id = :user_id) AS unique_albums,
-
-                -- Unique artists listened by user (via track -> artist)
-                (SELECT COUNT(DISTINCT t.artist_id)
-                FROM listening_history lh
-                JOIN tracks t ON lh.track_id = t.track_id
-                WHERE lh.user_id = :user_id) AS unique_artists,
-
-                -- Unique genres listened by user (UNNEST artist.genres from tracks they've listened to)
-                (SELECT COUNT(DISTINCT genre)
-                FROM (
-                    SELECT UNNEST(a.genres) AS genre
-                    FROM listening_history lh
-                    JOIN tracks t ON lh.track_id = t.track_id
-                    JOIN artists a ON t.artist_id = a.artist_id
-                    WHERE lh.user_id = :user_id
-                ) subquery_genres
-                ) AS unique_genres;
-        """)
+        query = queries.UNIQUE_LISTENING_COUNTS
         result = await self.db.execute(query, {"user_id": self.user_id})
         row = result.fetchone()
         return dict(row._mapping) if row else None
@@ -672,25 +427,132 @@ class MusicDataService:
 
 
 class TokenRefresh:
+    """Refreshes access tokens that expire within REFRESH_BUFFER.
+
+    Only expiring rows are read (partial index ix_users_token_expires). Each batch is
+    refreshed concurrently on the shared HTTP client, then written back in one UPDATE.
+    The refresh scheduler (app/token_scheduler.py) decides when a batch is due.
+    """
+
+    REFRESH_BUFFER = timedelta(minutes=int(os.getenv("TOKEN_REFRESH_BUFFER_MINUTES", "5")))
+    BATCH_SIZE = int(os.getenv("TOKEN_REFRESH_BATCH_SIZE", "500"))
+    CONCURRENCY = int(os.getenv("TOKEN_REFRESH_CONCURRENCY", "20"))
+
     def __init__(self, db):
         self.db = db
-        # This function should retrieve users with their refresh tokens and expiry times from your database
-    async def get_all_users_from_db(self):
+
+    async def get_expiring_tokens(self, cutoff, after=None, limit=BATCH_SIZE):
+        """(user_id, refresh_token, token_expires) rows expiring before `cutoff`, keyset-paged by `after`."""
+        stmt = (
+            select(User.user_id, User.refresh_token, User.token_expires)
+            .where(User.refresh_token.isnot(None), User.token_expires <= cutoff)
+            .order_by(User.token_expires, User.user_id)
+            .limit(limit)
+        )
+        if after is not None:
+            stmt = stmt.where(tuple_(User.token_expires, User.user_id) > tuple_(*after))
+        result = await self.db.execute(stmt)
+        return result.all()
+
+    async def bulk_update_tokens(self, refreshed):
+        """Write [(user_id, access_token, refresh_token, token_expires), ...] in a single statement."""
+        if not refreshed:
+            return
+        user_ids, access_tokens, refresh_tokens, expires = (list(column) for column in zip(*refreshed))
+        await self.db.execute(queries.BULK_UPDATE_TOKENS, {
+            "user_ids": user_ids,
+            "access_tokens": access_tokens,
+            "refresh_tokens": refresh_tokens,
+            "token_expires": expires
+        })
+        await self.db.commit()
+        for user_id in user_ids:
+            auth_context_cache.pop(user_id)
+
+    async def get_due_tokens(self, user_ids, cutoff):
+        """Rows for `user_ids` that still expire before `cutoff` (another worker may have refreshed them)."""
         result = await self.db.execute(
-            select(User).where(User.token_expires.isnot(None))
+            select(User.user_id, User.refresh_token, User.token_expires)
+            .where(User.user_id.in_(user_ids), User.refresh_token.isnot(None), User.token_expires <= cutoff)
         )
-        return result.scalars().all()
-
-    async def update_user_token(self, user_id, access_token: str, refresh_token: str, token_expires):
-        user = await self.db.get(User, user_id)
-        if user:
-            user.access_token = access_token
-            user.refresh_token = refresh_token
-            user.token_expires = token_expires
-            await self.db.commit()
-            print(f"Token updated for user {user_id}.")
-        else:
-            print(f"User with ID {user_id} not found.")
+        return result.all()
+
+    async def clear_refresh_tokens(self, user_ids):
+        """Forget revoked refresh tokens, so neither the scheduler nor the sweep tries them again."""
+        if not user_ids:
+            return
+        await self.db.execute(queries.CLEAR_REFRESH_TOKENS, {"user_ids": list(user_ids)})
+        await self.db.commit()
+        for user_id in user_ids:
+            auth_context_cache.pop(user_id)
+
+    async def refresh_rows(self, spotify_oauth, rows):
+        """Refresh `rows` concurrently and store them in one UPDATE. Returns (refreshed tuples, failed user_ids).
+
+        Revoked refresh tokens are cleared and left out of both lists: only a new login fixes those.
+        """
+        semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        revoked = []
+
+        async def refresh_one(row):
+            async with semaphore:
+                try:
+                    token = await spotify_oauth.refresh_access_token(row.refresh_token, persist=False)
+                except TokenRevokedError as e:
+                    logging.warning(f"[TokenRefresh] Refresh token for user {row.user_id} was revoked; clearing it: {e}")
+                    revoked.append(row.user_id)
+                    return None
+                except Exception as e:
+                    logging.warning(f"[TokenRefresh] Failed to refresh token for user {row.user_id}: {e}")
+                    return None
+            return (
+                row.user_id,
+                token["access_token"],
+                token.get("refresh_token", row.refresh_token),
+                datetime.fromtimestamp(token["expires_at"], tz=pytz.UTC)
+            )
+
+        results = await asyncio.gather(*(refresh_one(row) for row in rows))
+        refreshed = [r for r in results if r is not None]
+        await self.bulk_update_tokens(refreshed)
+        await self.clear_refresh_tokens(revoked)
+        failed = [row.user_id for row, r in zip(rows, results) if r is None and row.user_id not in revoked]
+        return refreshed, failed
+
+    async def refresh_users(self, spotify_oauth, user_ids):
+        """Refresh the given users' tokens if they are still inside the buffer."""
+        rows = await self.get_due_tokens(user_ids, datetime.now(pytz.UTC) + self.REFRESH_BUFFER)
+        return await self.refresh_rows(spotify_oauth, rows)
+
+    async def refresh_expiring_tokens(self, spotify_oauth):
+        """Sweep every token expiring inside the buffer. Returns (refreshed tuples, failed user_ids)."""
+        cutoff = datetime.now(pytz.UTC) + self.REFRESH_BUFFER
+        refreshed_all, failed_all = [], []
+
+        after = None
+        while True:
+            rows = await self.get_expiring_tokens(cutoff, after)
+            if not rows:
+                break
+            after = (rows[-1].token_expires, rows[-1].user_id)
+
+            refreshed, failed = await self.refresh_rows(spotify_oauth, rows)
+            refreshed_all.extend(refreshed)
+            failed_all.extend(failed)
+            if len(rows) < self.BATCH_SIZE:
+                break
+
+        return refreshed_all, failed_all
+
+    async def get_refresh_schedule(self, user_ids=None):
+        """(user_id, token_expires) for every refreshable token (or just `user_ids`), for the refresh scheduler."""
+        stmt = select(User.user_id, User.token_expires).where(
+            User.refresh_token.isnot(None), User.token_expires.isnot(None)
+        )
+        if user_ids is not None:
+            stmt = stmt.where(User.user_id.in_(user_ids))
+        result = await self.db.execute(stmt)
+        return result.all()
 
 
 
@@ -699,88 +561,132 @@ class UserMusicUpdater:
         self.db = db
         self.user_id = user_id
         self.token = token
-
-    async def get_last_update(self, data_type, time_range):
-        result = None
+        self._sync_state = None
+
+    async def get_sync_state(self):
+        """{(data_type, time_range): user_sync_state row} for this user, loaded once per updater."""
+        if self._sync_state is None:
+            result = await self.db.execute(queries.USER_SYNC_STATE, {"user_id": self.user_id})
+            self._sync_state = {(row.data_type, row.time_range): row for row in result}
+        return self._sync_state
+
+    async def get_sync_row(self, data_type, time_range):
+        # recent_tracks and profile are not split by time range
+        key = (data_type, "" if data_type in ("recent_tracks", "profile") else time_range)
         try:
-            if data_type == "top_tracks":
-                query = text("""
-                    SELECT last_updated
-                    FROM users_top_tracks
-                    WHERE user_id = :user_id AND time_range = :time_range;
-                """)
-                row = await self.db.execute(query, {
-                    "user_id": self.user_id,
-                    "time_range": time_range
-                })
-                result = row.scalar()
-
-            elif data_type == "top_artists":
-                query = text("""
-                    SELECT last_updated 
-                    FROM users_top_artists 
-                    WHERE user_id = :user_id AND time_range = :time_range;
-                """)
-                row = await self.db.execute(query, {
-                    "user_id": self.user_id,
-                    "time_range": time_range
-                })
-                result = row.scalar()
-
-            elif data_type == "recent_tracks":
-                query = text("""
-                    SELECT MAX(played_at) as last_updated
-                    FROM listening_history 
-                    WHERE user_id = :user_id;
-                """)
-                row = await self.db.execute(query, {
-                    "user_id": self.user_id
-                })
-                result = row.scalar()
-
+            return (await self.get_sync_state()).get(key)
         except Exception as e:
             logging.error(f"[DB] Error fetching last update for user={self.user_id}, type={data_type}, range={time_range}: {e}")
-        
-        return result
-
-    async def update_data_if_needed(self, data_type, time_range):
-        last_update = await self.get_last_update(data_type, time_range)
-        print(f"Last update for {self.user_id}, {data_type}, {time_range}: {last_update}")
-
-        if last_update and last_update.tzinfo is None:
-            last_update = pytz.UTC.localize(last_update)
+            return None
 
-        current_time = datetime.utcnow().replace(tzinfo=pytz.UTC)
-        print(f"Current time: {current_time}")
+    async def get_last_update(self, data_type, time_range):
+        row = await self.get_sync_row(data_type, time_range)
+        return row.last_synced_at if row else None
 
+    @staticmethod
+    def refresh_interval(data_type, time_range):
         intervals = {
             "top_artists": timedelta(weeks=12 if time_range == "long_term" else 6 if time_range == "medium_term" else 4),
             "top_tracks": timedelta(days=1 if time_range == "short_term" else 7 if time_range == "medium_term" else 28),
             "recent_tracks": timedelta(minutes=5),
+            "profile": timedelta(hours=PROFILE_REFRESH_HOURS),
         }
+        return intervals[data_type]
 
-        interval = intervals[data_type]
-        print(f"Interval for {data_type}: {interval}")
+    async def is_stale(self, data_type, time_range):
+        last_update = await self.get_last_update(data_type, time_range)
+        logging.debug(f"[Sync] Last update for {self.user_id}, {data_type}, {time_range}: {last_update}")
 
-        if not last_update or current_time - last_update > interval:
-            logging.info(f"Fetching new {data_type} data for user {self.user_id}...")
+        if last_update and last_update.tzinfo is None:
+            last_update = pytz.UTC.localize(last_update)
+
+        current_time = datetime.utcnow().replace(tzinfo=pytz.UTC)
+        return not last_update or current_time - last_update > self.refresh_interval(data_type, time_range)
+
+    async def update_data_if_needed(self, data_type, time_range):
+        """Refresh one data type from Spotify if stale. Returns True when new data was written."""
+        if await self.is_stale(data_type, time_range):
+            logging.debug(f"[Sync] Fetching new {data_type} data for user {self.user_id}")
 
             async with SpotifyDataSaver(self.token, self.user_id) as saver:
-                client = SpotifyClient(self.token)
+                client = SpotifyClient(self.token, self.user_id)
                 if data_type == "top_artists":
                     data = await client.get_top_artists(time_range)
-                    await saver.top_artists_to_database(data, time_range, current_time)
+                    await saver.top_artists_to_database(data, time_range)
 
                 elif data_type == "top_tracks":
                     data = await client.get_top_tracks(time_range)
                     await saver.top_tracks_to_database(data, time_range)
 
                 elif data_type == "recent_tracks":
-                    data = await client.get_recently_played_tracks()
+                    # Only plays newer than the last one saved; an idle user costs one empty call
+                    sync_row = await self.get_sync_row(data_type, time_range)
+                    data = await client.get_recently_played_tracks(after=sync_row.cursor if sync_row else None)
+                    if not data:
+                        return False
                     await saver.recents_to_database(data)
 
-        else:
-            logging.info(f"{data_type} for user {self.user_id}, range {time_range} is up to date.")
+            # The saver recorded the new sync time; drop our copy so the next check reloads it
+            self._sync_state = None
+            mark_primary_write(self.user_id)
+            return True
+
+        logging.debug(f"[Sync] {data_type} for user {self.user_id}, range {time_range} is up to date")
+        return False
+
+    async def update_profile_if_needed(self):
+        """Re-read /me on a schedule (PROFILE_REFRESH_HOURS) rather than on every page view."""
+        if not await self.is_stale("profile", ""):
+            return False
+
+        profile = await SpotifyClient(self.token, self.user_id).get_spotify_user_profile()
+        if not profile:
+            return False
+        async with SpotifyDataSaver(self.token, self.user_id) as saver:
+            await saver.profile_to_database(profile)
+
+        self._sync_state = None
+        auth_context_cache.pop(self.user_id)
+        mark_primary_write(self.user_id)
+        return True
+
+    async def update_all_top_items_if_needed(self):
+        """Sync every stale (top_artists|top_tracks, time_range) pair in one cycle.
+
+        The stale lists are fetched concurrently over the pooled HTTP client, then
+        saved one by one as rank diffs. Every range is kept current, so switching
+        ranges on the dashboard never has to wait for Spotify. Returns True when
+        anything was written.
+        """
+        stale = [
+            (data_type, time_range)
+            for data_type in ("top_artists", "top_tracks")
+            for time_range in TIME_RANGES
+            if await self.is_stale(data_type, time_range)
+        ]
+        if not stale:
+            return False
+
+        client = SpotifyClient(self.token, self.user_id)
+        fetchers = {"top_artists": client.get_top_artists, "top_tracks": client.get_top_tracks}
+        results = await asyncio.gather(
+            *(fetchers[data_type](time_range) for data_type, time_range in stale),
+            return_exceptions=True
+        )
+
+        written = False
+        async with SpotifyDataSaver(self.token, self.user_id) as saver:
+            for (data_type, time_range), data in zip(stale, results):
+                if isinstance(data, Exception):
+                    logging.error(f"[Sync] Fetching {data_type} ({time_range}) failed for user {self.user_id}: {data}")
+                    continue
+                await saver.save_top_items(data_type.removeprefix("top_"), data, time_range)
+                written = True
+
+        if written:
+            self._sync_state = None
+            mark_primary_write(self.user_id)
+        return written
 
 
 
@@ -0,0 +1,217 @@
+import contextvars, json, logging, os, time
+
+from sqlalchemy import event
+
+
+# Routes without an explicit @query_budget may issue at most this many statements per request
+DB_QUERY_BUDGET_DEFAULT = int(os.getenv("DB_QUERY_BUDGET_DEFAULT", "20"))
+# Test mode: a request over its budget is answered with a 500 instead of only being logged
+DB_QUERY_BUDGET_ENFORCE = os.getenv("DB_QUERY_BUDGET_ENFORCE", "").lower() in ("1", "true", "yes")
+# Add Server-Timing / X-DB-* headers to every response
+DB_QUERY_HEADERS = os.getenv("DB_QUERY_HEADERS", "1").lower() in ("1", "true", "yes")
+# Statements slower than this are logged with their route
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+
+BACKGROUND = "<background>"  # statements issued outside a request (sync workers, schedulers)
+UNMATCHED = "<unmatched>"  # requests no route matched, kept together so stray paths do not pile up
+
+
+class QueryStats:
+    """Statements issued by one request (or, aggregated, by one route)."""
+
+    __slots__ = ("route", "requests", "count", "max_count", "total_ms", "rows", "slowest_ms", "slowest_sql", "over_budget")
+
+    def __init__(self, route: str = BACKGROUND):
+        self.route = route
+        self.requests = 0
+        self.count = 0
+        self.max_count = 0
+        self.total_ms = 0.0
+        self.rows = 0
+        self.slowest_ms = 0.0
+        self.slowest_sql = None
+        self.over_budget = 0
+
+    def record(self, statement: str, elapsed_ms: float, rows: int):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if rows > 0:
+            self.rows += rows
+        if elapsed_ms > self.slowest_ms:
+            self.slowest_ms = elapsed_ms
+            self.slowest_sql = statement
+
+    def add(self, request: "QueryStats", budget: int):
+        self.requests += 1
+        self.count += request.count
+        self.max_count = max(self.max_count, request.count)
+        self.total_ms += request.total_ms
+        self.rows += request.rows
+        if request.count > budget:
+            self.over_budget += 1
+        if request.slowest_ms > self.slowest_ms:
+            self.slowest_ms = request.slowest_ms
+            self.slowest_sql = request.slowest_sql
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "queries": self.count,
+            "queries_per_request": round(self.count / self.requests, 2) if self.requests else None,
+            "max_queries": self.max_count,
+            "db_ms": round(self.total_ms, 1),
+            "rows": self.rows,
+            "over_budget": self.over_budget,
+            "slowest_ms": round(self.slowest_ms, 1),
+            "slowest_sql": " ".join(self.slowest_sql.split())[:500] if self.slowest_sql else None,
+        }
+
+
+_current: contextvars.ContextVar[QueryStats | None] = contextvars.ContextVar("request_query_stats", default=None)
+_routes: dict[str, QueryStats] = {}
+_background = QueryStats()
+
+
+def query_budget(max_queries: int):
+    """Route decorator (below @app.get): the number of statements one request may issue."""
+    def decorate(endpoint):
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorate
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_started"].pop()) * 1000
+    stats = _current.get()
+    target = stats if stats is not None else _background
+    target.record(statement, elapsed_ms, cursor.rowcount or 0)
+    if elapsed_ms >= DB_SLOW_QUERY_MS:
+        route = stats.route if stats is not None else BACKGROUND
+        logging.warning(f"[SQL] slow statement ({elapsed_ms:.0f} ms) in {route}: {' '.join(statement.split())[:300]}")
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute; drop its start time
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_started"):
+        conn.info["query_started"].pop()
+
+
+def install(*engines):
+    """Attribute every statement on these (async) engines to the request that issued it."""
+    for engine in engines:
+        target = engine.sync_engine
+        if not event.contains(target, "after_cursor_execute", _after_cursor_execute):
+            event.listen(target, "before_cursor_execute", _before_cursor_execute)
+            event.listen(target, "after_cursor_execute", _after_cursor_execute)
+            event.listen(target, "handle_error", _handle_error)
+
+
+class QueryInstrumentationMiddleware:
+    """Per-request statement counts, time and rows, checked against the route's query budget.
+
+    Plain ASGI so the request's context (and so `_current`) is the one the handler runs in.
+
+    Streamed responses (no Content-Length, e.g. /listening-history) start before their
+    queries have run, so they get no X-DB headers and their budget is checked once the
+    body is done: over-budget streams are logged and counted in the route stats, but
+    cannot be turned into a 500.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats(scope["path"])
+        token = _current.set(stats)
+        budget = DB_QUERY_BUDGET_DEFAULT
+        replaced = False
+        streamed = False
+
+        def resolve_route() -> int:
+            # Once the router has matched, use the route template so /tracks/{track_id} aggregates
+            route = scope.get("route")
+            if route is None:
+                stats.route = UNMATCHED
+                return DB_QUERY_BUDGET_DEFAULT
+            stats.route = getattr(route, "path", UNMATCHED)
+            return getattr(getattr(route, "endpoint", None), "query_budget", DB_QUERY_BUDGET_DEFAULT)
+
+        async def send_with_stats(message):
+            nonlocal budget, replaced, streamed
+            if replaced:
+                return
+            if message["type"] == "http.response.start":
+                budget = resolve_route()
+                # 204/304 carry no body and so no Content-Length either; they are not streams
+                streamed = message["status"] not in (204, 304) and not any(
+                    name.lower() == b"content-length" for name, _ in message.get("headers", []))
+                if streamed:
+                    await send(message)
+                    return
+
+                if stats.count > budget:
+                    logging.warning(f"[SQL] {stats.route} issued {stats.count} statements (budget {budget})")
+                    if DB_QUERY_BUDGET_ENFORCE:
+                        replaced = True
+                        body = json.dumps({
+                            "error": "query budget exceeded",
+                            "route": stats.route,
+                            "queries": stats.count,
+                            "budget": budget,
+                        }).encode()
+                        await send({"type": "http.response.start", "status": 500, "headers": [
+                            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                        ]})
+                        await send({"type": "http.response.body", "body": body})
+                        return
+
+                if DB_QUERY_HEADERS:
+                    message = {**message, "headers": list(message.get("headers", [])) + [
+                        (b"server-timing", f'db;dur={stats.total_ms:.1f};desc="{stats.count} queries"'.encode()),
+                        (b"x-db-query-count", str(stats.count).encode()),
+                        (b"x-db-rows", str(stats.rows).encode()),
+                    ]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _current.reset(token)
+            # Unhandled errors are answered outside this middleware, so the route may still be unresolved
+            budget = resolve_route()
+            if streamed and stats.count > budget:
+                logging.warning(f"[SQL] {stats.route} issued {stats.count} statements (budget {budget}) while streaming")
+            if stats.route not in _routes:
+                _routes[stats.route] = QueryStats(stats.route)
+            _routes[stats.route].add(stats, budget)
+
+
+def get_query_stats() -> dict:
+    """Per-route totals since startup (or the last reset), heaviest first."""
+    routes = sorted(_routes.values(), key=lambda s: s.total_ms, reverse=True)
+    return {
+        "budget_default": DB_QUERY_BUDGET_DEFAULT,
+        "enforce": DB_QUERY_BUDGET_ENFORCE,
+        "routes": {s.route: s.to_dict() for s in routes},
+        "background": _background.to_dict(),
+    }
+
+
+def routes_over_budget() -> dict[str, int]:
+    """{route: requests over budget}; empty when every route stayed within its budget."""
+    return {route: s.over_budget for route, s in _routes.items() if s.over_budget}
+
+
+def reset_query_stats():
+    global _background
+    _routes.clear()
+    _background = QueryStats()
@@ -0,0 +1,207 @@
+import contextvars, json, logging, logging.handlers, os, queue, re, sys, threading, time, uuid
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# "json" (one object per line, for log shippers) or "text" (for a terminal)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Records waiting for the writer thread; past this, new records are dropped instead of blocking the loop
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Each call site may log LOG_RATE_LIMIT_BURST records per LOG_RATE_LIMIT_SECONDS; the rest are
+# counted and reported in one line once the window is over. 0 disables the limit.
+LOG_RATE_LIMIT_BURST = int(os.getenv("LOG_RATE_LIMIT_BURST", "20"))
+LOG_RATE_LIMIT_SECONDS = float(os.getenv("LOG_RATE_LIMIT_SECONDS", "60"))
+
+REQUEST_ID_HEADER = "x-request-id"
+
+_request_id: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+# Tokens and secrets that must never reach the log, whatever a message interpolates
+_SECRET_PATTERNS = (
+    (re.compile(r"(Bearer\s+)[A-Za-z0-9._~+/=-]+", re.IGNORECASE), r"\1[redacted]"),
+    (re.compile(r"""(["']?(?:access_token|refresh_token|client_secret|spotify_token|password)["']?\s*[:=]\s*["']?)[^"',&\s}]+""",
+                re.IGNORECASE), r"\1[redacted]"),
+    (re.compile(r"([?&]code=)[^&\s]+"), r"\1[redacted]"),  # OAuth authorization codes in callback URLs
+    (re.compile(r"(Basic\s+)[A-Za-z0-9+/=]{16,}", re.IGNORECASE), r"\1[redacted]"),
+)
+
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+def redact(message: str) -> str:
+    for pattern, replacement in _SECRET_PATTERNS:
+        message = pattern.sub(replacement, message)
+    return message
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps every record with the current request's correlation id and strips secrets from it.
+
+    Runs in the logging thread's caller (the event loop), where the request's context is visible.
+    """
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        message = record.getMessage()
+        cleaned = redact(message)
+        # Freeze the formatted message here: args may be mutated before the writer thread formats it
+        record.msg, record.args = cleaned, None
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Per call site (file and line), at most `burst` records per `window` seconds.
+
+    A loop that logs the same warning for every item, or every request logging the
+    same failure during an outage, collapses into one "suppressed N" line per window.
+    """
+
+    def __init__(self, burst: int = LOG_RATE_LIMIT_BURST, window: float = LOG_RATE_LIMIT_SECONDS):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self._sites: dict[tuple, list] = {}  # (pathname, lineno) -> [window start, emitted, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        # Access lines all come from one uvicorn call site but are one per request, not repetition
+        if self.burst <= 0 or record.levelno >= logging.CRITICAL or record.name == "uvicorn.access":
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                suppressed = site[2] if site is not None else 0
+                self._sites[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} (suppressed {suppressed} similar messages in the last {self.window:.0f}s)"
+                    record.args = None
+                if len(self._sites) > 10000:
+                    # Call sites are bounded by the code, but never let this grow without limit
+                    self._sites = {k: v for k, v in self._sites.items() if now - v[0] < self.window}
+                return True
+            if site[1] < self.burst:
+                site[1] += 1
+                return True
+            site[2] += 1
+            return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks the caller: when the writer falls behind, records are dropped and counted."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The filters already froze the message; keep exc_info as text so the record pickles and survives
+        if record.exc_info:
+            record.exc_text = redact(logging.Formatter().formatException(record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+_listener: logging.handlers.QueueListener | None = None
+_queue_handler: DroppingQueueHandler | None = None
+
+
+def setup_logging():
+    """Route the root logger through a bounded queue to a writer thread; safe to call more than once."""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+        formatter.converter = time.gmtime
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)-7s [%(request_id)s] %(name)s: %(message)s")
+    stream.setFormatter(formatter)
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _queue_handler.addFilter(RateLimitFilter())
+    _queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(LOG_LEVEL)
+    # Per-statement SQL and per-request HTTP client lines are far too chatty for INFO
+    logging.getLogger("httpx").setLevel(max(root.level, logging.WARNING))
+    logging.getLogger("sqlalchemy.engine").setLevel(max(root.level, logging.WARNING))
+    # Uvicorn's loggers write to their own stream handlers; send them through the queue too
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, stream, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Flush what is queued and stop the writer thread (lifespan shutdown)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        if _queue_handler is not None and _queue_handler.dropped:
+            print(f"[logging] dropped {_queue_handler.dropped} records while the queue was full", file=sys.stderr)
+
+
+class RequestIdMiddleware:
+    """Gives every request a correlation id (the caller's X-Request-ID, or a new one) and echoes it back."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == REQUEST_ID_HEADER.encode():
+                request_id = value.decode("latin-1")[:64]
+                break
+        if not request_id or not re.fullmatch(r"[A-Za-z0-9._:-]+", request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (REQUEST_ID_HEADER.encode(), request_id.encode()),
+                ]}
+            await send(message)
+
+        token = _request_id.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _request_id.reset(token)
@@ -1,90 +1,110 @@
 from fastapi import FastAPI, Request, Query, HTTPException, UploadFile, File, APIRouter, Depends, Form
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, PlainTextResponse
+from fastapi.encoders import jsonable_encoder
 from starlette.middleware.sessions import SessionMiddleware
 from starlette.responses import RedirectResponse
-import time, asyncio, zipfile, json, logging, traceback
+import time, asyncio, zipfile, json, logging, os
 from io import BytesIO
 from contextlib import asynccontextmanager
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime, timedelta, timezone
-from sqlalchemy import update, select
+from sqlalchemy import update, select, text
 from typing import Optional
 
 
 # Import Spotify helper functions
-from app.oauth import OAuthSettings, SpotifyOAuth, SpotifyHandler, SpotifyUser
-from app.spotify_api import SpotifyClient
-from app.database import get_db_connection, AsyncSessionLocal
-from app.helpers import MusicDataService, UserMusicUpdater, TokenRefresh
+from app.oauth import OAuthSettings, SpotifyOAuth, SpotifyHandler
+from app.spotify_api import SPOTIFY_API_URL, close_http_client, get_http_client, response_cache
+from app.database import get_db, get_read_db, AsyncSessionLocal, engine, get_pool_stats, replica_engine, REPLICA_CONFIGURED, mark_primary_write
+from app.crud import SpotifyDataSaver
+from app import queries
+from app.helpers import MusicDataService, TokenRefresh, time_period_classifier
+from app.streaming import stream_rows, stream_template
 from app.db import User, Track, Album, Artist, UsersTopTracks, UsersTopArtists, ListeningHistory
-from app.routers import messages
-from app.dependencies import get_current_user
-
-# Function to fetch user data from Spotify
-import httpx
-
+from app.partitions import ensure_future_partitions, maintain_recent_partitions
+from app.token_scheduler import token_scheduler
+from app.sync_service import sync_service, PRIORITY_ACTIVE
+from app.catalog_batcher import get_batcher_stats
+from app.circuit_breaker import get_breaker_states
+from app.instrumentation import QueryInstrumentationMiddleware, get_query_stats, install as install_query_instrumentation, query_budget, reset_query_stats
+from app.profiler import ProfilerMiddleware, profiler
+from app.logging_config import RequestIdMiddleware, setup_logging, stop_logging
+from app.metrics import METRICS_ENABLED, MetricsMiddleware, register_collectors, render as render_metrics, spotify_rate_limited, spotify_retry_after, timed_job
+from app.routers import messages, stats_api, dashboard_panels
+from app.dependencies import get_current_user, load_auth_context, require_admin
+from app.cache import auth_context_cache
+
+
+# Queue-backed logging with per-request correlation ids; see app/logging_config.py
+setup_logging()
 
 settings = OAuthSettings()
 spotify_oauth = SpotifyOAuth(settings)
 
 scheduler = AsyncIOScheduler()
 
+# Tokens are refreshed by token_scheduler as they near expiry; this sweep only catches stragglers
+TOKEN_SWEEP_MINUTES = int(os.getenv("TOKEN_SWEEP_MINUTES", "60"))
+# Background re-sync of recently active users (recently-played only returns the last 50 plays)
+SYNC_INTERVAL_MINUTES = int(os.getenv("SYNC_INTERVAL_MINUTES", "5"))
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Start scheduler ONCE
     if not scheduler.running:
-        scheduler.add_job(refresh_tokens_periodically, 'interval', minutes=5)
+        await ensure_future_partitions()
+        await token_scheduler.start(spotify_oauth)
+        sync_service.start()
+        scheduler.add_job(timed_job("enqueue_active_users", sync_service.enqueue_active_users), 'interval', minutes=SYNC_INTERVAL_MINUTES)
+        scheduler.add_job(timed_job("token_sweep", refresh_tokens_periodically), 'interval', minutes=TOKEN_SWEEP_MINUTES, max_instances=1, coalesce=True)
+        scheduler.add_job(timed_job("ensure_future_partitions", ensure_future_partitions), 'interval', days=1)
+        scheduler.add_job(timed_job("maintain_recent_partitions", maintain_recent_partitions), 'cron', hour=4)
         scheduler.start()
     yield
     # Stop scheduler on shutdown
     scheduler.shutdown()
+    await token_scheduler.stop()
+    await sync_service.stop()
+    await close_http_client()
+    stop_logging()
 
 app = FastAPI(lifespan=lifespan)
 router = APIRouter()
 app.include_router(messages.router)
+# Versioned JSON stats, one metric per endpoint (/api/v1/users/{user_id}/stats/...)
+app.include_router(stats_api.router)
+# The dashboard's lazily loaded sections (/dashboard/panels/...)
+app.include_router(dashboard_panels.router)
 
 async def refresh_tokens_periodically():
-    print("starting token refresh job")
+    # Safety net for the refresh scheduler: catches tokens it never saw, e.g. users
+    # who logged in through another worker process
+    started = time.perf_counter()
     async with AsyncSessionLocal() as db:
-        print("[Scheduler] Token refresh job started.")
-        data_service = TokenRefresh(db)
-        users = await data_service.get_all_users_from_db()
-
-        now = datetime.now(timezone.utc)
-        buffer = timedelta(minutes=5)
-
-        for user in users:
-            try:
-                expires_at = user.token_expires
-                if expires_at.tzinfo is None:
-                    expires_at = expires_at.replace(tzinfo=timezone.utc)
-
-                print(f"[{now}] Checking user {user.user_id} token expiry: {expires_at} (UTC)")
-
-                if expires_at <= now + buffer:
-                    print(f"[{now}] Token for user {user.user_id} is expiring or expired. Refreshing...")
-                    new_token = await spotify_oauth.refresh_access_token(user.refresh_token)
-                    print("New token data:", new_token)
-
-                    if new_token:
-                        await data_service.update_user_token(
-                            user_id=user.user_id,
-                            access_token=new_token["access_token"],
-                            refresh_token=new_token.get("refresh_token", user.refresh_token),
-                            token_expires=datetime.fromtimestamp(new_token["expires_at"], tz=timezone.utc)
-                        )
-                    else:
-                        print(f"Failed to refresh token for user {user.user_id}.")
-                else:
-                    print(f"[{now}] Token for user {user.user_id} is still valid.")
-            except Exception as e:
-                print(f"Error refreshing token for user {user.user_id}: {e}")
+        refreshed, failed = await TokenRefresh(db).refresh_expiring_tokens(spotify_oauth)
+    for user_id, _access_token, _refresh_token, token_expires in refreshed:
+        token_scheduler.schedule(user_id, token_expires)
+    logging.info(f"[Scheduler] Token sweep: {len(refreshed)} refreshed, {len(failed)} failed in {time.perf_counter() - started:.1f}s")
 
 # ✅ Session Middleware
 app.add_middleware(SessionMiddleware, secret_key="your_super_secret_key", session_cookie="spotify_session")
 
+# Per-request SQL counts and query budgets (see /debug/queries)
+install_query_instrumentation(engine, replica_engine)
+app.add_middleware(QueryInstrumentationMiddleware)
+
+# Request latency histograms and the in-process counters behind /metrics
+register_collectors()
+app.add_middleware(MetricsMiddleware)
+
+# Opt-in stack sampling of slow (and a share of all) requests; see /debug/profiles
+app.add_middleware(ProfilerMiddleware)
+
+# Outermost, so every log line of a request (and the other middlewares') carries its X-Request-ID
+app.add_middleware(RequestIdMiddleware)
+
 # ✅ Setup Jinja2 Templates
 templates = Jinja2Templates(directory="app/templates") 
 
@@ -92,32 +112,18 @@ templates = Jinja2Templates(directory="app/templates")
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 @app.get("/")
-async def root(request: Request):
-    # Get the Spotify token from the session (None if not logged in)
-    access_token = request.session.get("spotify_token")
-    client_data = SpotifyClient(access_token)
-
+async def root(request: Request, db=Depends(get_db)):
     # Default values in case the user is not logged in
     user_image, user_name = None, "Guest"
 
-    # If the user is logged in, fetch user profile data
-    if access_token:
-        db = get_db_connection()
-        cursor = db.cursor()
-
-        # Get the user profile from Spotify
-        user_profile = await client_data.get_spotify_user_profile()
-        spotify_user = SpotifyUser(access_token)
-        user_data = await spotify_user.store_user_info_to_database(user_profile, db)
-        user_id = user_data["id"]
-
-        # Fetch user info from the database (image and name)
-        cursor.execute("SELECT images, display_name FROM users WHERE id = %s;", (user_id,))
-        user_info = cursor.fetchone()  # Fetch only once
+    # If the user is logged in, use the cached auth context (no Spotify call)
+    user_id = request.session.get("user_id")
+    if request.session.get("spotify_token") and user_id:
+        user_info = await load_auth_context(user_id, db)
 
         # Handle user information safely
         if user_info:
-            user_image, user_name = user_info  # Unpack values
+            user_image, user_name = user_info["image_url"], user_info["display_name"]
         else:
             user_image, user_name = None, "Unknown User"  # Default values if data is missing
 
@@ -129,15 +135,14 @@ async def root(request: Request):
     })
 
 @app.get("/layout")
-async def layout_page(request: Request, user_data: dict = Depends(SpotifyHandler.get_current_user)):
-    db = await get_db_connection()  # Get the async connection
-
+async def layout_page(request: Request, db=Depends(get_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data.get("user_id")
-    print(f"User ID from session: {user_id}")  
-
-    user_info = await db.fetchrow("SELECT image_url, display_name FROM users WHERE user_id = $1;", user_id)
 
-    await db.close()  # Properly close the async connection
+    result = await db.execute(
+        text("SELECT image_url, display_name FROM users WHERE user_id = :user_id;"),
+        {"user_id": user_id}
+    )
+    user_info = result.mappings().one_or_none()
 
     if user_info:
         user_image, user_name = user_info["image_url"], user_info["display_name"]
@@ -183,7 +188,7 @@ async def callback(request: Request):
         return RedirectResponse(url="/dashboard")
 
     except Exception as e:
-        print(f"Callback error: {e}")
+        logging.exception(f"[OAuth] Callback failed: {e}")
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
@@ -191,169 +196,59 @@ async def callback(request: Request):
 
 
 async def get_spotify_user_profile(token):
-    url = "https://api.spotify.com/v1/me"
+    url = f"{SPOTIFY_API_URL}/me"
     headers = {"Authorization": f"Bearer {token}"}
 
     while True:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
+        response = await get_http_client().get(url, headers=headers)
 
-            if response.status_code == 200:
-                return response.json()
+        if response.status_code == 200:
+            return response.json()
 
-            elif response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After", 5))  # Default wait: 5 sec
-                print(f"429 Too Many Requests. Retrying after {retry_after} seconds...")
-                time.sleep(retry_after)  #Wait before retrying
-                continue  # Retry the request
+        elif response.status_code == 429:
+            retry_after = int(response.headers.get("Retry-After", 5))  # Default wait: 5 sec
+            spotify_rate_limited.inc("get_spotify_user_profile")
+            spotify_retry_after.observe(retry_after, "get_spotify_user_profile")
+            logging.warning(f"[Spotify] 429 Too Many Requests fetching the profile. Retrying after {retry_after} seconds...")
+            await asyncio.sleep(retry_after)  #Wait before retrying
+            continue  # Retry the request
 
-            else:
-                print(f"Error fetching user profile: {response.status_code} - {response.text}")
-                return None
+        else:
+            logging.error(f"[Spotify] Error fetching user profile: {response.status_code} - {response.text[:500]}")
+            return None
 
 
 @app.get("/dashboard")
-async def dashboard(request: Request, limit: int = 1000, offset: int = 0, user_data: dict = Depends(SpotifyHandler.get_current_user)):
-    db = None
+@query_budget(3)
+async def dashboard(request: Request, read_db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     try:
 
-        token = user_data["token"]  # Extract token if needed
         user_id = user_data["user_id"]  # Extract user_id if needed
-        print(f"User ID from session: {user_id}")
 
-        db = await get_db_connection()
         time_range = request.query_params.get('time_range', 'medium_term')
 
-        updater = UserMusicUpdater(db, user_id, token)
+        # Spotify data is pulled by the background sync workers; render what is stored now.
+        # get_read_db already routes to the primary if a sync wrote this user's data recently.
+        sync_service.request_sync(user_id, time_range, priority=PRIORITY_ACTIVE)
 
-        await asyncio.gather(
-            updater.update_data_if_needed("top_artists", time_range),
-            updater.update_data_if_needed("top_tracks", time_range),
-            updater.update_data_if_needed("recent_tracks", time_range)
-        )
-
-        user_service = MusicDataService(user_id, db)
-
-        user_info = await user_service.get_user_info()
-        top_artist_list = await user_service.get_top_artists_db(time_range)
-        top_tracks_list = await user_service.get_top_tracks_db(time_range)
-        track_play_counts = await user_service.get_track_play_counts()
-        daily_play_count = await user_service.get_daily_play_counts()
-        total_play_count = await user_service.get_total_play_count()
-        total_play_today = await user_service.get_total_play_today()
-        daily_listening_time = await user_service.get_daily_listening_time()
-        total_listened_minutes, total_listened_hours = await user_service.get_total_listening_time()
-        top_genres = await user_service.get_top_genres()
-        records_by_time = await user_service.complete_listening_history(limit, offset)
-
-
-        #TESTING 
-        print("TESTING:")
-        days_listened = await user_service.get_consecutive_days_listened() #passed
-        print(f"Consecutive days listened: {days_listened}")
-        biggest_streak_one_song = await user_service.get_most_listened_song_streak() #passed
-        print(f"Biggest streak for one song: {biggest_streak_one_song}")
-        streak_inbetween_song = await user_service.get_streak_of_song_played_inbetween() #passed
-        print(f"Streak of song played inbetween: {streak_inbetween_song}")
-        average_song_popularity = await user_service.get_average_popularity() #passed
-        print(f"Average song popularity: {average_song_popularity}")
-        average_album_release_date = await user_service.get_average_release_date() #passed
-        print(f"Average album release date: {average_album_release_date}")
-
-        # top artists and top tracks from local database per user
-        async with AsyncSessionLocal() as session:
-            stats = MusicDataService(user_id, session)
-
-            top_tracks = await stats.get_top_tracks(limit=50)
-            print("Top Tracks:")
-            for i, track in enumerate(top_tracks, start=1):
-                print(f"{i}. {track['name']} - {track['total_streams']} streams")
-
-            top_artists = await stats.get_top_artists(limit=50)
-            print("Top Artists:")
-            for i, artist in enumerate(top_artists, start=1):
-                print(f"{i}. {artist['name']} - {artist['total_streams']} streams")
-
-        # Fetch user to artist stats // artist, number of streams, distinct tracks listened, total duration 
-        user_to_artist = await user_service.get_user_artist_stats(user_id)
-        print("User to Artist Stats:")
-        for row in user_to_artist:
-            artist_id = row["artist_id"]
-            artist_name = row["artist_name"]
-            total_duration = row["total_duration_ms"]
-            total_streams = row["total_streams"]
-            distinct_tracks_listened = row["distinct_tracks_listened"]
-            total_seconds = total_duration // 1000 if total_duration else 0
-            formatted_duration = str(timedelta(seconds=total_seconds))
-            print(f"Artist ID: {artist_id}, Artist Name: {artist_name}, Streams: {total_streams}, "
-                f"Distinct Tracks: {distinct_tracks_listened}, Total Duration: {formatted_duration}")
-        
-        #streams per distinctive genres per user 
-        distinctive_genres_per_user = await user_service.get_user_genre_stats(user_id)
-        print("Distinctive Genres per User:")
-        for row in distinctive_genres_per_user:
-            genre = row["genre"]
-            total_streams = row["total_streams"]
-            print(f"Genre: {genre}, Streams: {total_streams}")
-
-        #monthly stats
-        monthly_stats = await user_service.get_monthly_stats(user_id)
-        print("Monthly Stats:")
-        for stats in monthly_stats:
-            month = stats["month"]
-            total_songs_listened = stats["total_songs_listened"]
-            total_duration_minutes = stats["total_duration_minutes"]
-            total_duration_hours = stats["total_duration_hours"]
-            print(f"Month: {month}, total_songs_listened: {total_songs_listened}, "
-                  f"total_duration_minutes: {total_duration_minutes} minutes, "
-                  f"total_duration_hours: {total_duration_hours} hours")
-            
-        # First song listened
-        first_last_listened = await user_service.get_first_and_last_listened()
-        print(f"first_last_listened: {first_last_listened}")
-
-        # Unique numbers of artists and tracks
-        unique_artists_count = await user_service.get_unique_listening_counts()
-        print(f"Unique artists count: {unique_artists_count}")
-
-        # Get currently playing track
-        spotify_client = SpotifyClient(token)
-        playing_now_data = await spotify_client.get_now_playing() or {
-            "track_name": "N/A",
-            "artists": "N/A",
-            "album_image_url": "N/A"
-        }
+        # Only the shell is rendered here; every metric is its own panel under /dashboard/panels,
+        # fetched by the page once it is on screen (see app/routers/dashboard_panels.py)
+        last_synced = await MusicDataService(user_id, read_db).get_last_synced()
 
     except Exception as e:
-        error_traceback = traceback.format_exc()
-        print(f"Error fetching dashboard data: {str(e)}\nTraceback:\n{error_traceback}")
+        logging.exception(f"[Dashboard] Error fetching dashboard data: {e}")
         return JSONResponse(content={"error": "An unexpected error occurred."}, status_code=500)
-    finally:
-        if db:
-            await db.close()
 
     context = {
         "request": request,
         "user_id": user_id,
-        "user_info": user_info,
-        "top_artist_list": top_artist_list,
-        "top_tracks_list": top_tracks_list,
-        "track_play_counts": track_play_counts,
-        "daily_play_count": daily_play_count,
-        "total_play_count": total_play_count,
-        "total_play_today": total_play_today,
-        "daily_listening_time": daily_listening_time,
-        "total_listened_minutes": total_listened_minutes,
-        "total_listened_hours": total_listened_hours,
-        "top_genres": top_genres,
-        "records_by_time": records_by_time,
-        "playing_now_data": playing_now_data,
         "current_time_range": time_range,
-        "user_image": user_info.get("image_url") if user_info else None,
-        "user_name": user_info.get("display_name") if user_info else "Unknown User",
-        "track_name": playing_now_data.get("track_name"),
-        "artist_name": playing_now_data.get("artists"),
-        "album_img": playing_now_data.get("album_image_url")
+        "user_image": user_data.get("image_url"),
+        "user_name": user_data.get("display_name") or "Unknown User",
+        "last_synced": last_synced,
+        # Part of every panel URL: a new sync means new URLs, so panels can be cached until then
+        "panel_version": int(last_synced.timestamp()) if last_synced else 0,
+        "sync_pending": sync_service.is_syncing(user_id)
     }
 
     return templates.TemplateResponse("dashboard.html", context)
@@ -362,7 +257,7 @@ async def dashboard(request: Request, limit: int = 1000, offset: int = 0, user_d
 # /users/{user_id}	
 # Endpoint to fetch user profile data for other users
 @app.get("/users/{user_id}", response_class=HTMLResponse)
-async def get_user_profile(request: Request, user_id: str, db=Depends(get_db_connection)):
+async def get_user_profile(request: Request, user_id: str, db=Depends(get_read_db)):
     stmt = select(
         User.user_id,
         User.image_url,
@@ -388,10 +283,11 @@ async def get_user_profile(request: Request, user_id: str, db=Depends(get_db_con
 
 # /tracks/{track_id}
 @app.get("/tracks/{track_id}")
+@query_budget(6)
 async def get_track_details(
     request: Request,
     track_id: str,
-    db=Depends(get_db_connection),
+    db=Depends(get_read_db),
     current_user: dict = Depends(get_current_user)
 ):
     # Fetch track details
@@ -554,10 +450,11 @@ from collections import Counter
 from datetime import timedelta
 
 @app.get("/albums/{album_id}")
+@query_budget(8)
 async def get_album_details(
     request: Request,
     album_id: str,
-    db=Depends(get_db_connection),
+    db=Depends(get_read_db),
     user_id: Optional[str] = None
 ):
     # --- 1. Basic Album Info ---
@@ -618,15 +515,12 @@ async def get_album_details(
     # --- 4. Album-level aggregates ---
     total_album_listens = sum(stat["listen_count"] for stat in global_stats.values())
 
-    # Properly gather all user_ids before creating set
-    all_user_ids = []
-    for tid in global_stats:
-        ids = await db.scalars(
-            select(ListeningHistory.user_id).where(ListeningHistory.track_id == tid)
-        )
-        all_user_ids.extend(ids.all())
-
-    unique_album_listeners = len(set(all_user_ids))
+    # Distinct listeners across the whole album, counted in one query
+    unique_album_listeners = 0
+    if global_stats:
+        unique_album_listeners = await db.scalar(
+            select(func.count(distinct(ListeningHistory.user_id))).where(ListeningHistory.track_id.in_(track_ids))
+        ) or 0
 
     most_played_track_id = max(global_stats, key=lambda tid: global_stats[tid]["listen_count"]) if global_stats else None
     most_played_track_name = track_names.get(most_played_track_id, "N/A")
@@ -677,28 +571,23 @@ async def get_album_details(
                 (sum([r.play_count * track_durations[r.track_id] for r in user_listens]) / 1000 / 60) / 60, 2
             )
 
-            # Most common listening hour
-            hour_stmt = select(ListeningHistory.played_at).where(
-                ListeningHistory.user_id == user_id,
-                ListeningHistory.track_id.in_(track_ids)
-            )
-            hour_result = await db.execute(hour_stmt)
-            hours = [dt.hour for (dt,) in hour_result]
-            most_common_hour = Counter(hours).most_common(1)[0][0] if hours else None
-
-            # Peak listening day calculation
-            days_result = await db.execute(
+            # Most common listening hour and peak day, from one fetch of the play times
+            played_result = await db.execute(
                 select(ListeningHistory.played_at).where(
                     ListeningHistory.user_id == user_id,
                     ListeningHistory.track_id.in_(track_ids)
                 )
             )
-            days = [dt.date() for (dt,) in days_result]
+            played_times = played_result.scalars().all()
+            hours = [dt.hour for dt in played_times]
+            most_common_hour = Counter(hours).most_common(1)[0][0] if hours else None
+
+            # Peak listening day calculation
+            days = [dt.date() for dt in played_times]
 
             peak_listening_day = None
             if days:
                 peak_listening_day = Counter(days).most_common(1)[0][0].strftime("%Y-%m-%d")
-                print(f"Peak listening day: {peak_listening_day}")
 
             # Format peak listening time (hour)
             def format_hour(h):
@@ -711,7 +600,6 @@ async def get_album_details(
                 return f"{hour_12} {suffix}"
 
             formatted_peak_time = format_hour(most_common_hour)
-            print(f"Formatted peak listening time: {formatted_peak_time}")
 
             # Listening streak
             unique_days = sorted(set(days))
@@ -785,10 +673,11 @@ async def get_album_details(
 
 
 @app.get("/artists/{artist_id}")
+@query_budget(10)
 async def get_artist_details(
     request: Request,
     artist_id: str,
-    db=Depends(get_db_connection),
+    db=Depends(get_read_db),
     current_user: dict = Depends(get_current_user)
 ):
     # --- 1. Basic Artist Info ---
@@ -898,10 +787,11 @@ from sqlalchemy import func
 from math import ceil
 
 @app.get("/genres/{genre_name}")
+@query_budget(6)
 async def get_genre_details(
     request: Request,
     genre_name: str,
-    db=Depends(get_db_connection),
+    db=Depends(get_read_db),
     search: str = "",
     sort: str = "popularity",  # or "release_date"
     page: int = 1,
@@ -983,11 +873,12 @@ async def get_genre_details(
 
 
 @app.get("/compare/{user_id_1}/{user_id_2}")
+@query_budget(5)
 async def compare_users(
     request: Request,
     user_id_1: str,
     user_id_2: str,
-    db=Depends(get_db_connection)
+    db=Depends(get_read_db)
 ):
     # Fetch user profiles
     stmt = select(
@@ -1091,7 +982,8 @@ async def compare_users(
 
 # /search?q=...	
 @app.get("/search")
-async def search(request: Request, q: str = Query(..., min_length=1), db=Depends(get_db_connection), limit: int = Query(10, ge=1, le=50), offset: int = Query(0, ge=0)
+@query_budget(5)
+async def search(request: Request, q: str = Query(..., min_length=1), db=Depends(get_read_db), limit: int = Query(10, ge=1, le=50), offset: int = Query(0, ge=0)
 ):
     # Search for tracks, artists, and albums
     search_results = {
@@ -1143,8 +1035,9 @@ async def search(request: Request, q: str = Query(..., min_length=1), db=Depends
     })
 
 # /trending or /explore	Global stats — most listened artists/tracks across the platform.
-@app.get("/trending")   
-async def trending(request: Request, db=Depends(get_db_connection)):
+@app.get("/trending")
+@query_budget(4)
+async def trending(request: Request, db=Depends(get_read_db)):
     # Fetch global stats for trending artists and tracks
     stmt = select(
         Artist.artist_id,
@@ -1178,6 +1071,67 @@ async def trending(request: Request, db=Depends(get_db_connection)):
 
 # /history or /timeline	Personal listening history (calendar/timeline view).
 
+# Pool usage for sizing DB_POOL_SIZE / DB_MAX_OVERFLOW against the number of workers
+@app.get("/debug/db-pool", dependencies=[Depends(require_admin)])
+async def debug_db_pool():
+    pools = {"primary": get_pool_stats()}
+    if REPLICA_CONFIGURED:
+        pools["replica"] = get_pool_stats(replica_engine)
+    return JSONResponse(content=pools)
+
+
+@app.get("/debug/sync", dependencies=[Depends(require_admin)])
+async def debug_sync():
+    return JSONResponse(content={**sync_service.stats(), "catalog_batchers": get_batcher_stats()})
+
+
+@app.get("/debug/spotify-cache", dependencies=[Depends(require_admin)])
+async def debug_spotify_cache():
+    return JSONResponse(content={"responses": response_cache.stats(), "auth_context": auth_context_cache.stats()})
+
+
+@app.get("/debug/circuit-breakers", dependencies=[Depends(require_admin)])
+async def debug_circuit_breakers():
+    return JSONResponse(content=get_breaker_states())
+
+
+@app.get("/debug/queries", dependencies=[Depends(require_admin)])
+async def debug_queries():
+    return JSONResponse(content=get_query_stats())
+
+
+# Returns the stats as they were, then starts counting afresh
+@app.post("/debug/queries/reset", dependencies=[Depends(require_admin)])
+async def debug_queries_reset():
+    stats = get_query_stats()
+    reset_query_stats()
+    return JSONResponse(content=stats)
+
+
+# Sampled stacks per route: JSON summary, or ?format=collapsed for flamegraph.pl / speedscope
+@app.get("/debug/profiles", dependencies=[Depends(require_admin)])
+async def debug_profiles(route: Optional[str] = None, format: str = Query("json", pattern="^(json|collapsed)$")):
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed(route))
+    summary = profiler.summary()
+    if route:
+        summary["routes"] = {name: p for name, p in summary["routes"].items() if name == route}
+    return JSONResponse(content=summary)
+
+
+@app.post("/debug/profiles/reset", dependencies=[Depends(require_admin)])
+async def debug_profiles_reset():
+    profiler.reset()
+    return JSONResponse(content={"reset": True})
+
+
+# Prometheus text format, read straight from this worker's in-process counters
+@app.get("/metrics")
+async def metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # /messages, /notifications 
 @app.get("/messages-page")
 async def messages_page(request: Request):
@@ -1185,7 +1139,7 @@ async def messages_page(request: Request):
 
 # STREAMS BY DAY OF THE WEEK
 @app.get("/streams-by-day")
-async def streams_by_day(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def streams_by_day(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
     # Fetch streams by day of the week
     stmt = select(
@@ -1206,7 +1160,7 @@ async def streams_by_day(request: Request, db=Depends(get_db_connection), user_d
 
 #STREAMS BY MONTH OF THE YEAR
 @app.get("/streams-by-month")
-async def streams_by_month(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def streams_by_month(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
     # Fetch streams by month of the year
     stmt = select(
@@ -1230,7 +1184,7 @@ async def streams_by_month(request: Request, db=Depends(get_db_connection), user
 
 #ON THIS DAY YOU LISTENED
 @app.get("/on-this-day")
-async def on_this_day(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def on_this_day(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
     today = datetime.now(timezone.utc).date()
 
@@ -1258,7 +1212,7 @@ async def on_this_day(request: Request, db=Depends(get_db_connection), user_data
 
 #TODAYS TOPS
 @app.get("/todays-tops")
-async def todays_tops(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def todays_tops(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
     today = datetime.now(timezone.utc).date()
 
@@ -1289,7 +1243,7 @@ async def todays_tops(request: Request, db=Depends(get_db_connection), user_data
 
 #ALL ARTIST LISTENED BY STREAMS
 @app.get("/all-artists")
-async def all_artists(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def all_artists(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
 
     # Fetch all artists listened to by the user, ordered by total streams
@@ -1313,7 +1267,7 @@ async def all_artists(request: Request, db=Depends(get_db_connection), user_data
 
 #GLOBAL RANK PER ARTIST
 @app.get("/global-artist-rank")
-async def global_artist_rank(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def global_artist_rank(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
 
     # Fetch global artist rank based on total streams
@@ -1337,7 +1291,7 @@ async def global_artist_rank(request: Request, db=Depends(get_db_connection), us
 
 #GLOBAL RANK PER SONG
 @app.get("/global-song-rank")
-async def global_song_rank(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def global_song_rank(request: Request, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
 
     # Fetch global song rank based on total streams
@@ -1371,23 +1325,15 @@ async def global_song_rank(request: Request, db=Depends(get_db_connection), user
 
 
 @app.get("/profile", response_class=HTMLResponse)
-async def profile(request: Request):
+async def profile(request: Request, db=Depends(get_db)):
     access_token = request.session.get("spotify_token")
-    client_data = SpotifyClient(access_token)
 
     user_image, user_name = None, "Guest"
     user_info_dict = {}
-    user_id = None
-
-    if access_token:
-        db = await get_db_connection()
-
-        # Get user info from Spotify and update DB
-        user_profile = await client_data.get_spotify_user_profile()
-        spotify_user = SpotifyUser(access_token)
-        user_data = await spotify_user.store_user_info_to_database(user_profile, db)
-        user_id = user_data["id"]
+    # Profile is stored at login and refreshed by the background sync; no /me call here
+    user_id = request.session.get("user_id") if access_token else None
 
+    if user_id:
         # Get additional user settings from DB
         stmt = select(
             User.user_id,
@@ -1412,8 +1358,6 @@ async def profile(request: Request):
         # Save user_id to session
         request.session["spotify_user_id"] = user_id
 
-        await db.close()
-
     if not access_token or not user_id or user_name == "Guest":
         return RedirectResponse(url="/login", status_code=302)
 
@@ -1437,14 +1381,13 @@ async def update_settings(
     custom_username: str = Form(...),
     bio: str = Form(...),
     language: str = Form(...),
-    timezone: str = Form(...)
+    timezone: str = Form(...),
+    db=Depends(get_db)
 ):
     user_id = request.session.get("spotify_user_id")
     if not user_id:
         return RedirectResponse(url="/login", status_code=302)
 
-    db = await get_db_connection()
-
     stmt = (
         update(User)
         .where(User.user_id == user_id)
@@ -1459,7 +1402,6 @@ async def update_settings(
 
     await db.execute(stmt)
     await db.commit()
-    await db.close()
 
     return RedirectResponse(url="/profile", status_code=303)
 
@@ -1471,53 +1413,48 @@ from fastapi import APIRouter, Depends
 from fastapi.responses import JSONResponse
 
 @app.get("/get-more-history")
-async def get_more_history(page: int = 1, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def get_more_history(page: int = 1, db=Depends(get_read_db), user_data: dict = Depends(SpotifyHandler.get_current_user)):
 
     user_id = user_data["user_id"]  # Extract user_id if needed
 
-    limit = 20
-    offset = (page - 1) * limit
+    # Same page size as the dashboard's history panel, so page 2 starts where the panel stopped
+    limit = dashboard_panels.HISTORY_PAGE_SIZE
+    offset = (max(page, 1) - 1) * limit
 
-    grouped = await MusicDataService.complete_listening_history(user_id, db, limit, offset)
-    print(f"Fetched page {page} with {len(grouped)} records.")
-    return JSONResponse(content=grouped)
+    grouped = await MusicDataService(user_id, db).complete_listening_history(limit, offset)
+    return JSONResponse(content=jsonable_encoder(grouped))
 
 
 
 
 @app.get("/listening-history", response_class=HTMLResponse)
-async def show_listening_history(request: Request, db=Depends(get_db_connection), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+async def show_listening_history(request: Request, limit: Optional[int] = Query(None, ge=1), user_data: dict = Depends(SpotifyHandler.get_current_user)):
     user_id = user_data["user_id"]
-    limit = 20
-    offset = 0
+    period_of = time_period_classifier()
 
-    grouped_history = await MusicDataService.complete_listening_history(user_id, db, limit, offset)
+    # The whole history is streamed: rows come off a server-side cursor and are rendered and sent
+    # as they arrive, so the first byte does not wait for the last row (see app/streaming.py)
+    async def history():
+        async for row in stream_rows(user_id, queries.LISTENING_HISTORY_STREAM, {"user_id": user_id, "limit": limit}):
+            yield {**row, "period": period_of(row["played_at"])}
 
-    return templates.TemplateResponse("dashboard.html", {
+    return stream_template(templates, "listening_history.html", {
         "request": request,
-        "records_by_time": grouped_history  # 👈 match the name used in HTML
+        "user_id": user_id,
+        "user_name": user_data.get("display_name"),
+        "user_image": user_data.get("image_url"),
+        "current_path": request.url.path,
+        "history": history()
     })
 
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
 @app.get("/upload", response_class=HTMLResponse)
 async def upload_page(request: Request):
     return templates.TemplateResponse("upload.html", {"request": request})
 
 @app.post("/upload")
-async def upload_file(request: Request, file: UploadFile = File(...)):
-    db = await get_db_connection()
-    access_token = request.session.get("spotify_token")
-    client_data = SpotifyClient(access_token)
-    user_profile = await client_data.get_spotify_user_profile()
-    spotify_user = SpotifyUser(access_token)
-    user_data = await spotify_user.store_user_info_to_database(user_profile, db)
-    user_id = user_data["id"]
-
-
+async def upload_file(request: Request, file: UploadFile = File(...), user_data: dict = Depends(SpotifyHandler.get_current_user)):
+    user_id = user_data["user_id"]
 
     if not file.filename.endswith(".zip"):
         return {"error": "Please upload a ZIP file"}
@@ -1530,48 +1467,22 @@ async def upload_file(request: Request, file: UploadFile = File(...)):
         if not json_files:
             return {"error": "No JSON files found in ZIP"}
 
-        records = []
-
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                for json_file in json_files:
-                    with zip_ref.open(json_file) as f:
-                        data = json.load(f)
-                        print("Starting to process data")
-                        for entry in data:
-                            if not entry.get("master_metadata_track_name"):
-                                continue  # Skip entries without track info
-
-                            # For now, skip fetching artist/album data and store track info
-                            track_id = entry.get("spotify_track_uri")
-                            records.append(
-                                (
-                                    user_id,
-                                    track_id,
-                                    entry.get("master_metadata_track_name"),
-                                    None,  # No artist_id for now
-                                    entry.get("master_metadata_album_artist_name"),
-                                    entry.get("master_metadata_album_album_name"),
-                                    None,  # No album_image_url for now
-                                    entry.get("ts"),
-                                    entry.get("ms_played")
-                                )
-                            )
-
-                # Insert into database without artist_id and album_image_url
-                cursor.executemany(
-                    """
-                    INSERT INTO listening_history (
-                        user_id, track_id, track_name, artist_id, artist_name,
-                        album_name, album_image_url, played_at, duration_ms
-                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (user_id, played_at) DO NOTHING;
-                    """,
-                    records
-                )
-                print("Inserted records into database: ", len(records))
-                conn.commit()
-
-    return {"message": f"Inserted {len(records)} records into database"}
+        entries = []
+        for json_file in json_files:
+            with zip_ref.open(json_file) as f:
+                data = json.load(f)
+                if isinstance(data, list):
+                    entries.extend(data)
+
+    logging.info(f"[Upload] Processing {len(entries)} entries from {len(json_files)} files for {user_id}")
+    async with SpotifyDataSaver(user_data["token"], user_id) as saver:
+        inserted, new_track_ids = await saver.streaming_history_to_database(entries)
+    mark_primary_write(user_id)
+    # The new tracks' details come from Spotify in the sync worker, not in this request
+    sync_service.request_track_details(user_id, new_track_ids)
+    sync_service.request_sync(user_id, priority=PRIORITY_ACTIVE)
+    logging.info(f"[Upload] Inserted {inserted} plays for {user_id}")
+
+    return {"message": f"Inserted {inserted} new plays into database"}
     
 
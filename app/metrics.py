@@ -0,0 +1,295 @@
+import asyncio, bisect, functools, logging, os, time
+
+from app.instrumentation import UNMATCHED
+
+
+# Serve /metrics at all (it exposes route names and cache sizes, so it can be turned off)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() in ("1", "true", "yes")
+
+# Bucket upper bounds in seconds; +Inf is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RETRY_AFTER_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300)
+JOB_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label combination."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _labels(self.label_names, labels), value
+
+    def clear(self):
+        self._values.clear()
+
+
+class Histogram:
+    """Bucketed observations per label combination (cumulative buckets are built at scrape time)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels):
+        """Context manager observing the duration of its block."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.label_names, labels, f'le="{_number(bound)}"'), cumulative
+            yield f"{self.name}_count", _labels(self.label_names, labels), cumulative
+            yield f"{self.name}_sum", _labels(self.label_names, labels), series[-1]
+
+    def clear(self):
+        self._values.clear()
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started")
+
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Gauge:
+    """Value read when /metrics is scraped; `collect` returns {label values tuple: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect=None, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.collect = collect
+        self.kind = kind  # "counter" for totals some other module already keeps
+
+    def samples(self):
+        try:
+            values = self.collect()
+        except Exception as e:
+            logging.warning(f"[metrics] collecting {self.name} failed: {e}")
+            return
+        for labels, value in values.items():
+            if value is not None:
+                yield self.name, _labels(self.label_names, labels), value
+
+    def clear(self):
+        pass
+
+
+_registry: dict[str, Counter | Histogram | Gauge] = {}
+
+
+def register(metric):
+    _registry[metric.name] = metric
+    return metric
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in _registry.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics():
+    for metric in _registry.values():
+        metric.clear()
+
+
+# Requests, by route template (not the concrete path) so ids do not become label values
+http_request_duration = register(Histogram(
+    "http_request_duration_seconds", "Time to serve a request, until the response has been sent.",
+    ("method", "route", "status"),
+))
+# Spotify Web API calls, one observation per HTTP attempt (retries are separate attempts)
+spotify_request_duration = register(Histogram(
+    "spotify_request_duration_seconds", "Spotify API round trip per attempt, by SpotifyClient method.",
+    ("method", "status"),
+))
+spotify_rate_limited = register(Counter(
+    "spotify_rate_limited_total", "429 responses from Spotify, by SpotifyClient method.", ("method",),
+))
+spotify_retry_after = register(Histogram(
+    "spotify_retry_after_seconds", "Retry-After waits Spotify asked for on 429 responses.", ("method",),
+    buckets=RETRY_AFTER_BUCKETS,
+))
+# Ingest: rate(ingest_rows_total[5m]) is rows per second
+ingest_rows = register(Counter(
+    "ingest_rows_total", "Listening history rows sent to the database, by source.", ("source",),
+))
+ingest_duration = register(Histogram(
+    "ingest_duration_seconds", "Time to write one batch of listening history, by source.", ("source",),
+    buckets=JOB_BUCKETS,
+))
+# Background work: APScheduler jobs, token refresh batches and per-user syncs
+job_duration = register(Histogram(
+    "job_duration_seconds", "Duration of background jobs.", ("job", "outcome"), buckets=JOB_BUCKETS,
+))
+
+
+class MetricsMiddleware:
+    """Observes http_request_duration_seconds for every HTTP request (plain ASGI, like the query middleware)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500  # an unhandled error is answered with a 500 outside this middleware
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            http_request_duration.observe(
+                time.perf_counter() - started,
+                scope["method"], getattr(route, "path", UNMATCHED) if route is not None else UNMATCHED, status,
+            )
+
+
+def timed_job(name: str, func):
+    """Wrap a scheduler job (sync or async) so its runs land in job_duration_seconds."""
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def run_async(*args, **kwargs):
+            started, outcome = time.perf_counter(), "error"
+            try:
+                result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                job_duration.observe(time.perf_counter() - started, name, outcome)
+        return run_async
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        started, outcome = time.perf_counter(), "error"
+        try:
+            result = func(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            job_duration.observe(time.perf_counter() - started, name, outcome)
+    return run
+
+
+def register_collectors():
+    """Gauges read from the state other modules already keep, so the hot paths pay nothing extra."""
+    from app.cache import auth_context_cache
+    from app.catalog_batcher import get_batcher_stats
+    from app.circuit_breaker import get_breaker_states
+    from app.database import REPLICA_CONFIGURED, engine, get_pool_stats, replica_engine
+    from app.spotify_api import response_cache
+    from app.sync_service import sync_service
+    from app.token_scheduler import token_scheduler
+
+    def pools() -> dict[str, dict]:
+        stats = {"primary": get_pool_stats(engine)}
+        if REPLICA_CONFIGURED:
+            stats["replica"] = get_pool_stats(replica_engine)
+        return stats
+
+    def pool_value(key: str, scale: float = 1):
+        return lambda: {(name,): stats[key] * scale for name, stats in pools().items()}
+
+    register(Gauge("db_pool_size", "Configured pool size.", ("pool",), pool_value("pool_size")))
+    register(Gauge("db_pool_checked_out", "Connections currently in use.", ("pool",), pool_value("checked_out")))
+    register(Gauge("db_pool_overflow", "Connections open beyond pool_size.", ("pool",), pool_value("overflow")))
+    register(Gauge("db_pool_checkouts_total", "Connection checkouts.", ("pool",), pool_value("checkouts"), kind="counter"))
+    register(Gauge("db_pool_checkout_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT.", ("pool",),
+                   pool_value("checkout_timeouts"), kind="counter"))
+    register(Gauge("db_pool_max_checkout_wait_seconds", "Longest wait for a free connection.", ("pool",),
+                   pool_value("max_checkout_wait_ms", 0.001)))
+
+    def caches() -> dict[str, tuple[int, int]]:
+        # (hits, misses); a 304 revalidation saved the download, so it counts as a hit
+        return {
+            "spotify_response": (response_cache.hits + response_cache.revalidated, response_cache.misses),
+            "auth_context": (auth_context_cache.hits, auth_context_cache.misses),
+        }
+
+    register(Gauge("cache_hits_total", "Cache lookups answered from the cache.", ("cache",),
+                   lambda: {(name,): hits for name, (hits, _) in caches().items()}, kind="counter"))
+    register(Gauge("cache_misses_total", "Cache lookups that had to fetch.", ("cache",),
+                   lambda: {(name,): misses for name, (_, misses) in caches().items()}, kind="counter"))
+    register(Gauge("cache_hit_ratio", "Hits / (hits + misses) since startup.", ("cache",),
+                   lambda: {(name,): hits / (hits + misses) if hits + misses else None
+                            for name, (hits, misses) in caches().items()}))
+    register(Gauge("spotify_cache_stale_served_total", "Stale responses served while Spotify was failing.", (),
+                   lambda: {(): response_cache.stale_served}, kind="counter"))
+    register(Gauge("spotify_cache_bytes", "Response bodies held in the Spotify response cache.", (),
+                   lambda: {(): response_cache.stats()["bytes"]}))
+
+    register(Gauge("catalog_batcher_requests_total", "Spotify catalog requests made by each batcher.", ("batcher",),
+                   lambda: {(name,): stats["api_requests"] for name, stats in get_batcher_stats().items()}, kind="counter"))
+    register(Gauge("circuit_breaker_open", "1 while the endpoint family's breaker is not closed.", ("family",),
+                   lambda: {(name,): int(state["state"] != "closed") for name, state in get_breaker_states().items()}))
+    register(Gauge("sync_queue_depth", "Users waiting for a background sync.", (), lambda: {(): sync_service.queue_depth()}))
+    register(Gauge("sync_in_flight", "Users being synced right now.", (), lambda: {(): sync_service.stats()["in_flight"]}))
+    register(Gauge("token_refresh_scheduled", "Tokens the refresh scheduler is tracking.", (), lambda: {(): len(token_scheduler)}))
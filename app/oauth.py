@@ -1,9 +1,13 @@
-import requests, os, time, httpx, aiohttp, base64
+import requests, os, time, httpx, base64, logging
 from urllib.parse import urlencode
 from dotenv import load_dotenv
-from app.database import get_db_connection
-from app.spotify_api import SpotifyClient
+from app.database import db_session, get_db, mark_primary_write
+from app.spotify_api import SPOTIFY_API_URL, TokenRevokedError, get_http_client
+from app.circuit_breaker import get_breaker
 from app.db import User
+from app.token_scheduler import token_scheduler
+from app.dependencies import get_current_user
+from app.cache import auth_context_cache
 
 from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi import Request, HTTPException, status, FastAPI, Depends
@@ -30,8 +34,9 @@ app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
 
 class OAuthSettings:
     def __init__(self):
-        self.SPOTIFY_AUTH_URL = "https://accounts.spotify.com/authorize"
-        self.SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+        # Overridable so logins and token refreshes can run against app/fake_spotify.py
+        self.SPOTIFY_AUTH_URL = os.getenv("SPOTIFY_AUTH_URL", "https://accounts.spotify.com/authorize")
+        self.SPOTIFY_TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
         self.SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
         self.SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "http://127.0.0.1:8000/callback")
         self.SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
@@ -80,8 +85,7 @@ class SpotifyOAuth:
             "client_secret": self.settings.SPOTIFY_CLIENT_SECRET
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, data=payload)
+        response = await get_http_client().post(url, headers=headers, data=payload)
         
         if response.status_code != 200:
             raise HTTPException(status_code=response.status_code, detail=f"Error fetching access token: {response.text}")
@@ -104,24 +108,27 @@ class SpotifyOAuth:
 
         # If token is expired, try refreshing it using the refresh token
         if refresh_token:
-            print("Token expired, attempting to refresh...")
+            logging.debug("[OAuth] Session token expired, attempting to refresh")
             new_token_data = self.refresh_access_token(refresh_token)
-            print("New token data:", new_token_data)
             if new_token_data:
                 new_token = new_token_data.get("access_token")
                 expires_in = new_token_data.get("expires_in", 3600)  # Default to 3600 seconds if not provided
                 request.session["spotify_token"] = new_token
                 request.session["token_expires"] = time.time() + expires_in
-                print("Token refreshed successfully.")
+                logging.debug("[OAuth] Session token refreshed")
                 return new_token
 
-        print("No valid token available.")
+        logging.debug("[OAuth] No valid token in session")
         return None
 
 
-    async def refresh_access_token(self, refresh_token: str) -> dict:
-        print("Starting to refresh access token...")
-        url = "https://accounts.spotify.com/api/token"
+    async def refresh_access_token(self, refresh_token: str, persist: bool = True) -> dict:
+        """Exchange a refresh token for a new access token.
+
+        With persist=False a rotated refresh token is only returned, not written;
+        the batch refresher stores every result in one UPDATE instead.
+        """
+        url = self.settings.SPOTIFY_TOKEN_URL
         headers = {
             "Authorization": f"Basic {self.settings.client_credentials_b64}",
             "Content-Type": "application/x-www-form-urlencoded"
@@ -130,28 +137,37 @@ class SpotifyOAuth:
             "grant_type": "refresh_token",
             "refresh_token": refresh_token
         }
-        print("got data from API")
-        async with aiohttp.ClientSession() as session:
-            print("started async session")
-            async with session.post(url, headers=headers, data=data) as response:
-                print("got response from API:", response.status)
-                if response.status != 200:
-                    raise Exception(f"Failed to refresh token: {await response.text()}")
-                token_data = await response.json()
-                
-                # ✅ If a new refresh_token is provided by Spotify
-                if "refresh_token" in token_data:
-                    new_refresh_token = token_data["refresh_token"]
-                    print("New refresh token received:", new_refresh_token)
-                    await self.update_refresh_token_in_db(old_refresh_token=refresh_token, new_refresh_token=new_refresh_token)
-
-                # Always recalculate expires_at
-                token_data["expires_at"] = int(time.time()) + token_data["expires_in"]
-                return token_data
+        # During an accounts outage, fail fast; the scheduler retries these users later
+        breaker = get_breaker("token")
+        if not breaker.allow():
+            raise Exception("Spotify token endpoint unavailable (circuit open)")
+        try:
+            response = await get_http_client().post(url, headers=headers, data=data)
+        except httpx.TransportError:
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if response.status_code == 400 and "invalid_grant" in response.text:
+            # Revoked or expired refresh token; retrying will never succeed
+            raise TokenRevokedError(f"Refresh token rejected ({response.status_code}): {response.text}")
+        if response.status_code != 200:
+            raise Exception(f"Failed to refresh token ({response.status_code}): {response.text}")
+        token_data = response.json()
+
+        # ✅ If a new refresh_token is provided by Spotify
+        if persist and "refresh_token" in token_data:
+            await self.update_refresh_token_in_db(old_refresh_token=refresh_token, new_refresh_token=token_data["refresh_token"])
+
+        # Always recalculate expires_at
+        token_data["expires_at"] = int(time.time()) + token_data["expires_in"]
+        return token_data
 
     async def update_refresh_token_in_db(self, old_refresh_token: str, new_refresh_token: str):
-        print(f"Updating refresh token in DB: {old_refresh_token} -> {new_refresh_token}")
-        async with get_db_connection() as session:
+        logging.info("[OAuth] Spotify rotated a refresh token; updating the stored one")
+        async with db_session() as session:
             result = await session.execute(
                 select(User).where(User.refresh_token == old_refresh_token)
             )
@@ -170,13 +186,10 @@ class SpotifyUser:
 
     async def get_user_profile(self) -> dict:
         headers = {"Authorization": f"Bearer {self.access_token}"}
-        async with httpx.AsyncClient() as client:
-            response = await client.get("https://api.spotify.com/v1/me", headers=headers)
-
-        print(f"Spotify response status: {response.status_code}")
-        print(f"Spotify response body: {response.text}")  # 🧠 THIS will help us see the real issue
+        response = await get_http_client().get(f"{SPOTIFY_API_URL}/me", headers=headers)
 
         if response.status_code != 200:
+            logging.warning(f"[OAuth] Profile fetch failed with {response.status_code}: {response.text[:500]}")
             raise HTTPException(
                 status_code=response.status_code,
                 detail=f"Failed to fetch user data from Spotify: {response.text}"
@@ -185,7 +198,6 @@ class SpotifyUser:
         return response.json()
 
     async def store_user_info_to_database(self, user_profile: dict, db) -> Optional[dict]:
-        print("Storing user info to database...")   
         if isinstance(user_profile, dict):
             # Extract user profile details
             user_id = user_profile.get("id")
@@ -193,7 +205,7 @@ class SpotifyUser:
             profile_url = user_profile.get("external_urls", {}).get("spotify")
             images = user_profile.get("images", [])
             image_url = images[0].get("url") if images else None
-            print("User profile response from Spotify:", user_profile)
+            logging.debug(f"[OAuth] Storing profile of user {user_id}")
             username = user_profile.get("display_name")
             email = user_profile.get("email", "unknown_email@example.com")
             country = user_profile.get("country")
@@ -253,7 +265,7 @@ class SpotifyUser:
             await db.commit()
             return user_profile
         else:
-            print("No user data to insert.")
+            logging.warning("[OAuth] No user profile to store")
             return None
 
 
@@ -293,8 +305,11 @@ class SpotifyHandler:
         user_profile = await user.get_user_profile()
 
         # Store user info in database
-        db = await get_db_connection()
-        await user.store_user_info_to_database(user_profile, db)
+        async with db_session() as db:
+            await user.store_user_info_to_database(user_profile, db)
+        mark_primary_write(user_profile.get("id"))
+        auth_context_cache.pop(user_profile.get("id"))
+        token_scheduler.schedule(user_profile.get("id"), time.time() + (expires_in or 3600))
 
         return {
             "access_token": access_token,
@@ -304,45 +319,6 @@ class SpotifyHandler:
         }
 
     @staticmethod
-    async def get_current_user(request: Request) -> dict | RedirectResponse | JSONResponse:
-        token = request.session.get("spotify_token")
-        user_id = request.session.get("user_id")
-
-        if not token or not user_id:
-            return RedirectResponse(url="/login")
-
-        db = await get_db_connection()
-
-        # Retrieve access_token from DB
-        stmt = select(User.access_token).where(User.user_id == user_id)
-        result = await db.execute(stmt)
-        access_token = result.scalar_one_or_none()
-
-        if not access_token:
-            return JSONResponse(content={"error": "User not found in DB."}, status_code=404)
-
-        # Optional: Update session with DB value (overwriting old token if needed)
-        request.session["spotify_token"] = access_token
-
-        # Use the token to get Spotify profile
-        client = SpotifyClient(access_token)
-        user_profile = await client.get_spotify_user_profile()
-
-        if not user_profile:
-            return JSONResponse(
-                content={"error": "Failed to fetch user profile from Spotify."},
-                status_code=500
-            )
-
-        # Store or update user info in DB
-        user_instance = SpotifyUser(access_token)
-        user_data = await user_instance.store_user_info_to_database(user_profile, db)
-
-        new_user_id = user_data.get("id") if user_data else None
-        if new_user_id and new_user_id != user_id:
-            request.session["user_id"] = new_user_id
-
-        return {
-            "token": access_token,
-            "user_id": request.session["user_id"]
-        }
+    async def get_current_user(request: Request, db=Depends(get_db)) -> dict | RedirectResponse | JSONResponse:
+        # Kept for the routes that depend on it; see app.dependencies.get_current_user
+        return await get_current_user(request, db)
@@ -0,0 +1,90 @@
+import os, logging
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+from app.database import engine
+
+
+# listening_history is range-partitioned by played_at, one partition per calendar month.
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+PARENT_TABLE = "listening_history"
+
+# Months we already know have a partition, so ingest paths can skip the catalog lookup
+_known_months: set[date] = set()
+
+
+def month_start(value: date | datetime) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + (month.month - 1) + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def months_between(start: date | datetime, end: date | datetime) -> list[date]:
+    months = []
+    current, last = month_start(start), month_start(end)
+    while current <= last:
+        months.append(current)
+        current = add_months(current, 1)
+    return months
+
+
+def create_partition_sql(month: date) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {PARENT_TABLE} "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+async def ensure_partitions(start: date | datetime, end: date | datetime):
+    """Create the monthly partitions covering [start, end] that do not exist yet."""
+    missing = [m for m in months_between(start, end) if m not in _known_months]
+    if not missing:
+        return
+
+    async with engine.begin() as conn:
+        for month in missing:
+            await conn.execute(text(create_partition_sql(month)))
+
+    _known_months.update(missing)
+    logging.info(f"[partitions] ensured {len(missing)} listening_history partitions from {missing[0]} to {missing[-1]}")
+
+
+async def ensure_future_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Scheduler job: keep the current month and the next `months_ahead` months partitioned."""
+    current = month_start(datetime.utcnow())
+    await ensure_partitions(current, add_months(current, months_ahead))
+
+
+async def maintain_recent_partitions():
+    """Scheduler job: VACUUM ANALYZE only the partitions still receiving writes.
+
+    Older months are effectively read-only once the month is over, so there is
+    nothing for autovacuum or a manual VACUUM to do on them.
+    """
+    current = month_start(datetime.utcnow())
+    months = [add_months(current, -1), current]
+
+    # VACUUM cannot run inside a transaction block
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for month in months:
+            name = partition_name(month)
+            exists = await conn.scalar(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})
+            if exists:
+                await conn.execute(text(f"VACUUM (ANALYZE) {name}"))
+                logging.info(f"[partitions] vacuumed {name}")
+
+
+async def reindex_partition(month: date):
+    """Rebuild one partition's indexes without touching the rest of the table."""
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await conn.execute(text(f"REINDEX TABLE CONCURRENTLY {partition_name(month_start(month))}"))
@@ -0,0 +1,247 @@
+import asyncio, collections, logging, os, random, sys, threading, time
+
+from app.instrumentation import UNMATCHED
+
+
+# Opt-in: nothing is sampled unless PROFILE_ENABLED is set
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "").lower() in ("1", "true", "yes")
+# Fraction of requests whose profile is always kept
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+# Any request slower than this keeps its profile; 0 profiles only the PROFILE_SAMPLE_RATE share
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "1000"))
+# Time between stack samples while a profiled request is in flight
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Recent profiles kept per route, and distinct stacks kept in each route's aggregate
+PROFILE_MAX_PROFILES = int(os.getenv("PROFILE_MAX_PROFILES", "20"))
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "5000"))
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AWAITING = "[await]"  # leaf of a stack sampled while the request was suspended (SQL, Spotify, sleeps)
+TRUNCATED = "[other stacks]"
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if filename.startswith(APP_ROOT):
+        filename = os.path.relpath(filename, APP_ROOT)
+    else:
+        # site-packages/jinja2/runtime.py -> jinja2/runtime.py
+        filename = "/".join(filename.replace("\\", "/").split("/")[-2:])
+    # Semicolons separate frames in the collapsed format
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+def _running_stack(top_frame, root_frame) -> tuple | None:
+    """Frames above `root_frame` up to `top_frame`, or None when the root is not on this stack."""
+    frames = []
+    frame = top_frame
+    while frame is not None:
+        if frame is root_frame:
+            return tuple(_frame_label(f) for f in reversed(frames)) or (_frame_label(root_frame),)
+        frames.append(frame)
+        frame = frame.f_back
+    return None
+
+
+def _awaiting_stack(coro, root_frame) -> tuple | None:
+    """The chain of awaits a suspended task is parked on, from below `root_frame` down to what it waits for."""
+    labels = []
+    seen_root = False
+    depth = 0
+    while coro is not None and depth < 200:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            # A Future, or a coroutine that already finished
+            if seen_root:
+                labels.append(f"{type(coro).__name__} {AWAITING}")
+            break
+        if seen_root:
+            labels.append(_frame_label(frame))
+        seen_root = seen_root or frame is root_frame
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+        depth += 1
+    if not seen_root:
+        return None
+    if not labels or not labels[-1].endswith(AWAITING):
+        labels.append(AWAITING)
+    return tuple(labels)
+
+
+class RequestProfile:
+    """Stack samples of one request: what it was running, or what it was awaiting, at each tick."""
+
+    __slots__ = ("path", "thread_id", "root_frame", "coro", "keep", "started", "samples", "duration_ms")
+
+    def __init__(self, path: str, root_frame, coro, keep: bool):
+        self.path = path
+        self.thread_id = threading.get_ident()
+        self.root_frame = root_frame
+        self.coro = coro
+        self.keep = keep  # sampled share: kept whatever the latency
+        self.started = time.perf_counter()
+        self.samples: collections.Counter = collections.Counter()
+        self.duration_ms = 0.0
+
+
+class RouteProfiles:
+    """Everything kept for one route: merged stacks for a flamegraph, plus the latest profiles."""
+
+    def __init__(self):
+        self.stacks: collections.Counter = collections.Counter()
+        self.recent = collections.deque(maxlen=PROFILE_MAX_PROFILES)
+        self.requests = 0
+        self.samples = 0
+
+    def add(self, profile: RequestProfile):
+        self.requests += 1
+        for stack, count in profile.samples.items():
+            if stack not in self.stacks and len(self.stacks) >= PROFILE_MAX_STACKS:
+                stack = (TRUNCATED,)
+            self.stacks[stack] += count
+            self.samples += count
+        self.recent.append({
+            "path": profile.path,
+            "duration_ms": round(profile.duration_ms, 1),
+            "samples": sum(profile.samples.values()),
+            "at": time.time(),
+            "top_stacks": [[";".join(stack), count] for stack, count in profile.samples.most_common(5)],
+        })
+
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack every PROFILE_INTERVAL_MS while a profiled request is in flight.
+
+    Runs in one daemon thread per process and only wakes up while there is something
+    to profile. A sample whose stack includes the request's middleware frame is that
+    request's running code (Python loops, Jinja rendering). Otherwise the request is
+    parked on an await, and its await chain is recorded with an [await] leaf, so time
+    spent on SQL and Spotify calls shows up under the line that awaited them.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._active: dict[int, RequestProfile] = {}
+        self._routes: dict[str, RouteProfiles] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        self.ticks = 0
+
+    def start_request(self, path: str, root_frame, coro, keep: bool) -> RequestProfile:
+        profile = RequestProfile(path, root_frame, coro, keep)
+        with self._lock:
+            self._active[id(profile)] = profile
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+            self._thread.start()
+        self._wakeup.set()
+        return profile
+
+    def finish_request(self, profile: RequestProfile, route: str):
+        with self._lock:
+            self._active.pop(id(profile), None)
+        profile.duration_ms = (time.perf_counter() - profile.started) * 1000
+        if not profile.keep and not (PROFILE_SLOW_MS > 0 and profile.duration_ms >= PROFILE_SLOW_MS):
+            return
+        if not profile.samples:
+            return
+        with self._lock:
+            if route not in self._routes:
+                self._routes[route] = RouteProfiles()
+            self._routes[route].add(profile)
+        if not profile.keep:
+            logging.info(f"[Profiler] kept a {profile.duration_ms:.0f} ms profile of {profile.path} ({route})")
+
+    def _run(self):
+        while True:
+            if not self._active:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            time.sleep(self.interval)
+            try:
+                self._sample()
+            except Exception as e:
+                # A sample can race with the loop thread; skip it rather than stop profiling
+                logging.debug(f"[Profiler] sample failed: {e!r}")
+
+    def _sample(self):
+        # Under the lock so finish_request never reads a profile mid-update
+        with self._lock:
+            if not self._active:
+                return
+            self.ticks += 1
+            frames = sys._current_frames()
+            for profile in self._active.values():
+                stack = _running_stack(frames.get(profile.thread_id), profile.root_frame)
+                if stack is None:
+                    stack = _awaiting_stack(profile.coro, profile.root_frame)
+                if stack is not None:
+                    profile.samples[stack] += 1
+
+    def collapsed(self, route: str | None = None) -> str:
+        """Brendan Gregg's collapsed format ("frame;frame;frame count"), for flamegraph.pl or speedscope."""
+        with self._lock:
+            routes = {route: self._routes[route]} if route in self._routes else ({} if route else dict(self._routes))
+            lines = []
+            for name, profiles in routes.items():
+                for stack, count in profiles.stacks.items():
+                    # Without a route filter, each route becomes its own root
+                    lines.append(f"{';'.join(stack if route else (name,) + stack)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        with self._lock:
+            routes = {
+                name: {
+                    "profiled_requests": p.requests,
+                    "samples": p.samples,
+                    "sampled_ms": round(p.samples * self.interval * 1000, 1),
+                    "top_stacks": [[";".join(stack), count] for stack, count in p.stacks.most_common(10)],
+                    "recent": list(p.recent),
+                }
+                for name, p in sorted(self._routes.items(), key=lambda item: item[1].samples, reverse=True)
+            }
+        return {
+            "enabled": PROFILE_ENABLED,
+            "sample_rate": PROFILE_SAMPLE_RATE,
+            "slow_ms": PROFILE_SLOW_MS,
+            "interval_ms": self.interval * 1000,
+            "in_flight": len(self._active),
+            "ticks": self.ticks,
+            "routes": routes,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+# One profiler (and sampling thread) per worker process
+profiler = SamplingProfiler()
+
+
+class ProfilerMiddleware:
+    """Profiles PROFILE_SAMPLE_RATE of requests, and every request slower than PROFILE_SLOW_MS.
+
+    With PROFILE_SLOW_MS set every request is sampled, because slowness is only known
+    at the end; profiles of fast requests outside the sampled share are dropped.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        keep = random.random() < PROFILE_SAMPLE_RATE
+        if not PROFILE_ENABLED or scope["type"] != "http" or not (keep or PROFILE_SLOW_MS > 0):
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        profile = profiler.start_request(scope["path"], sys._getframe(), task.get_coro() if task else None, keep)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            profiler.finish_request(profile, getattr(route, "path", UNMATCHED) if route is not None else UNMATCHED)
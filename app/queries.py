@@ -0,0 +1,524 @@
+# queries.py
+# Hot queries, built once at import time instead of per call, so handlers skip
+# constructing the statement (and generating its cache key) on every request.
+# asyncpg keeps the prepared statements per connection (see
+# DB_PREPARED_STATEMENT_CACHE_SIZE in database.py), so a repeat execute is only
+# binding parameters and the round trip.
+from sqlalchemy import text, select, bindparam, func, cast, Integer
+
+from app.db import User, Track, Album, Artist, ListeningHistory
+
+
+# --- Dashboard: profile and top lists ---
+
+USER_INFO = text("SELECT * FROM users WHERE user_id = :user_id")
+
+USER_TOP_ARTISTS = text("""
+    SELECT a.name, a.image_url, a.spotify_url, uta.rank
+    FROM users_top_artists uta
+    JOIN artists a ON uta.artist_id = a.artist_id
+    WHERE uta.user_id = :user_id AND uta.time_range = :time_range
+    ORDER BY uta.rank ASC;
+""")
+
+USER_TOP_TRACKS = text("""
+    SELECT t.name, a.name AS artist_name, t.album_image_url, t.spotify_url, utt.rank
+    FROM users_top_tracks utt
+    JOIN tracks t ON utt.track_id = t.track_id
+    JOIN artists a ON t.artist_id = a.artist_id
+    WHERE utt.user_id = :user_id AND utt.time_range = :time_range
+    ORDER BY utt.rank ASC;
+""")
+
+
+# --- Dashboard: play counts and listening time ---
+
+TRACK_PLAY_COUNTS = text("""
+    SELECT t.name, t.artist_name, t.album_image_url, COUNT(*) AS track_play_counts
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    GROUP BY t.name, t.artist_name, t.album_image_url
+    ORDER BY track_play_counts DESC
+    LIMIT 10;
+""")
+
+DAILY_PLAY_COUNTS = text("""
+    SELECT DATE(lh.played_at) AS play_date, COUNT(*) AS daily_play_count
+    FROM listening_history lh
+    WHERE lh.user_id = :user_id
+    GROUP BY play_date
+    ORDER BY play_date DESC;
+""")
+
+PLAYS_IN_RANGE = text("""
+    SELECT COUNT(*) FROM listening_history
+    WHERE user_id = :user_id AND played_at >= :day_start AND played_at < :day_end;
+""")
+
+TOTAL_PLAY_COUNT = text("""
+    SELECT COUNT(*) FROM listening_history WHERE user_id = :user_id;
+""")
+
+TOTAL_LISTENING_TIME = text("""
+    SELECT SUM(t.duration_ms)
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id AND t.duration_ms IS NOT NULL;
+""")
+
+LISTENING_TIME_IN_RANGE = text("""
+    SELECT SUM(t.duration_ms)
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+      AND lh.played_at >= :day_start AND lh.played_at < :day_end
+      AND t.duration_ms IS NOT NULL;
+""")
+
+DAILY_LISTENING_TIME = text("""
+    SELECT DATE(lh.played_at) AS play_date,
+        SUM(t.duration_ms) / 60000 AS total_minutes
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id AND t.duration_ms IS NOT NULL
+    GROUP BY play_date
+    ORDER BY play_date DESC;
+""")
+
+LISTENING_HISTORY_PAGE = text("""
+    SELECT lh.played_at, t.name, t.artist_name, t.duration_ms
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    ORDER BY lh.played_at DESC
+    LIMIT :limit OFFSET :offset;
+""")
+
+# Whole history, newest first, read through a server-side cursor (app.streaming); LIMIT NULL is no limit
+LISTENING_HISTORY_STREAM = text("""
+    SELECT lh.played_at, t.name, t.artist_name, t.duration_ms
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    ORDER BY lh.played_at DESC
+    LIMIT :limit;
+""")
+
+USER_GENRE_ROWS = text("""
+    SELECT a.genres
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    JOIN artists a ON t.artist_id = a.artist_id
+    WHERE lh.user_id = :user_id;
+""")
+
+
+# --- Streaks ---
+
+DISTINCT_PLAY_DATES = text("""
+    SELECT DISTINCT DATE(played_at) AS play_date
+    FROM listening_history
+    WHERE user_id = :user_id
+    ORDER BY play_date DESC;
+""")
+
+DAILY_SONGS = text("""
+    SELECT DATE(lh.played_at) as play_date, t.name, t.artist_name
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    ORDER BY play_date
+""")
+
+SONG_STREAMS_ON_DATES = text("""
+    SELECT COUNT(*)
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    AND t.name = :song_name
+    AND t.artist_name = :artist_name
+    AND DATE(played_at) IN :streak_dates
+""").bindparams(bindparam("streak_dates", expanding=True))
+
+MOST_PLAYED_SONG = text("""
+    SELECT t.name, t.artist_name, COUNT(*) AS play_count
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    GROUP BY t.name, t.artist_name
+    ORDER BY play_count DESC
+    LIMIT 1;
+""")
+
+SONG_PLAY_DATES = text("""
+    SELECT DISTINCT DATE(played_at) AS play_date
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id AND t.name = :song_name AND t.artist_name = :artist_name
+    ORDER BY play_date DESC;
+""")
+
+
+# --- Averages, global and per-artist stats ---
+
+AVERAGE_POPULARITY = text("""
+    SELECT AVG(t.popularity) AS average_popularity
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id;
+""")
+
+AVERAGE_RELEASE_EPOCH = text("""
+    SELECT AVG(EXTRACT(EPOCH FROM t.album_release_date)) AS average_release_date
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id AND t.album_release_date IS NOT NULL;
+""")
+
+GLOBAL_TOP_ARTISTS = text("""
+    SELECT
+        a.artist_id,
+        a.name,
+        COUNT(*) AS total_streams
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    JOIN artists a ON t.artist_id = a.artist_id
+    GROUP BY a.artist_id, a.name
+    ORDER BY total_streams DESC
+    LIMIT :limit;
+""")
+
+GLOBAL_TOP_TRACKS = text("""
+    SELECT
+        t.track_id,
+        t.name,
+        COUNT(*) AS total_streams
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    GROUP BY t.track_id, t.name
+    ORDER BY total_streams DESC
+    LIMIT :limit;
+""")
+
+USER_ARTIST_STATS = text("""
+    SELECT
+        t.artist_id,
+        a.name AS artist_name,
+        COUNT(*) AS total_streams,
+        SUM(t.duration_ms) AS total_duration_ms,
+        COUNT(DISTINCT t.track_id) AS distinct_tracks_listened
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    JOIN artists a ON t.artist_id = a.artist_id
+    WHERE lh.user_id = :user_id
+    GROUP BY t.artist_id, a.name
+    ORDER BY total_streams DESC;
+""")
+
+USER_GENRE_STATS = text("""
+    SELECT
+        a.genres AS genre,
+        COUNT(*) AS total_streams
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    JOIN artists a ON t.artist_id = a.artist_id
+    WHERE lh.user_id = :user_id AND a.genres IS NOT NULL
+    GROUP BY a.genres
+    ORDER BY total_streams DESC;
+""")
+
+MONTHLY_STATS = text("""
+    SELECT
+        DATE_TRUNC('month', lh.played_at) AS month,
+        COUNT(*) AS total_songs_listened,
+        SUM(t.duration_ms) AS total_duration_ms
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+    GROUP BY month
+    ORDER BY month DESC;
+""")
+
+MONTH_STATS = text("""
+    SELECT
+        DATE_TRUNC('month', lh.played_at) AS month,
+        COUNT(*) AS total_songs_listened,
+        SUM(t.duration_ms) AS total_duration_ms
+    FROM listening_history lh
+    JOIN tracks t ON lh.track_id = t.track_id
+    WHERE lh.user_id = :user_id
+      AND lh.played_at >= :month_start AND lh.played_at < :month_end
+    GROUP BY month;
+""")
+
+FIRST_AND_LAST_LISTENED = text("""
+    WITH first_play AS (
+        SELECT lh.played_at, t.track_id, t.name AS track_name, t.album_image_url AS track_image, t.spotify_url AS track_url,
+            a.artist_id, a.name AS artist_name, a.image_url AS artist_image, a.spotify_url AS artist_url,
+            al.album_id, al.name AS album_name, al.image_url AS album_image, al.spotify_url AS album_url
+        FROM listening_history lh
+        JOIN tracks t ON lh.track_id = t.track_id
+        JOIN artists a ON t.artist_id = a.artist_id
+        JOIN albums al ON t.album_id = al.album_id
+        WHERE lh.user_id = :user_id
+        ORDER BY lh.played_at ASC
+        LIMIT 1
+    ),
+    last_play AS (
+        SELECT lh.played_at, t.track_id, t.name AS track_name, t.album_image_url AS track_image, t.spotify_url AS track_url,
+            a.artist_id, a.name AS artist_name, a.image_url AS artist_image, a.spotify_url AS artist_url,
+            al.album_id, al.name AS album_name, al.image_url AS album_image, al.spotify_url AS album_url
+        FROM listening_history lh
+        JOIN tracks t ON lh.track_id = t.track_id
+        JOIN artists a ON t.artist_id = a.artist_id
+        JOIN albums al ON t.album_id = al.album_id
+        WHERE lh.user_id = :user_id
+        ORDER BY lh.played_at DESC
+        LIMIT 1
+    )
+    SELECT
+        fp.played_at AS first_played,
+        fp.track_id AS first_track_id,
+        fp.track_name AS first_track_name,
+        fp.album_id AS first_album_id,
+        fp.album_name AS first_album_name,
+        fp.artist_id AS first_artist_id,
+        fp.artist_name AS first_artist_name,
+        fp.album_image AS first_album_image,
+        fp.album_url AS first_album_url,
+        fp.artist_image AS first_artist_image,
+        fp.artist_url AS first_artist_url,
+        fp.track_image AS first_track_image,
+        fp.track_url AS first_track_url,
+        (
+            SELECT COUNT(*) FROM listening_history
+            WHERE user_id = :user_id AND track_id = fp.track_id
+        ) AS first_track_play_count,
+
+        lp.played_at AS last_played,
+        lp.track_id AS last_track_id,
+        lp.track_name AS last_track_name,
+        lp.album_id AS last_album_id,
+        lp.album_name AS last_album_name,
+        lp.artist_id AS last_artist_id,
+        lp.artist_name AS last_artist_name,
+        lp.album_image AS last_album_image,
+        lp.album_url AS last_album_url,
+        lp.artist_image AS last_artist_image,
+        lp.artist_url AS last_artist_url,
+        lp.track_image AS last_track_image,
+        lp.track_url AS last_track_url,
+        (
+            SELECT COUNT(*) FROM listening_history
+            WHERE user_id = :user_id AND track_id = lp.track_id
+        ) AS last_track_play_count
+    FROM first_play fp, last_play lp;
+""")
+
+UNIQUE_LISTENING_COUNTS = text("""
+    SELECT
+        -- Unique tracks listened by user
+        (SELECT COUNT(DISTINCT lh.track_id)
+        FROM listening_history lh
+        WHERE lh.user_id = :user_id) AS unique_tracks,
+
+        -- Unique albums listened by user (via track -> album)
+        (SELECT COUNT(DISTINCT t.album_id)
+        FROM listening_history lh
+        JOIN tracks t ON lh.track_id = t.track_id
+        WHERE lh.user_id = :user_id) AS unique_albums,
+
+        -- Unique artists listened by user (via track -> artist)
+        (SELECT COUNT(DISTINCT t.artist_id)
+        FROM listening_history lh
+        JOIN tracks t ON lh.track_id = t.track_id
+        WHERE lh.user_id = :user_id) AS unique_artists,
+
+        -- Unique genres listened by user (UNNEST artist.genres from tracks they've listened to)
+        (SELECT COUNT(DISTINCT genre)
+        FROM (
+            SELECT UNNEST(a.genres) AS genre
+            FROM listening_history lh
+            JOIN tracks t ON lh.track_id = t.track_id
+            JOIN artists a ON t.artist_id = a.artist_id
+            WHERE lh.user_id = :user_id
+        ) subquery_genres
+        ) AS unique_genres;
+""")
+
+
+# --- Freshness checks (UserMusicUpdater) ---
+
+# Every (data_type, time_range) sync time for a user, in one primary key lookup
+USER_SYNC_STATE = text("""
+    SELECT data_type, time_range, last_synced_at, cursor
+    FROM user_sync_state
+    WHERE user_id = :user_id;
+""")
+
+LAST_SYNCED_AT = text("""
+    SELECT MAX(last_synced_at) FROM user_sync_state WHERE user_id = :user_id;
+""")
+
+# Written by SpotifyDataSaver in the same transaction as the data it describes.
+# GREATEST ignores NULLs, so a save without a cursor keeps the stored one.
+MARK_SYNCED = text("""
+    INSERT INTO user_sync_state (user_id, data_type, time_range, last_synced_at, cursor)
+    VALUES (:user_id, :data_type, :time_range, :last_synced_at, :cursor)
+    ON CONFLICT (user_id, data_type, time_range)
+    DO UPDATE SET last_synced_at = EXCLUDED.last_synced_at,
+                  cursor = GREATEST(EXCLUDED.cursor, user_sync_state.cursor);
+""")
+
+KNOWN_TRACK_IDS = text("""
+    SELECT track_id FROM tracks WHERE track_id = ANY(:ids);
+""")
+
+# Of `ids`, the tracks whose details Spotify has not filled in yet (upload stubs, failed batches)
+TRACKS_MISSING_DETAILS = text("""
+    SELECT track_id FROM tracks
+    WHERE track_id = ANY(:ids) AND (artist_name IS NULL OR artist_name = 'Unknown');
+""")
+
+KNOWN_ARTIST_IDS = text("""
+    SELECT artist_id FROM artists WHERE artist_id = ANY(:ids);
+""")
+
+# Profile fields only: the access token and its expiry belong to the token refresher
+UPDATE_USER_PROFILE = text("""
+    UPDATE users
+    SET display_name = :display_name,
+        profile_url = :profile_url,
+        image_url = :image_url,
+        email = COALESCE(:email, email),
+        country = :country,
+        product = :product,
+        followers = :followers,
+        external_urls = :external_urls,
+        href = :href,
+        uri = :uri,
+        last_updated = NOW()
+    WHERE user_id = :user_id;
+""")
+
+
+# --- Token refresh ---
+
+# Refresh tokens Spotify revoked: the rows drop out of the refresh index until the user logs in again
+CLEAR_REFRESH_TOKENS = text("""
+    UPDATE users SET refresh_token = NULL
+    WHERE user_id = ANY(CAST(:user_ids AS VARCHAR[]));
+""")
+
+# One UPDATE for a whole batch; refresh_token is only replaced when Spotify rotated it
+BULK_UPDATE_TOKENS = text("""
+    UPDATE users u
+    SET access_token = v.access_token,
+        refresh_token = COALESCE(v.refresh_token, u.refresh_token),
+        token_expires = v.token_expires
+    FROM unnest(
+        CAST(:user_ids AS VARCHAR[]),
+        CAST(:access_tokens AS VARCHAR[]),
+        CAST(:refresh_tokens AS VARCHAR[]),
+        CAST(:token_expires AS TIMESTAMPTZ[])
+    ) AS v(user_id, access_token, refresh_token, token_expires)
+    WHERE u.user_id = v.user_id;
+""")
+
+
+# --- Detail pages (LogicHandlers) ---
+
+USER_PROFILE = select(
+    User.user_id,
+    User.image_url,
+    User.display_name,
+    User.custom_username,
+    User.bio,
+    User.preferred_language,
+    User.timezone
+).where(User.user_id == bindparam("user_id"))
+
+TRACK_DETAILS = select(
+    Track.track_id,
+    Track.name,
+    Track.album_id,
+    Track.artist_id,
+    Track.artist_name,
+    Track.spotify_url,
+    Track.duration_ms,
+    Track.popularity,
+    Track.explicit,
+    Track.track_number,
+    Track.album_release_date,
+    Track.album_image_url,
+    Track.album_name
+).where(Track.track_id == bindparam("track_id"))
+
+ALBUM_DETAILS = (
+    select(
+        Album.album_id,
+        Album.name.label("album_name"),
+        Album.release_date,
+        Album.image_url,
+        Album.spotify_url,
+        Album.total_tracks,
+        Artist.artist_id,
+        Artist.name.label("artist_name")
+    )
+    .join(Artist, Album.artist_id == Artist.artist_id)
+    .where(Album.album_id == bindparam("album_id"))
+)
+
+ARTIST_DETAILS = (
+    select(
+        Artist.artist_id,
+        Artist.name.label("artist_name"),
+        Artist.image_url,
+        Artist.spotify_url,
+        Artist.popularity,
+        Artist.genres
+    )
+    .where(Artist.artist_id == bindparam("artist_id"))
+)
+
+STREAMS_BY_DAY = (
+    select(
+        func.to_char(ListeningHistory.played_at, 'Day').label('day_of_week'),
+        func.count(ListeningHistory.track_id).label('stream_count')
+    )
+    .where(ListeningHistory.user_id == bindparam("user_id"))
+    .group_by('day_of_week')
+    .order_by('day_of_week')
+)
+
+STREAMS_BY_MONTH = (
+    select(
+        func.to_char(ListeningHistory.played_at, 'Month').label("month"),
+        func.count(ListeningHistory.track_id).label("stream_count"),
+        cast(func.to_char(ListeningHistory.played_at, 'MM'), Integer).label("month_num")
+    )
+    .where(ListeningHistory.user_id == bindparam("user_id"))
+    .group_by("month", "month_num")
+    .order_by("month_num")
+)
+
+ON_THIS_DAY = (
+    select(
+        ListeningHistory.track_id,
+        Track.name.label("track_name"),
+        Track.artist_name,
+        Track.album_name,
+        Track.album_image_url,
+        Track.spotify_url,
+        func.date(ListeningHistory.played_at).label("listened_date")
+    )
+    .join(Track, ListeningHistory.track_id == Track.track_id)
+    .where(
+        # Plain range on played_at so only last year's month partition is scanned
+        ListeningHistory.played_at >= bindparam("day_start"),
+        ListeningHistory.played_at < bindparam("day_end"),
+        ListeningHistory.user_id == bindparam("user_id")
+    )
+    .distinct(ListeningHistory.track_id)  # Ensures unique songs
+)
@@ -0,0 +1,214 @@
+import logging, math, os
+from datetime import date, timedelta
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+
+from app import queries
+from app.cache import TTLCache
+from app.database import get_db, get_read_db
+from app.dependencies import load_auth_context
+from app.helpers import MusicDataService
+from app.instrumentation import query_budget
+from app.spotify_api import SpotifyClient
+
+
+# Seconds a rendered panel is reused in this process. Panel URLs carry the user's last sync
+# time (`v`), so a finished sync moves the dashboard to fresh URLs whatever these are.
+PANEL_CACHE_TTL = float(os.getenv("PANEL_CACHE_TTL", "300"))
+PANEL_MAX_AGE = int(os.getenv("PANEL_MAX_AGE", "300"))
+# Plays in the first history page; "More" fetches the next ones from /get-more-history
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+# Seconds a user's now playing answer from Spotify is reused; the dashboard polls every 30
+NOW_PLAYING_TTL = float(os.getenv("NOW_PLAYING_TTL", "20"))
+# Days listed under the heatmap (the heatmap itself always covers a year)
+DAILY_LIST_DAYS = 30
+HEATMAP_DAYS = 365
+
+TIME_RANGE = Query("medium_term", pattern="^(short_term|medium_term|long_term)$")
+
+templates = Jinja2Templates(directory="app/templates")
+
+# (user_id, panel, v, params...) -> rendered HTML
+panel_cache = TTLCache(PANEL_CACHE_TTL, max_entries=20000)
+# user_id -> get_now_playing() result
+now_playing_cache = TTLCache(NOW_PLAYING_TTL, max_entries=20000)
+
+router = APIRouter(prefix="/dashboard/panels", tags=["dashboard"])
+
+
+async def panel_user(request: Request, db=Depends(get_db)) -> str:
+    """The logged-in user; panels are fetched by script, so a missing session is a 401, not a redirect."""
+    user_id = request.session.get("user_id")
+    if not request.session.get("spotify_token") or not user_id:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    if await load_auth_context(user_id, db) is None:
+        raise HTTPException(status_code=401, detail="Unknown session user")
+    return user_id
+
+
+async def render_panel(user_id: str, panel: str, template: str, build, v: int, *params) -> HTMLResponse:
+    """Render `template` with the context `build()` returns, reusing the HTML for the same sync version.
+
+    v=0 (never synced) is rendered fresh every time: the first sync is still filling in the
+    data, and a cached empty panel would outlive it.
+    """
+    key = (user_id, panel, v) + params
+    html = panel_cache.get(key) if v else None
+    if html is None:
+        html = templates.get_template(template).render(await build())
+        if v:
+            panel_cache.set(key, html)
+    # Without a version the URL does not change after a sync, so the browser must not keep it
+    cache_control = f"private, max-age={PANEL_MAX_AGE}" if v else "no-cache"
+    return HTMLResponse(html, headers={"Cache-Control": cache_control, "Vary": "Cookie"})
+
+
+def heatmap_days(daily_play_count: list, today: date) -> list[dict]:
+    """One cell per day of the last year, starting on a Monday so the grid's rows are weekdays."""
+    plays = {row["play_date"]: row["daily_play_count"] for row in daily_play_count}
+    busiest = max(plays.values(), default=0)
+    first = today - timedelta(days=HEATMAP_DAYS - 1)
+    first -= timedelta(days=first.weekday())
+    days = []
+    for offset in range((today - first).days + 1):
+        day = first + timedelta(days=offset)
+        count = plays.get(day, 0)
+        days.append({"date": day, "plays": count, "level": math.ceil(4 * count / busiest) if count else 0})
+    return days
+
+
+@router.get("/summary")
+@query_budget(6)
+async def summary(v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        total_listened_minutes, total_listened_hours = await service.get_total_listening_time()
+        return {
+            "total_play_today": await service.get_total_play_today(),
+            "total_play_count": await service.get_total_play_count(),
+            "total_listened_minutes": total_listened_minutes,
+            "total_listened_hours": total_listened_hours,
+        }
+
+    return await render_panel(user_id, "summary", "partials/dashboard_summary.html", build, v)
+
+
+@router.get("/now-playing")
+@query_budget(2)
+async def now_playing(user_id: str = Depends(panel_user), db=Depends(get_db)):
+    # Asked of Spotify by whichever process serves the poll, at most once per NOW_PLAYING_TTL;
+    # the HTML itself is never cached, the shell polls this
+    playing_now_data = now_playing_cache.get(user_id)
+    if playing_now_data is None:
+        auth = await load_auth_context(user_id, db)
+        try:
+            playing_now_data = await SpotifyClient(auth["token"], user_id).get_now_playing() or {}
+        except Exception as e:
+            logging.warning(f"[Panels] now playing fetch failed for user {user_id}: {e}")
+            playing_now_data = {}
+        now_playing_cache.set(user_id, playing_now_data)
+    html = templates.get_template("partials/dashboard_now_playing.html").render({
+        "track_name": playing_now_data.get("track_name"),
+        "artist_name": playing_now_data.get("artists"),
+        "album_img": playing_now_data.get("album_image_url"),
+    })
+    return HTMLResponse(html, headers={"Cache-Control": "no-store"})
+
+
+@router.get("/tops")
+@query_budget(4)
+async def tops(time_range: str = TIME_RANGE, v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        return {
+            "top_artist_list": await service.get_top_artists_db(time_range),
+            "top_tracks_list": await service.get_top_tracks_db(time_range),
+        }
+
+    return await render_panel(user_id, "tops", "partials/dashboard_tops.html", build, v, time_range)
+
+
+@router.get("/track-list")
+@query_budget(3)
+async def track_list(time_range: str = TIME_RANGE, v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        return {"top_tracks_list": await service.get_top_tracks_db(time_range)}
+
+    return await render_panel(user_id, "track-list", "partials/dashboard_track_list.html", build, v, time_range)
+
+
+@router.get("/history")
+@query_budget(3)
+async def history(v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        # One row past the page tells whether "More" has anything to load
+        result = await db.execute(queries.LISTENING_HISTORY_PAGE, {"user_id": user_id, "limit": HISTORY_PAGE_SIZE + 1, "offset": 0})
+        rows = result.mappings().all()
+        return {
+            "records_by_time": service.group_by_time_period(rows[:HISTORY_PAGE_SIZE]),
+            "has_more": len(rows) > HISTORY_PAGE_SIZE,
+        }
+
+    return await render_panel(user_id, "history", "partials/dashboard_history.html", build, v)
+
+
+@router.get("/most-played")
+@query_budget(3)
+async def most_played(v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        return {"track_play_counts": await service.get_track_play_counts()}
+
+    return await render_panel(user_id, "most-played", "partials/dashboard_most_played.html", build, v)
+
+
+@router.get("/heatmap")
+@query_budget(4)
+async def heatmap(v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        daily_play_count = await service.get_daily_play_counts()
+        return {
+            "heatmap_days": heatmap_days(daily_play_count, date.today()),
+            "daily_play_count": daily_play_count[:DAILY_LIST_DAYS],
+            "total_play_count": await service.get_total_play_count(),
+        }
+
+    return await render_panel(user_id, "heatmap", "partials/dashboard_heatmap.html", build, v)
+
+
+@router.get("/listening-time")
+@query_budget(4)
+async def listening_time(v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        total_listened_minutes, total_listened_hours = await service.get_total_listening_time()
+        return {
+            "total_listened_minutes": total_listened_minutes,
+            "total_listened_hours": total_listened_hours,
+            "daily_listening_time": (await service.get_daily_listening_time())[:DAILY_LIST_DAYS],
+        }
+
+    return await render_panel(user_id, "listening-time", "partials/dashboard_listening_time.html", build, v)
+
+
+@router.get("/genres")
+@query_budget(3)
+async def genres(v: int = 0, user_id: str = Depends(panel_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def build():
+        return {"top_genres": await service.get_top_genres()}
+
+    return await render_panel(user_id, "genres", "partials/dashboard_genres.html", build, v)
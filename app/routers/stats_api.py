@@ -0,0 +1,239 @@
+import hashlib, json, os
+from datetime import date
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+from app import queries
+from app.cache import TTLCache
+from app.database import get_db, get_read_db
+from app.dependencies import load_auth_context
+from app.helpers import MusicDataService
+
+
+# Seconds a computed metric is reused in this process, and the max-age browsers may keep it for
+STATS_API_CACHE_TTL = float(os.getenv("STATS_API_CACHE_TTL", "60"))
+STATS_API_MAX_AGE = int(os.getenv("STATS_API_MAX_AGE", "60"))
+MAX_PAGE_SIZE = 500
+
+# Profile columns the API returns; the users row also holds tokens, which never leave the server
+PROFILE_FIELDS = ("user_id", "display_name", "custom_username", "image_url", "profile_url", "country",
+                  "product", "followers", "bio", "last_updated")
+# The part of the profile other users see, as on /users/{user_id}
+PUBLIC_PROFILE_FIELDS = ("user_id", "display_name", "custom_username", "image_url", "bio")
+
+TIME_RANGE = Query("medium_term", pattern="^(short_term|medium_term|long_term)$")
+
+# (user_id, metric, params) -> full (unpaginated) metric, so paging through a list is one query
+stats_cache = TTLCache(STATS_API_CACHE_TTL, max_entries=20000)
+_MISSING = object()  # metrics may legitimately be None (no streak yet)
+
+router = APIRouter(prefix="/api/v1/users/{user_id}/stats", tags=["stats"])
+
+
+async def stats_user(user_id: str, request: Request, db=Depends(get_db)) -> str:
+    """The user whose stats are read: `me` is the logged-in user; any signed-in user may read others' aggregates (as on /compare)."""
+    session_user = request.session.get("user_id")
+    if not request.session.get("spotify_token") or not session_user:
+        raise HTTPException(status_code=401, detail="Not logged in")
+    if await load_auth_context(session_user, db) is None:
+        raise HTTPException(status_code=401, detail="Unknown session user")
+    return session_user if user_id == "me" else user_id
+
+
+async def own_stats_user(request: Request, user_id: str = Depends(stats_user)) -> str:
+    """Like stats_user, but only the logged-in user's own: for data that is not shown to others."""
+    if user_id != request.session.get("user_id"):
+        raise HTTPException(status_code=403, detail="Only available for your own account")
+    return user_id
+
+
+def json_response(request: Request, payload: dict) -> Response:
+    """JSON with an ETag over the body; a matching If-None-Match gets an empty 304."""
+    body = json.dumps(jsonable_encoder(payload), separators=(",", ":")).encode("utf-8")
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"private, max-age={STATS_API_MAX_AGE}",
+        "Vary": "Cookie",
+    }
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def cached_metric(user_id: str, metric: str, compute, *params):
+    key = (user_id, metric) + params
+    value = stats_cache.get(key, _MISSING)
+    if value is _MISSING:
+        value = await compute()
+        stats_cache.set(key, value)
+    return value
+
+
+def envelope(user_id: str, metric: str, data, **extra) -> dict:
+    return {"user_id": user_id, "metric": metric, "data": data, **extra}
+
+
+def paginate(user_id: str, metric: str, rows: list, limit: int, offset: int) -> dict:
+    page = rows[offset:offset + limit]
+    next_offset = offset + limit if offset + limit < len(rows) else None
+    return envelope(user_id, metric, page, pagination={
+        "limit": limit, "offset": offset, "total": len(rows), "next_offset": next_offset,
+    })
+
+
+@router.get("/profile")
+async def profile(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    info = await MusicDataService(user_id, db).get_user_info()
+    if info is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    fields = PROFILE_FIELDS if user_id == request.session.get("user_id") else PUBLIC_PROFILE_FIELDS
+    return json_response(request, envelope(user_id, "profile", {field: info.get(field) for field in fields}))
+
+
+@router.get("/totals")
+async def totals(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def compute():
+        minutes, hours = await service.get_total_listening_time()
+        minutes_today, hours_today = await service.get_total_listening_time_today()
+        return {
+            "total_plays": await service.get_total_play_count(),
+            "plays_today": await service.get_total_play_today(),
+            "total_minutes": minutes,
+            "total_hours": hours,
+            "minutes_today": minutes_today,
+            "hours_today": hours_today,
+        }
+
+    return json_response(request, envelope(user_id, "totals", await cached_metric(user_id, "totals", compute)))
+
+
+@router.get("/top-artists")
+async def top_artists(request: Request, time_range: str = TIME_RANGE, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "top-artists", lambda: MusicDataService(user_id, db).get_top_artists_db(time_range), time_range)
+    return json_response(request, envelope(user_id, "top-artists", rows, time_range=time_range))
+
+
+@router.get("/top-tracks")
+async def top_tracks(request: Request, time_range: str = TIME_RANGE, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "top-tracks", lambda: MusicDataService(user_id, db).get_top_tracks_db(time_range), time_range)
+    return json_response(request, envelope(user_id, "top-tracks", rows, time_range=time_range))
+
+
+@router.get("/most-played")
+async def most_played(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "most-played", MusicDataService(user_id, db).get_track_play_counts)
+    return json_response(request, envelope(user_id, "most-played", rows))
+
+
+@router.get("/top-genres")
+async def top_genres(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    genres = await cached_metric(user_id, "top-genres", MusicDataService(user_id, db).get_top_genres)
+    return json_response(request, envelope(user_id, "top-genres", [{"genre": g, "plays": n} for g, n in genres]))
+
+
+@router.get("/daily-plays")
+async def daily_plays(request: Request, limit: int = Query(90, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                      user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "daily-plays", MusicDataService(user_id, db).get_daily_play_counts)
+    return json_response(request, paginate(user_id, "daily-plays", rows, limit, offset))
+
+
+@router.get("/daily-listening-time")
+async def daily_listening_time(request: Request, limit: int = Query(90, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                               user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "daily-listening-time", MusicDataService(user_id, db).get_daily_listening_time)
+    return json_response(request, paginate(user_id, "daily-listening-time", rows, limit, offset))
+
+
+@router.get("/history")
+async def history(request: Request, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                  grouped: bool = False, user_id: str = Depends(own_stats_user), db=Depends(get_read_db)):
+    # Timestamped plays are private to their owner. Not cached: new plays arrive with every sync, and the page query is an index range scan
+    service = MusicDataService(user_id, db)
+    result = await db.execute(queries.LISTENING_HISTORY_PAGE, {"user_id": user_id, "limit": limit + 1, "offset": offset})
+    rows = [dict(row) for row in result.mappings().all()]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    data = service.group_by_time_period(rows) if grouped else rows
+    return json_response(request, envelope(user_id, "history", data, pagination={
+        "limit": limit, "offset": offset, "next_offset": offset + limit if has_more else None,
+    }))
+
+
+@router.get("/streaks")
+async def streaks(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def compute():
+        return {
+            "consecutive_days": await service.get_consecutive_days_listened(),
+            "one_song_streak": await service.get_most_listened_song_streak(),
+            "song_played_daily": await service.get_streak_of_song_played_inbetween(),
+        }
+
+    return json_response(request, envelope(user_id, "streaks", await cached_metric(user_id, "streaks", compute)))
+
+
+@router.get("/averages")
+async def averages(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+
+    async def compute():
+        return {
+            "popularity": await service.get_average_popularity(),
+            "album_release_date": await service.get_average_release_date(),
+        }
+
+    return json_response(request, envelope(user_id, "averages", await cached_metric(user_id, "averages", compute)))
+
+
+@router.get("/artists")
+async def artists(request: Request, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                  user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "artists", lambda: MusicDataService(user_id, db).get_user_artist_stats(user_id))
+    return json_response(request, paginate(user_id, "artists", rows, limit, offset))
+
+
+@router.get("/genres")
+async def genres(request: Request, limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                 user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    rows = await cached_metric(user_id, "genres", lambda: MusicDataService(user_id, db).get_user_genre_stats(user_id))
+    return json_response(request, paginate(user_id, "genres", rows, limit, offset))
+
+
+@router.get("/monthly")
+async def monthly(request: Request, month: str | None = Query(None, pattern=r"^[1-9]\d{3}-(0[1-9]|1[0-2])$"),
+                  limit: int = Query(24, ge=1, le=MAX_PAGE_SIZE), offset: int = Query(0, ge=0),
+                  user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    service = MusicDataService(user_id, db)
+    if month:
+        # One month only reads that month's partition
+        first_day = date(int(month[:4]), int(month[5:]), 1)
+        rows = await cached_metric(user_id, "monthly", lambda: service.get_monthly_stats(user_id, first_day), month)
+    else:
+        rows = await cached_metric(user_id, "monthly", lambda: service.get_monthly_stats(user_id))
+    return json_response(request, paginate(user_id, "monthly", rows, limit, offset))
+
+
+@router.get("/first-last")
+async def first_last(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    row = await cached_metric(user_id, "first-last", MusicDataService(user_id, db).get_first_and_last_listened)
+    return json_response(request, envelope(user_id, "first-last", row))
+
+
+@router.get("/unique-counts")
+async def unique_counts(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    row = await cached_metric(user_id, "unique-counts", MusicDataService(user_id, db).get_unique_listening_counts)
+    return json_response(request, envelope(user_id, "unique-counts", row))
+
+
+@router.get("/last-synced")
+async def last_synced(request: Request, user_id: str = Depends(stats_user), db=Depends(get_read_db)):
+    # Not cached: the dashboard polls this to know when a sync has landed
+    value = await MusicDataService(user_id, db).get_last_synced()
+    return json_response(request, envelope(user_id, "last-synced", value))
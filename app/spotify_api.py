@@ -1,41 +1,268 @@
-import asyncio, httpx
+import asyncio, hashlib, httpx, logging, os, time
+from collections import OrderedDict
 from fastapi import HTTPException
 from typing import List
+from urllib.parse import urlsplit
 
+from app.circuit_breaker import BREAKER_OPEN_SECONDS, get_breaker
+from app.metrics import spotify_rate_limited, spotify_request_duration, spotify_retry_after
 
-SPOTIFY_API_URL = "https://api.spotify.com/v1"
+
+# Overridable so the app can run against a local fake (app/fake_spotify.py)
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com/v1").rstrip("/")
+
+# One pooled client per process, so API calls reuse TLS connections instead of
+# opening a new one per request
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15"))
+
+_http_client: httpx.AsyncClient | None = None
+
+
+class TokenRevokedError(Exception):
+    """Spotify rejected a refresh token for good (400 invalid_grant): the user has to log in again."""
+
+
+# Send every Spotify request to app/fake_spotify.py in-process instead of over the network
+SPOTIFY_FAKE_IN_PROCESS = os.getenv("SPOTIFY_FAKE_IN_PROCESS", "").lower() in ("1", "true", "yes")
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        transport = None
+        if SPOTIFY_FAKE_IN_PROCESS:
+            from app.fake_spotify import asgi_transport
+            transport = asgi_transport()
+        _http_client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS // 2),
+            transport=transport,
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# Response cache for GETs. Within its TTL an entry is served without a request;
+# after that it is revalidated with If-None-Match / If-Modified-Since, and a 304
+# reuses the already-decoded JSON. Entries are evicted least recently used once
+# SPOTIFY_CACHE_MAX_BYTES of response bodies are stored.
+SPOTIFY_CACHE_MAX_BYTES = int(os.getenv("SPOTIFY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# (path prefix, seconds an entry is fresh). First match wins; unlisted paths are not cached.
+CACHE_TTLS = (
+    ("/me/player", None),  # now playing and recently played change constantly
+    ("/me/top/", int(os.getenv("SPOTIFY_CACHE_TTL_TOP", "3600"))),
+    ("/me", int(os.getenv("SPOTIFY_CACHE_TTL_PROFILE", "300"))),
+    ("/tracks", int(os.getenv("SPOTIFY_CACHE_TTL_CATALOG", "86400"))),
+    ("/artists", int(os.getenv("SPOTIFY_CACHE_TTL_CATALOG", "86400"))),
+    ("/albums", int(os.getenv("SPOTIFY_CACHE_TTL_CATALOG", "86400"))),
+)
+# Catalog objects are the same for every user, so they share one cache scope
+CATALOG_PREFIXES = ("/tracks", "/artists", "/albums")
+
+
+class CachedResponse:
+    __slots__ = ("data", "etag", "last_modified", "size", "stored_at")
+
+    def __init__(self, data, etag, last_modified, size):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.stored_at = time.monotonic()
+
+
+class ResponseCache:
+    """Byte-bounded LRU of decoded Spotify responses keyed by (scope, url)."""
+
+    def __init__(self, max_bytes: int = SPOTIFY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: OrderedDict[tuple[str, str], CachedResponse] = OrderedDict()
+        self.hits = 0  # served without a request
+        self.revalidated = 0  # 304 Not Modified
+        self.misses = 0
+        self.bytes_saved = 0  # response bodies not downloaded thanks to hits and 304s
+        self.stale_served = 0  # expired entries returned while Spotify was failing
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry: CachedResponse):
+        if entry.size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.total_bytes -= old.size
+        self._entries[key] = entry
+        self.total_bytes += entry.size
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+
+    def clear(self):
+        self._entries.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "stale_served": self.stale_served,
+        }
+
+
+response_cache = ResponseCache()
+
+
+def cache_ttl_for(url: str) -> int | None:
+    path = urlsplit(url).path.removeprefix(urlsplit(SPOTIFY_API_URL).path)
+    for prefix, ttl in CACHE_TTLS:
+        if path.startswith(prefix):
+            return ttl
+    return None
+
+
+# Circuit breaker families: an outage of one kind of endpoint should not block the others
+ENDPOINT_FAMILIES = (
+    ("/me/player", "player"),
+    ("/me/top/", "top"),
+    ("/me", "profile"),
+    ("/tracks", "catalog"),
+    ("/artists", "catalog"),
+    ("/albums", "catalog"),
+)
+
+
+def endpoint_family(url: str) -> str:
+    path = urlsplit(url).path.removeprefix(urlsplit(SPOTIFY_API_URL).path)
+    for prefix, family in ENDPOINT_FAMILIES:
+        if path.startswith(prefix):
+            return family
+    return "other"
 
 
 class SpotifyClient:
-    def __init__(self, token: str):
+    def __init__(self, token: str, user_id: str | None = None):
         self.token = token
         self.headers = {"Authorization": f"Bearer {self.token}"}
+        # Per-user responses are cached under the user id when known, otherwise under the token
+        self.cache_scope = user_id or hashlib.sha256((token or "").encode()).hexdigest()[:32]
+
+    def _cache_key(self, url: str):
+        path = urlsplit(url).path.removeprefix(urlsplit(SPOTIFY_API_URL).path)
+        scope = "catalog" if path.startswith(CATALOG_PREFIXES) else self.cache_scope
+        return (scope, url)
+
+    async def _fetch_spotify_data(self, url: str, retries: int = 3, method_name: str = ""):
+        ttl = cache_ttl_for(url)
+        key = self._cache_key(url) if ttl is not None else None
+        cached = response_cache.get(key) if key else None
+        if cached is not None and time.monotonic() - cached.stored_at < ttl:
+            response_cache.hits += 1
+            response_cache.bytes_saved += cached.size
+            return cached.data
+
+        headers = dict(self.headers)
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        # One breaker per endpoint family, shared by every request in this process
+        breaker = get_breaker(endpoint_family(url))
+        client = get_http_client()
+        for attempt in range(retries):
+            if not breaker.allow():
+                # Spotify is failing for this family: answer now instead of queueing up behind it
+                return self._serve_stale(cached, method_name, breaker.name)
+
+            started = time.perf_counter()
+            try:
+                response = await client.get(url, headers=headers)
+            except httpx.TransportError as e:
+                spotify_request_duration.observe(time.perf_counter() - started, method_name, "network_error")
+                breaker.record_failure()
+                logging.warning(f"[Spotify] Network error in {method_name}: {e!r}. Retrying...")
+                if attempt < retries - 1:
+                    await asyncio.sleep(breaker.retry_delay(attempt))
+                continue
+
+            spotify_request_duration.observe(time.perf_counter() - started, method_name, response.status_code)
+
+            if 500 <= response.status_code < 600:
+                breaker.record_failure()
+                logging.warning(f"[Spotify] Server error {response.status_code} in {method_name}. Retrying...")
+                if attempt < retries - 1:
+                    await asyncio.sleep(breaker.retry_delay(attempt))
+                continue
+            # Anything that is not a server error means Spotify is up
+            breaker.record_success()
+
+            if response.status_code == 304 and cached is not None:
+                # Unchanged: keep the decoded body and start a new TTL
+                cached.stored_at = time.monotonic()
+                response_cache.revalidated += 1
+                response_cache.bytes_saved += cached.size
+                return cached.data
+
+            if response.status_code == 429:
+                retry_after = int(response.headers.get("Retry-After", 30))
+                spotify_rate_limited.inc(method_name)
+                spotify_retry_after.observe(retry_after, method_name)
+                logging.warning(f"[Spotify] Rate limit hit in {method_name}. Retrying after {retry_after} seconds...")
+                await asyncio.sleep(retry_after)
+            elif response.status_code == 200:
+                try:
+                    data = response.json()
+                except ValueError as e:
+                    logging.error(f"[Spotify] Error decoding JSON in {method_name}: {e}")
+                    raise HTTPException(status_code=500, detail=f"Error decoding JSON in {method_name}")
+                if key is not None:
+                    response_cache.misses += 1
+                    response_cache.put(key, CachedResponse(
+                        data, response.headers.get("ETag"), response.headers.get("Last-Modified"), len(response.content)
+                    ))
+                return data
+            elif response.status_code == 204:
+                logging.debug(f"[Spotify] {method_name} - No content")
+                return None
+            else:
+                raise HTTPException(status_code=response.status_code, detail=f"Error in {method_name}: {response.text}")
 
-    async def _fetch_spotify_data(self, url: str, retries: int = 5, method_name: str = ""):
-        async with httpx.AsyncClient() as client:
-            for attempt in range(retries):
-                response = await client.get(url, headers=self.headers)
-
-                if response.status_code == 429:
-                    retry_after = int(response.headers.get("Retry-After", 30))
-                    print(f"Rate limit hit in {method_name}. Retrying after {retry_after} seconds...")
-                    await asyncio.sleep(retry_after)
-                elif 500 <= response.status_code < 600:
-                    print(f"Server error in {method_name}. Retrying...")
-                    await asyncio.sleep(2 ** attempt)
-                elif response.status_code == 200:
-                    try:
-                        return response.json()
-                    except ValueError as e:
-                        print(f"Error decoding JSON in {method_name}: {e}")
-                        raise HTTPException(status_code=500, detail=f"Error decoding JSON in {method_name}")
-                elif response.status_code == 204:
-                    print(f"{method_name} - No content.")
-                    return None
-                else:
-                    raise HTTPException(status_code=response.status_code, detail=f"Error in {method_name}: {response.text}")
+        if cached is not None:
+            return self._serve_stale(cached, method_name, breaker.name)
         raise HTTPException(status_code=500, detail=f"Failed in {method_name} after multiple attempts.")
-    
+
+    @staticmethod
+    def _serve_stale(cached: CachedResponse | None, method_name: str, family: str):
+        """Last known response for a call Spotify cannot answer right now, or a fast 503."""
+        if cached is not None:
+            response_cache.stale_served += 1
+            logging.warning(f"[Spotify] {family} endpoints unavailable; serving stale data for {method_name}")
+            return cached.data
+        raise HTTPException(
+            status_code=503,
+            detail=f"Spotify {family} endpoints are unavailable, try again shortly ({method_name})",
+            headers={"Retry-After": str(int(BREAKER_OPEN_SECONDS))},
+        )
+
 
     async def get_top_artists(self, time_range: str = "medium_term"):
         """Fetch user's top artists for a given time range."""
@@ -44,30 +271,30 @@ class SpotifyClient:
 
         # Construct the URL
         url = f"{SPOTIFY_API_URL}/me/top/artists?time_range={time_range}&limit=50"
-        
-        # Log the URL being used
-        print("URL in get_top_artists: ", url)
-        
+
         # Fetch data from Spotify API
         return await self._fetch_spotify_data(url, method_name=f"get_top_artists_{time_range}")
 
 
 
-    async def get_recently_played_tracks(self):
+    async def get_recently_played_tracks(self, after: int | None = None):
+        """Recently played items. With `after` (unix ms) only plays newer than it are returned.
+
+        Spotify only exposes the last 50 plays, so a single page is all there is.
+        """
         # Construct the URL for recently played tracks
         url = f"{SPOTIFY_API_URL}/me/player/recently-played?limit=50"
-        
-        # Log the URL being used
-        print("URL in get_recently_played_tracks: ", url)
-        
+        if after is not None:
+            url += f"&after={after}"
+
         # Fetch data from Spotify API
         response = await self._fetch_spotify_data(url, method_name="get_recently_played_tracks")
-        
+
         # Check if the response is valid and contains the 'items' key
         if response and isinstance(response, dict) and "items" in response:
             return response["items"]  # Return the list of tracks
         else:
-            print("No recent tracks found or invalid response format.")
+            logging.debug("[Spotify] No recent tracks found or invalid response format")
             return []
 
 
@@ -78,10 +305,7 @@ class SpotifyClient:
         
         # Construct the URL
         url = f"{SPOTIFY_API_URL}/me/top/tracks?time_range={time_range}&limit=50"
-        
-        # Log the URL being used
-        print("URL in get_top_tracks: ", url)
-        
+
         # Fetch data from Spotify API
         return await self._fetch_spotify_data(url, method_name=f"get_top_tracks_{time_range}")
 
@@ -100,14 +324,13 @@ class SpotifyClient:
 
 
     async def get_track(self, track_ids: List[str]):
-        print("Starting to get_tracks from spotify_api.py")
         url = f"{SPOTIFY_API_URL}/tracks?ids={','.join(track_ids)}"
         
         try:
             response = await self._fetch_spotify_data(url, method_name="get_track")
             return response
         except Exception as e:
-            print(f"[get_track ERROR] Failed to fetch track data: {e}")
+            logging.error(f"[Spotify] get_track failed: {e}")
             raise  # or return None
 
 
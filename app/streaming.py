@@ -0,0 +1,55 @@
+import functools, logging, os
+
+from fastapi.responses import StreamingResponse
+from fastapi.templating import Jinja2Templates
+
+from app.database import read_sessionmaker
+
+
+# Rows fetched from the server-side cursor per round trip
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", "500"))
+# Rendered HTML is sent once this many characters have piled up, rather than one write per template fragment
+STREAM_CHUNK_CHARS = int(os.getenv("STREAM_CHUNK_CHARS", "16384"))
+
+
+async def stream_rows(user_id: str, query, params: dict, batch_size: int = STREAM_BATCH_ROWS):
+    """Rows of `query` as they come off a server-side cursor, `batch_size` at a time.
+
+    Opens a read session of its own: FastAPI closes the request's yield-dependency
+    sessions before a StreamingResponse body is sent. The session (and its pooled
+    connection) is released when the rows run out or the client goes away.
+    """
+    async with read_sessionmaker(user_id)() as session:
+        result = await session.stream(query.execution_options(yield_per=batch_size), params)
+        async for partition in result.mappings().partitions():
+            for row in partition:
+                yield row
+
+
+@functools.lru_cache(maxsize=None)
+def _async_environment(env):
+    # Same loader, filters and globals (url_for) as the page templates, but able to iterate async generators
+    return env.overlay(enable_async=True)
+
+
+def stream_template(templates: Jinja2Templates, name: str, context: dict, headers: dict | None = None) -> StreamingResponse:
+    """Render `name` incrementally: HTML goes out while the async iterables in `context` are still producing."""
+    template = _async_environment(templates.env).get_template(name)
+
+    async def body():
+        pending, size = [], 0
+        try:
+            async for fragment in template.generate_async(context):
+                pending.append(fragment)
+                size += len(fragment)
+                if size >= STREAM_CHUNK_CHARS:
+                    yield "".join(pending)
+                    pending, size = [], 0
+        except Exception as e:
+            # The status line has already gone out; all that is left is to log and cut the page short
+            logging.exception(f"[Stream] Rendering {name} failed part way: {e}")
+            raise
+        if pending:
+            yield "".join(pending)
+
+    return StreamingResponse(body(), media_type="text/html; charset=utf-8", headers=headers)
@@ -0,0 +1,151 @@
+import asyncio, itertools, logging, os, time
+
+from sqlalchemy import select
+
+from app.crud import SpotifyDataSaver
+from app.database import db_session
+from app.db import User
+from app.helpers import UserMusicUpdater
+from app.metrics import job_duration
+
+
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "4"))
+# Users who opened the dashboard within this window are re-synced in the background
+SYNC_ACTIVE_WINDOW_SECONDS = int(os.getenv("SYNC_ACTIVE_WINDOW_SECONDS", str(24 * 3600)))
+
+# Lower number = served first
+PRIORITY_ACTIVE = 0      # the user is looking at the dashboard right now
+PRIORITY_BACKGROUND = 1  # periodic refresh of recently active users
+
+class SyncService:
+    """Pulls users' Spotify data into the database off the request path.
+
+    Requests are queued per user; a user already queued or being synced is not
+    queued twice (an active request only upgrades a queued background one).
+    A fixed pool of workers drains the queue, active users first.
+    """
+
+    def __init__(self, workers: int = SYNC_WORKERS):
+        self.workers = workers
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._counter = itertools.count()  # FIFO order within a priority
+        self._queued: dict[str, tuple[int, str]] = {}  # user_id -> (priority, time_range)
+        self._in_flight: set[str] = set()
+        self._tasks: list[asyncio.Task] = []
+        self._last_seen: dict[str, tuple[float, str]] = {}  # user_id -> (monotonic time, time_range)
+        self._pending_tracks: dict[str, set[str]] = {}  # user_id -> uploaded track ids still without details
+
+    def request_sync(self, user_id: str, time_range: str = "medium_term", priority: int = PRIORITY_BACKGROUND) -> bool:
+        """Queue a sync for `user_id`. Returns False when one is already queued or running."""
+        if priority == PRIORITY_ACTIVE:
+            self._last_seen[user_id] = (time.monotonic(), time_range)
+
+        if user_id in self._in_flight:
+            return False
+        queued = self._queued.get(user_id)
+        if queued is not None and queued[0] <= priority:
+            return False
+
+        # A higher-priority entry supersedes the queued one; the old entry is skipped when popped
+        self._queued[user_id] = (priority, time_range)
+        self._queue.put_nowait((priority, next(self._counter), user_id, time_range))
+        return True
+
+    def request_track_details(self, user_id: str, track_ids: list[str]):
+        """Have the user's next sync fill in `track_ids` from Spotify (the stubs a history upload stored)."""
+        if track_ids:
+            self._pending_tracks.setdefault(user_id, set()).update(track_ids)
+
+    def is_syncing(self, user_id: str) -> bool:
+        return user_id in self._in_flight or user_id in self._queued
+
+    def queue_depth(self) -> int:
+        return len(self._queued)
+
+    async def sync_user(self, user_id: str, time_range: str):
+        track_ids = self._pending_tracks.pop(user_id, None)
+        async with db_session() as db:
+            result = await db.execute(select(User.access_token).where(User.user_id == user_id))
+            token = result.scalar_one_or_none()
+            if not token:
+                logging.warning(f"[Sync] No access token for user {user_id}; skipping")
+                return
+
+            # One step at a time: the updater shares this session
+            updater = UserMusicUpdater(db, user_id, token)
+            try:
+                # All three time ranges of both top lists, so range switches render instantly
+                await updater.update_all_top_items_if_needed()
+            except Exception as e:
+                logging.error(f"[Sync] top items sync failed for user {user_id}: {e}")
+            try:
+                await updater.update_data_if_needed("recent_tracks", time_range)
+            except Exception as e:
+                logging.error(f"[Sync] recent_tracks sync failed for user {user_id}: {e}")
+            try:
+                await updater.update_profile_if_needed()
+            except Exception as e:
+                logging.error(f"[Sync] profile refresh failed for user {user_id}: {e}")
+
+        if track_ids:
+            try:
+                async with SpotifyDataSaver(token, user_id) as saver:
+                    await saver.update_tracks_details(list(track_ids))
+            except Exception as e:
+                logging.error(f"[Sync] track details for {len(track_ids)} uploaded tracks failed for user {user_id}: {e}")
+
+    async def _worker(self, number: int):
+        while True:
+            priority, _, user_id, time_range = await self._queue.get()
+            # Skip entries superseded by a higher-priority request for the same user
+            if self._queued.get(user_id) != (priority, time_range):
+                self._queue.task_done()
+                continue
+
+            del self._queued[user_id]
+            self._in_flight.add(user_id)
+            started = time.perf_counter()
+            try:
+                await self.sync_user(user_id, time_range)
+                job_duration.observe(time.perf_counter() - started, "sync_user", "ok")
+                logging.info(f"[Sync] worker {number} synced {user_id} ({time_range}) in {time.perf_counter() - started:.2f}s")
+            except Exception as e:
+                job_duration.observe(time.perf_counter() - started, "sync_user", "error")
+                logging.exception(f"[Sync] worker {number} failed for user {user_id}: {e}")
+            finally:
+                self._in_flight.discard(user_id)
+                self._queue.task_done()
+                # Tracks uploaded while this sync was running get a sync of their own
+                if user_id in self._pending_tracks:
+                    self.request_sync(user_id, time_range)
+
+    def enqueue_active_users(self):
+        """Scheduler job: background re-sync of everyone active within SYNC_ACTIVE_WINDOW_SECONDS."""
+        cutoff = time.monotonic() - SYNC_ACTIVE_WINDOW_SECONDS
+        for user_id, (seen, time_range) in list(self._last_seen.items()):
+            if seen < cutoff:
+                self._last_seen.pop(user_id, None)
+            else:
+                self.request_sync(user_id, time_range, priority=PRIORITY_BACKGROUND)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(n)) for n in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "queued": len(self._queued),
+            "in_flight": len(self._in_flight),
+            "active_users": len(self._last_seen),
+        }
+
+
+# One sync service per worker process
+sync_service = SyncService()
@@ -0,0 +1,162 @@
+import asyncio, heapq, logging, os, time
+from datetime import datetime
+
+from app.database import AsyncSessionLocal
+from app.helpers import TokenRefresh
+from app.metrics import job_duration
+
+
+# How long to wait before retrying a token whose refresh failed; doubles with each further
+# failure of the same user, up to TOKEN_REFRESH_MAX_RETRY_SECONDS
+TOKEN_REFRESH_RETRY_SECONDS = int(os.getenv("TOKEN_REFRESH_RETRY_SECONDS", "60"))
+TOKEN_REFRESH_MAX_RETRY_SECONDS = int(os.getenv("TOKEN_REFRESH_MAX_RETRY_SECONDS", "3600"))
+
+
+class TokenRefreshScheduler:
+    """Refreshes each token shortly before it expires, instead of polling every user.
+
+    Keeps a min-heap of (refresh_at, user_id) where refresh_at is token_expires minus
+    TokenRefresh.REFRESH_BUFFER, sleeps until the earliest entry is due, then refreshes
+    everything due at that point in batches. Rescheduling a user pushes a new entry and
+    leaves the old one in the heap; `_due_at` says which entry is current.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, str]] = []
+        self._due_at: dict[str, float] = {}
+        self._failures: dict[str, int] = {}  # user_id -> refreshes failed in a row
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._spotify_oauth = None
+
+    def __len__(self):
+        return len(self._due_at)
+
+    def schedule(self, user_id: str, token_expires: datetime | float):
+        """Queue (or move) `user_id`'s refresh for REFRESH_BUFFER before `token_expires`."""
+        if not user_id or token_expires is None:
+            return
+        expires_ts = token_expires.timestamp() if isinstance(token_expires, datetime) else float(token_expires)
+        refresh_at = expires_ts - TokenRefresh.REFRESH_BUFFER.total_seconds()
+
+        self._due_at[user_id] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, user_id))
+        # Only wake the loop if this entry is now the earliest one
+        if self._heap[0] == (refresh_at, user_id):
+            self._wakeup.set()
+
+    def retry_later(self, user_id: str):
+        """Reschedule a failed refresh with exponential backoff."""
+        failures = self._failures.get(user_id, 0) + 1
+        self._failures[user_id] = failures
+        delay = min(TOKEN_REFRESH_RETRY_SECONDS * 2 ** (failures - 1), TOKEN_REFRESH_MAX_RETRY_SECONDS)
+        self.schedule(user_id, time.time() + delay + TokenRefresh.REFRESH_BUFFER.total_seconds())
+
+    def next_due_in(self) -> float | None:
+        """Seconds until the earliest refresh, or None when nothing is scheduled."""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.time(), 0.0)
+
+    def _drop_stale(self):
+        # Entries superseded by a later schedule() call are skipped lazily
+        while self._heap and self._due_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, limit: int) -> list[str]:
+        now = time.time()
+        due = []
+        while len(due) < limit:
+            self._drop_stale()
+            if not self._heap or self._heap[0][0] > now:
+                break
+            _, user_id = heapq.heappop(self._heap)
+            del self._due_at[user_id]
+            due.append(user_id)
+        return due
+
+    async def load(self):
+        """Seed the heap from the database (one index scan at startup)."""
+        async with AsyncSessionLocal() as db:
+            rows = await TokenRefresh(db).get_refresh_schedule()
+        for row in rows:
+            self.schedule(row.user_id, row.token_expires)
+        logging.info(f"[TokenScheduler] Loaded {len(rows)} tokens; next refresh in {self.next_due_in()}s")
+
+    async def process_due(self):
+        """Refresh every due token, BATCH_SIZE users per DB round trip."""
+        while True:
+            user_ids = self._pop_due(TokenRefresh.BATCH_SIZE)
+            if not user_ids:
+                return
+
+            try:
+                async with AsyncSessionLocal() as db:
+                    token_refresh = TokenRefresh(db)
+                    refreshed, failed = await token_refresh.refresh_users(self._spotify_oauth, user_ids)
+
+                    # Users neither refreshed nor failed were refreshed elsewhere (another
+                    # worker, a new login) or had their revoked refresh token cleared; pick up
+                    # their current expiry instead, which drops the revoked ones from the heap
+                    handled = {r[0] for r in refreshed} | set(failed)
+                    skipped = [user_id for user_id in user_ids if user_id not in handled]
+                    current = await token_refresh.get_refresh_schedule(skipped) if skipped else []
+            except Exception:
+                # Put the batch back so a DB hiccup does not drop these users from the heap
+                for user_id in user_ids:
+                    self.retry_later(user_id)
+                raise
+
+            for user_id, _access_token, _refresh_token, token_expires in refreshed:
+                self._failures.pop(user_id, None)
+                self.schedule(user_id, token_expires)
+            for user_id in failed:
+                self.retry_later(user_id)
+            for user_id in skipped:
+                self._failures.pop(user_id, None)
+            for row in current:
+                self.schedule(row.user_id, row.token_expires)
+
+            logging.info(f"[TokenScheduler] Refreshed {len(refreshed)}, failed {len(failed)} of {len(user_ids)} due tokens")
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self.next_due_in()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    continue  # Heap changed; recompute the next deadline
+                except asyncio.TimeoutError:
+                    pass
+
+            started = time.perf_counter()
+            try:
+                await self.process_due()
+                job_duration.observe(time.perf_counter() - started, "token_refresh_due", "ok")
+            except Exception as e:
+                job_duration.observe(time.perf_counter() - started, "token_refresh_due", "error")
+                logging.exception(f"[TokenScheduler] Refresh batch failed: {e}")
+                await asyncio.sleep(TOKEN_REFRESH_RETRY_SECONDS)
+
+    async def start(self, spotify_oauth):
+        if self._task is not None:
+            return
+        self._spotify_oauth = spotify_oauth
+        await self.load()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+# One scheduler per worker process
+token_scheduler = TokenRefreshScheduler()
@@ -0,0 +1,63 @@
+"""Indexes for the dashboard, detail page and ingest query patterns
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+
+Every index is built CONCURRENTLY so the migration can run against a live
+database without locking listening_history for writes.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0001"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (name, table, columns, extra kwargs for op.create_index)
+INDEXES = [
+    # WHERE user_id = ? ORDER BY played_at DESC, with track_id available for the join
+    ("ix_listening_history_user_played_at", "listening_history",
+     ["user_id", sa.text("played_at DESC")], {"postgresql_include": ["track_id"]}),
+    ("ix_listening_history_track_user", "listening_history", ["track_id", "user_id"], {}),
+    ("ix_tracks_artist_id", "tracks", ["artist_id"], {}),
+    ("ix_tracks_album_id_track_number", "tracks", ["album_id", "track_number"], {}),
+    ("ix_tracks_missing_artist_name", "tracks", ["track_id"],
+     {"postgresql_where": sa.text("artist_name IS NULL OR artist_name = 'Unknown'")}),
+    ("ix_artists_genres", "artists", ["genres"], {"postgresql_using": "gin"}),
+    ("ix_albums_artist_id", "albums", ["artist_id"], {}),
+    ("ix_users_top_artists_user_range_rank", "users_top_artists",
+     ["user_id", "time_range", "rank"], {"postgresql_include": ["artist_id"]}),
+    ("ix_users_top_artists_artist_id", "users_top_artists", ["artist_id"], {}),
+    ("ix_users_top_tracks_user_range_rank", "users_top_tracks",
+     ["user_id", "time_range", "rank"], {"postgresql_include": ["track_id"]}),
+    ("ix_users_top_tracks_track_id", "users_top_tracks", ["track_id"], {}),
+    ("ix_track_artists_artist_id", "track_artists", ["artist_id"], {}),
+    ("ix_user_connections_friend_id", "user_connections", ["friend_id"], {}),
+    ("ix_messages_sender_id", "messages", ["sender_id"], {}),
+    ("ix_messages_receiver_unread", "messages", ["receiver_id"],
+     {"postgresql_where": sa.text("is_read = false")}),
+]
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    with op.get_context().autocommit_block():
+        for name, table, columns, kwargs in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **kwargs)
+
+        op.execute("ANALYZE listening_history")
+        op.execute("ANALYZE tracks")
+        op.execute("ANALYZE artists")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _columns, _kwargs in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
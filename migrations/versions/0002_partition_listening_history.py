@@ -0,0 +1,93 @@
+"""Range-partition listening_history by played_at month
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+
+The existing table is renamed, a partitioned parent with the same columns,
+primary key and indexes is created, one partition per month from the oldest
+play up to PARTITION_MONTHS_AHEAD months in the future is attached, and the
+rows are copied across before the old table is dropped. Run it during a
+quiet window: ingest writes are blocked while the copy runs.
+"""
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.partitions import PARTITION_MONTHS_AHEAD, add_months, month_start, months_between, create_partition_sql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0002"
+down_revision: Union[str, None] = "0001"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+HISTORY_INDEXES = ("ix_listening_history_user_played_at", "ix_listening_history_track_user")
+
+
+def create_history_indexes() -> None:
+    # Created on the parent, so Postgres builds (and maintains) one index per partition
+    op.create_index(
+        "ix_listening_history_user_played_at", "listening_history",
+        ["user_id", sa.text("played_at DESC")], postgresql_include=["track_id"]
+    )
+    op.create_index("ix_listening_history_track_user", "listening_history", ["track_id", "user_id"])
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+
+    op.execute("LOCK TABLE listening_history IN EXCLUSIVE MODE")
+    op.execute("ALTER TABLE listening_history RENAME TO listening_history_legacy")
+    op.execute("ALTER TABLE listening_history_legacy RENAME CONSTRAINT listening_history_pkey TO listening_history_legacy_pkey")
+    for name in HISTORY_INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {name}")
+
+    op.execute("""
+        CREATE TABLE listening_history (
+            user_id VARCHAR NOT NULL REFERENCES users (user_id),
+            track_id VARCHAR NOT NULL REFERENCES tracks (track_id),
+            played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT listening_history_pkey PRIMARY KEY (user_id, track_id, played_at)
+        ) PARTITION BY RANGE (played_at)
+    """)
+
+    oldest = bind.execute(sa.text("SELECT MIN(played_at) FROM listening_history_legacy")).scalar()
+    current = month_start(datetime.utcnow())
+    for month in months_between(oldest or current, add_months(current, PARTITION_MONTHS_AHEAD)):
+        op.execute(create_partition_sql(month))
+
+    create_history_indexes()
+
+    op.execute("""
+        INSERT INTO listening_history (user_id, track_id, played_at)
+        SELECT user_id, track_id, played_at FROM listening_history_legacy
+    """)
+    op.execute("DROP TABLE listening_history_legacy")
+    op.execute("ANALYZE listening_history")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE listening_history RENAME TO listening_history_partitioned")
+    op.execute("ALTER TABLE listening_history_partitioned RENAME CONSTRAINT listening_history_pkey TO listening_history_partitioned_pkey")
+    for name in HISTORY_INDEXES:
+        op.execute(f"DROP INDEX IF EXISTS {name}")
+
+    op.execute("""
+        CREATE TABLE listening_history (
+            user_id VARCHAR NOT NULL REFERENCES users (user_id),
+            track_id VARCHAR NOT NULL REFERENCES tracks (track_id),
+            played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT listening_history_pkey PRIMARY KEY (user_id, track_id, played_at)
+        )
+    """)
+    op.execute("""
+        INSERT INTO listening_history (user_id, track_id, played_at)
+        SELECT user_id, track_id, played_at FROM listening_history_partitioned
+    """)
+    op.execute("DROP TABLE listening_history_partitioned CASCADE")
+    create_history_indexes()
@@ -0,0 +1,35 @@
+"""Partial index on users.token_expires for the token refresher
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+
+The refresh job pages through users whose token expires inside the refresh
+buffer, ordered by (token_expires, user_id). Users without a refresh token
+can never be refreshed, so they are left out of the index.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0003"
+down_revision: Union[str, None] = "0002"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_token_expires", "users", ["token_expires", "user_id"],
+            postgresql_where=sa.text("refresh_token IS NOT NULL"),
+            postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_token_expires", table_name="users", postgresql_concurrently=True, if_exists=True)
@@ -0,0 +1,55 @@
+"""user_sync_state: last successful Spotify sync per user, data type and time range
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+
+Replaces the freshness checks that read users_top_* and MAX(played_at). The
+table is backfilled from those so existing users are not all re-synced on
+their next visit.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0004"
+down_revision: Union[str, None] = "0003"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "user_sync_state",
+        sa.Column("user_id", sa.String(), sa.ForeignKey("users.user_id"), primary_key=True),
+        sa.Column("data_type", sa.String(), primary_key=True),
+        sa.Column("time_range", sa.String(), primary_key=True, server_default=""),
+        sa.Column("last_synced_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+    # users_top_* and listening_history store naive UTC timestamps
+    op.execute("""
+        INSERT INTO user_sync_state (user_id, data_type, time_range, last_synced_at)
+        SELECT user_id, 'top_artists', time_range, MAX(last_updated) AT TIME ZONE 'UTC'
+        FROM users_top_artists WHERE last_updated IS NOT NULL
+        GROUP BY user_id, time_range
+    """)
+    op.execute("""
+        INSERT INTO user_sync_state (user_id, data_type, time_range, last_synced_at)
+        SELECT user_id, 'top_tracks', time_range, MAX(last_updated) AT TIME ZONE 'UTC'
+        FROM users_top_tracks WHERE last_updated IS NOT NULL
+        GROUP BY user_id, time_range
+    """)
+    op.execute("""
+        INSERT INTO user_sync_state (user_id, data_type, time_range, last_synced_at)
+        SELECT user_id, 'recent_tracks', '', MAX(played_at) AT TIME ZONE 'UTC'
+        FROM listening_history
+        GROUP BY user_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table("user_sync_state")
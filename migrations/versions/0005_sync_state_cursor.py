@@ -0,0 +1,41 @@
+"""Add the recently-played cursor to user_sync_state
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+
+The cursor is the newest saved played_at in unix milliseconds, passed to
+Spotify's recently-played endpoint as `after`. It is backfilled from
+listening_history so existing users start syncing incrementally right away.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0005"
+down_revision: Union[str, None] = "0004"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("user_sync_state", sa.Column("cursor", sa.BigInteger(), nullable=True))
+
+    # played_at is naive UTC
+    op.execute("""
+        UPDATE user_sync_state s
+        SET cursor = (EXTRACT(EPOCH FROM h.last_played) * 1000)::BIGINT
+        FROM (
+            SELECT user_id, MAX(played_at) AS last_played
+            FROM listening_history
+            GROUP BY user_id
+        ) h
+        WHERE s.user_id = h.user_id AND s.data_type = 'recent_tracks'
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column("user_sync_state", "cursor")
@@ -0,0 +1,63 @@
+"""Key users_top_* by time range and add user_top_rank_history
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-19
+
+The users_top_* primary keys were (user_id, item_id), so an artist or track
+could only be stored for one time range at a time. They become
+(user_id, time_range, item_id), which also serves the diffing sync's
+per-range lookups. user_top_rank_history records every rank movement.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "0006"
+down_revision: Union[str, None] = "0005"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+TOP_TABLES = (("users_top_artists", "artist_id"), ("users_top_tracks", "track_id"))
+
+
+def upgrade() -> None:
+    for table, item_column in TOP_TABLES:
+        op.drop_constraint(f"{table}_pkey", table, type_="primary")
+        op.create_primary_key(f"{table}_pkey", table, ["user_id", "time_range", item_column])
+
+    op.create_table(
+        "user_top_rank_history",
+        sa.Column("id", sa.BigInteger(), primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.String(), sa.ForeignKey("users.user_id"), nullable=False),
+        sa.Column("entity_type", sa.String(), nullable=False),
+        sa.Column("time_range", sa.String(), nullable=False),
+        sa.Column("item_id", sa.String(), nullable=False),
+        sa.Column("rank", sa.Integer(), nullable=True),
+        sa.Column("previous_rank", sa.Integer(), nullable=True),
+        sa.Column("changed_at", sa.TIMESTAMP(), nullable=False, server_default=sa.func.now()),
+    )
+    op.create_index(
+        "ix_user_top_rank_history_user_item", "user_top_rank_history",
+        ["user_id", "entity_type", "time_range", "item_id", "changed_at"]
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_user_top_rank_history_user_item", table_name="user_top_rank_history")
+    op.drop_table("user_top_rank_history")
+
+    for table, item_column in TOP_TABLES:
+        # Keep one row per (user, item) so the narrower key can be restored
+        op.execute(f"""
+            DELETE FROM {table} t
+            USING {table} d
+            WHERE t.user_id = d.user_id AND t.{item_column} = d.{item_column}
+              AND t.time_range > d.time_range
+        """)
+        op.drop_constraint(f"{table}_pkey", table, type_="primary")
+        op.create_primary_key(f"{table}_pkey", table, ["user_id", item_column])
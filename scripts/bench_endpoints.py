@@ -0,0 +1,239 @@
+"""End-to-end latency benchmark for the dashboard and detail pages.
+
+Runs the app in-process (httpx ASGI transport, logged in through a signed session
+cookie) against the configured database loaded by scripts.generate_dataset, with
+every Spotify call going to the in-process fake. Users are picked at several
+listening-history sizes, and for each endpoint and size it records p50/p95/p99
+latency, SQL queries per request and rows returned by the database (from
+app.instrumentation's X-DB-* headers) and response size.
+
+    python -m scripts.generate_dataset --scale 1
+    python -m scripts.bench_endpoints --output bench/results.json
+    python -m scripts.bench_endpoints --baseline bench/results.json --output bench/new.json
+
+With --baseline the run fails (exit code 1) when an endpoint's p95 grows by more
+than --max-latency-regression or it issues more queries than before. Routes that
+went over their @query_budget are listed in the output either way.
+"""
+import argparse, asyncio, base64, json, os, random, statistics, subprocess, sys, time
+from datetime import datetime, timezone
+
+# Spotify calls made while serving a page go to the fake, never to the real API
+os.environ["SPOTIFY_FAKE_IN_PROCESS"] = "1"
+# Query counts come from app.instrumentation's response headers
+os.environ["DB_QUERY_HEADERS"] = "1"
+
+import httpx
+from itsdangerous import TimestampSigner
+from sqlalchemy import text
+from starlette.middleware.sessions import SessionMiddleware
+
+from app.database import engine, replica_engine
+from app.fake_spotify import WORDS
+from app.instrumentation import routes_over_budget
+from app.main import app
+
+
+ENDPOINTS = {
+    "dashboard": "/dashboard",
+    # The dashboard's panels, as the page fetches them after the shell (v=0: uncached by the browser)
+    "panel-summary": "/dashboard/panels/summary",
+    "panel-tops": "/dashboard/panels/tops",
+    "panel-history": "/dashboard/panels/history",
+    "panel-heatmap": "/dashboard/panels/heatmap",
+    "panel-genres": "/dashboard/panels/genres",
+    "track": "/tracks/{track_id}",
+    "album": "/albums/{album_id}",
+    "artist": "/artists/{artist_id}",
+    "genre": "/genres/{genre}",
+    "compare": "/compare/{user_id}/{other_user_id}",
+    "search": "/search?q={word}",
+    "trending": "/trending",
+}
+# Listening-history size bands, as quantiles of plays per synthetic user
+HISTORY_QUANTILES = {"small": 0.1, "median": 0.5, "large": 0.9, "max": 1.0}
+SAMPLE_USERS = 500
+
+
+def session_cookie(user_id: str) -> tuple[str, str]:
+    """(cookie name, value) Starlette's SessionMiddleware accepts as a logged-in session for `user_id`."""
+    for middleware in app.user_middleware:
+        if middleware.cls is SessionMiddleware:
+            options = getattr(middleware, "kwargs", None) or getattr(middleware, "options", {})
+            break
+    else:
+        raise RuntimeError("SessionMiddleware not configured")
+    session = {"user_id": user_id, "spotify_token": f"fake.{user_id}.0"}
+    data = base64.b64encode(json.dumps(session).encode("utf-8"))
+    signed = TimestampSigner(str(options["secret_key"])).sign(data).decode("utf-8")
+    return options.get("session_cookie", "session"), signed
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def pick_targets(seed: int) -> dict[str, dict]:
+    """One user per history band, plus the ids each endpoint is called with for that user."""
+    rng = random.Random(seed)
+    async with engine.connect() as conn:
+        sample = (await conn.execute(text(
+            "SELECT user_id FROM users WHERE user_id LIKE 'synth%' ORDER BY user_id LIMIT :n"
+        ), {"n": SAMPLE_USERS})).scalars().all()
+        if len(sample) < 2:
+            raise SystemExit("Need at least two synthetic users; run scripts.generate_dataset first.")
+
+        counts = (await conn.execute(text("""
+            SELECT u.user_id, (SELECT count(*) FROM listening_history lh WHERE lh.user_id = u.user_id) AS plays
+            FROM unnest(CAST(:ids AS text[])) AS u(user_id)
+        """), {"ids": sample})).all()
+        counts.sort(key=lambda row: row.plays)
+
+        targets = {}
+        for band, q in HISTORY_QUANTILES.items():
+            user_id, plays = counts[min(len(counts) - 1, int(q * (len(counts) - 1)))]
+            other_user_id = rng.choice([u for u in sample if u != user_id])
+            top = (await conn.execute(text("""
+                SELECT t.track_id, t.album_id, t.artist_id
+                FROM users_top_tracks utt JOIN tracks t ON t.track_id = utt.track_id
+                WHERE utt.user_id = :user_id AND utt.time_range = 'medium_term'
+                ORDER BY utt.rank LIMIT 1
+            """), {"user_id": user_id})).first()
+            if top is None:
+                top = (await conn.execute(text("""
+                    SELECT t.track_id, t.album_id, t.artist_id FROM listening_history lh
+                    JOIN tracks t ON t.track_id = lh.track_id
+                    WHERE lh.user_id = :user_id ORDER BY lh.played_at DESC LIMIT 1
+                """), {"user_id": user_id})).first()
+            genre = await conn.scalar(text(
+                "SELECT genres[1] FROM artists WHERE artist_id = :artist_id AND cardinality(genres) > 0"
+            ), {"artist_id": top.artist_id}) if top else None
+            targets[band] = {
+                "plays": plays,
+                "params": {
+                    "user_id": user_id,
+                    "other_user_id": other_user_id,
+                    "track_id": top.track_id if top else "",
+                    "album_id": top.album_id if top else "",
+                    "artist_id": top.artist_id if top else "",
+                    "genre": genre or "pop",
+                    "word": rng.choice(WORDS),
+                },
+            }
+    return targets
+
+
+async def time_endpoint(client: httpx.AsyncClient, url: str, iterations: int, warmup: int) -> dict:
+    latencies, queries, rows, sizes, errors = [], [], [], [], 0
+    for i in range(warmup + iterations):
+        started = time.perf_counter()
+        response = await client.get(url)
+        elapsed = (time.perf_counter() - started) * 1000
+        if i < warmup:
+            continue
+        if response.status_code >= 400:
+            errors += 1
+        latencies.append(elapsed)
+        queries.append(int(response.headers.get("x-db-query-count", 0)))
+        rows.append(int(response.headers.get("x-db-rows", 0)))
+        sizes.append(len(response.content))
+    return {
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "mean_ms": round(statistics.fmean(latencies), 2),
+        "queries_per_request": round(statistics.fmean(queries), 2),
+        "max_queries": max(queries),
+        "rows_per_request": round(statistics.fmean(rows), 1),
+        "response_bytes": round(statistics.fmean(sizes)),
+        "errors": errors,
+        "iterations": iterations,
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Human-readable regressions of `results` against `baseline`."""
+    problems = []
+    for band, endpoints in results["results"].items():
+        for name, current in endpoints.items():
+            before = baseline.get("results", {}).get(band, {}).get(name)
+            if not before:
+                continue
+            if current["p95_ms"] > before["p95_ms"] * (1 + max_regression):
+                problems.append(f"{band}/{name}: p95 {before['p95_ms']} -> {current['p95_ms']} ms")
+            if current["max_queries"] > before["max_queries"]:
+                problems.append(f"{band}/{name}: queries {before['max_queries']} -> {current['max_queries']}")
+    return problems
+
+
+async def main(args) -> int:
+    targets = await pick_targets(args.seed)
+    endpoints = {name: path for name, path in ENDPOINTS.items() if not args.only or name in args.only}
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    for band, target in targets.items():
+        cookie_name, cookie_value = session_cookie(target["params"]["user_id"])
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", cookies={cookie_name: cookie_value}) as client:
+            print(f"\n{band}: user {target['params']['user_id']} with {target['plays']:,} plays")
+            results[band] = {}
+            for name, path in endpoints.items():
+                stats = await time_endpoint(client, path.format(**target["params"]), args.iterations, args.warmup)
+                results[band][name] = stats
+                print(f"  {name:<14} p50 {stats['p50_ms']:8.1f}  p95 {stats['p95_ms']:8.1f}  p99 {stats['p99_ms']:8.1f} ms"
+                      f"  {stats['queries_per_request']:5.1f} queries  {stats['rows_per_request']:9.1f} rows"
+                      f"{'  ' + str(stats['errors']) + ' errors' if stats['errors'] else ''}")
+
+    output = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "iterations": args.iterations,
+        "users": {band: {"plays": t["plays"], **t["params"]} for band, t in targets.items()},
+        "results": results,
+        "over_budget": routes_over_budget(),
+    }
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"\nWrote {args.output}")
+
+    await engine.dispose()
+    if replica_engine is not engine:
+        await replica_engine.dispose()
+
+    if output["over_budget"]:
+        print("\nRoutes over their query budget (requests):", output["over_budget"])
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(output, json.load(f), args.max_latency_regression)
+        if problems:
+            print("\nRegressions against", args.baseline)
+            for problem in problems:
+                print("  " + problem)
+            return 1
+        print(f"\nNo regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50, help="timed requests per endpoint and user (default 50)")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed requests first (default 5)")
+    parser.add_argument("--only", nargs="+", choices=list(ENDPOINTS), help="benchmark only these endpoints")
+    parser.add_argument("--seed", type=int, default=42, help="picks the compared user and the search word")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="earlier --output file to check for regressions")
+    parser.add_argument("--max-latency-regression", type=float, default=0.25,
+                        help="allowed p95 growth against the baseline, as a fraction (default 0.25)")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,113 @@
+"""Benchmark for the shared statements in app/queries.py.
+
+Times Connection.execute on the app's engine (SQLAlchemy's compiled cache and
+asyncpg's prepared statement cache on, as configured) two ways: building the
+statement on every call, the way the handlers used to, and passing the shared
+module-level constant. A rebuilt text() with the same SQL still hits the
+compiled cache, so the difference is what the constants save per call:
+constructing the statement and generating its cache key.
+
+A third column runs the constants on an engine with both caches off, to show
+what the caches themselves are worth.
+
+    python -m scripts.bench_query_cache --user-id <spotify user id>
+"""
+import argparse, asyncio, statistics, sys, time
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import queries
+from app.database import DATABASE_URL, make_engine, DB_PREPARED_STATEMENT_CACHE_SIZE, DB_QUERY_CACHE_SIZE
+from app.db import User
+
+
+def user_profile_per_call(user_id):
+    # As /users/{user_id} built it before app/queries.py
+    return select(
+        User.user_id,
+        User.image_url,
+        User.display_name,
+        User.custom_username,
+        User.bio,
+        User.preferred_language,
+        User.timezone
+    ).where(User.user_id == user_id)
+
+
+# (name, shared statement, per-call builder taking the user id) — a point lookup,
+# a heavier dashboard aggregate, and an ORM select()
+BENCH_QUERIES = [
+    ("USER_INFO", queries.USER_INFO, lambda user_id: text("SELECT * FROM users WHERE user_id = :user_id")),
+    ("DAILY_PLAY_COUNTS", queries.DAILY_PLAY_COUNTS, lambda user_id: text("""
+        SELECT DATE(lh.played_at) AS play_date, COUNT(*) AS daily_play_count
+        FROM listening_history lh
+        WHERE lh.user_id = :user_id
+        GROUP BY play_date
+        ORDER BY play_date DESC;
+    """)),
+    ("USER_PROFILE", queries.USER_PROFILE, user_profile_per_call),
+]
+
+
+async def time_executes(engine, stmt_factory, params, iterations):
+    samples = []
+    async with engine.connect() as conn:
+        # Warm up the connection and the caches so first-use costs are not counted
+        await conn.execute(stmt_factory(), params)
+        for _ in range(iterations):
+            start = time.perf_counter()
+            result = await conn.execute(stmt_factory(), params)
+            result.fetchall()
+            samples.append((time.perf_counter() - start) * 1000)
+        await conn.rollback()
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+async def bench(user_id, iterations):
+    cached = make_engine(DATABASE_URL)
+    # No compiled cache and no prepared statement cache: every execute compiles and prepares again
+    uncached = create_async_engine(
+        DATABASE_URL, query_cache_size=0, connect_args={"prepared_statement_cache_size": 0}
+    )
+
+    print(f"Execute latency for user {user_id} (ms, {iterations} runs, median / p95)")
+    print(f"  query_cache_size={DB_QUERY_CACHE_SIZE}, prepared_statement_cache_size={DB_PREPARED_STATEMENT_CACHE_SIZE}")
+    try:
+        for name, stmt, build in BENCH_QUERIES:
+            params = {"user_id": user_id}
+            per_call = await time_executes(cached, lambda: build(user_id), params, iterations)
+            shared = await time_executes(cached, lambda: stmt, params, iterations)
+            no_cache = await time_executes(uncached, lambda: stmt, params, iterations)
+            print(f"  {name:<20} per-call {per_call[0]:7.3f} / {per_call[1]:7.3f}"
+                  f"   shared {shared[0]:7.3f} / {shared[1]:7.3f}"
+                  f"   shared, caches off {no_cache[0]:7.3f} / {no_cache[1]:7.3f}")
+    finally:
+        await cached.dispose()
+        await uncached.dispose()
+
+
+async def pick_user():
+    engine = make_engine(DATABASE_URL)
+    try:
+        async with engine.connect() as conn:
+            return await conn.scalar(text("SELECT user_id FROM users LIMIT 1"))
+    finally:
+        await engine.dispose()
+
+
+async def main(args):
+    user_id = args.user_id or await pick_user()
+    if not user_id:
+        print("No users found; nothing to benchmark.")
+        return 0
+    await bench(user_id, args.iterations)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", help="user to run the queries for (default: any user)")
+    parser.add_argument("--iterations", type=int, default=200, help="executes per query and variant (default 200)")
+    sys.exit(asyncio.run(main(parser.parse_args())))
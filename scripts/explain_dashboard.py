@@ -0,0 +1,148 @@
+"""EXPLAIN check for the dashboard queries.
+
+Runs every MusicDataService query the dashboard issues for one user, captures
+the SQL actually sent to Postgres, and re-runs each statement under
+EXPLAIN (FORMAT JSON). A query fails the check if it sequentially scans
+listening_history (or any of its monthly partitions), does not use any of
+the indexes from migration 0001, or its plan never touches listening_history.
+
+    python -m scripts.explain_dashboard --user-id <spotify user id>
+    python -m scripts.explain_dashboard --no-seqscan   # small dev databases
+
+Exit status is 1 when any query fails, so it can gate a deploy.
+"""
+import argparse, asyncio, json, sys
+
+from sqlalchemy import event, text
+
+from app.database import engine, AsyncSessionLocal
+from app.helpers import MusicDataService
+from app.partitions import PARENT_TABLE
+
+
+# Indexes on listening_history that the per-user dashboard queries are expected to hit.
+# The primary key (user_id, track_id, played_at) also counts as a valid access path.
+EXPECTED_INDEXES = {
+    "ix_listening_history_user_played_at",
+    "ix_listening_history_track_user",
+    "listening_history_pkey",
+}
+
+
+def is_history_relation(name) -> bool:
+    """listening_history itself or one of its partitions (listening_history_y2024m01, ...)."""
+    return bool(name) and name.startswith(PARENT_TABLE)
+
+
+def is_history_index(name) -> bool:
+    # Partitions get their own copy of each index, named after the partition
+    # (listening_history_y2024m01_user_id_played_at_idx, listening_history_y2024m01_pkey)
+    return bool(name) and (name in EXPECTED_INDEXES or name.startswith(PARENT_TABLE))
+
+# (method name, positional args) — user-scoped calls that render /dashboard
+DASHBOARD_CALLS = [
+    ("get_user_info", ()),
+    ("get_top_artists_db", ("medium_term",)),
+    ("get_top_tracks_db", ("medium_term",)),
+    ("get_track_play_counts", ()),
+    ("get_daily_play_counts", ()),
+    ("get_total_play_count", ()),
+    ("get_total_play_today", ()),
+    ("get_daily_listening_time", ()),
+    ("get_total_listening_time", ()),
+    ("get_top_genres", ()),
+    ("complete_listening_history", (50, 0)),
+    ("get_consecutive_days_listened", ()),
+    ("get_average_popularity", ()),
+    ("get_average_release_date", ()),
+    ("get_first_and_last_listened", ()),
+    ("get_unique_listening_counts", ()),
+]
+
+
+def walk_plan(node, found):
+    """Collect (node type, relation, index) triples from an EXPLAIN JSON plan tree."""
+    found.append((node.get("Node Type"), node.get("Relation Name"), node.get("Index Name")))
+    for child in node.get("Plans", []):
+        walk_plan(child, found)
+    return found
+
+
+async def capture_statements(user_id):
+    captured = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    event.listen(engine.sync_engine, "before_cursor_execute", on_execute)
+    statements = []
+    try:
+        async with AsyncSessionLocal() as db:
+            service = MusicDataService(user_id, db)
+            for name, args in DASHBOARD_CALLS:
+                start = len(captured)
+                await getattr(service, name)(*args)
+                statements.extend((name, stmt, params) for stmt, params in captured[start:])
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", on_execute)
+    return statements
+
+
+async def pick_user():
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(text("""
+            SELECT user_id FROM listening_history
+            GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1
+        """))
+        return result.scalar()
+
+
+async def main(user_id, no_seqscan):
+    user_id = user_id or await pick_user()
+    if not user_id:
+        print("No listening history found; nothing to check.")
+        return 0
+
+    statements = await capture_statements(user_id)
+    failures = 0
+
+    async with engine.connect() as conn:
+        if no_seqscan:
+            # On tiny tables the planner rightly prefers seq scans; this only proves the indexes are usable
+            await conn.exec_driver_sql("SET enable_seqscan = off")
+
+        for name, statement, params in statements:
+            if "listening_history" not in statement:
+                print(f"SKIP {name}: does not read listening_history")
+                continue
+
+            result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", params)
+            plan = result.scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            nodes = walk_plan(plan[0]["Plan"], [])
+
+            history_nodes = [n for n in nodes if is_history_relation(n[1])]
+            seq_scans = [n for n in history_nodes if n[0] == "Seq Scan"]
+            used = {n[2] for n in nodes if n[2]}
+            # A plan without any listening_history relation means the check is not looking at what it should
+            ok = bool(history_nodes) and not seq_scans and any(is_history_index(index) for index in used)
+
+            status = "OK  " if ok else "FAIL"
+            print(f"{status} {name}: relations={len(history_nodes)} indexes={sorted(used) or '-'} seq_scans={len(seq_scans)}")
+            if not ok:
+                failures += 1
+
+        await conn.rollback()
+
+    await engine.dispose()
+    print(f"{len(statements)} statements checked, {failures} failing.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--user-id", help="user to run the dashboard queries for (default: heaviest listener)")
+    parser.add_argument("--no-seqscan", action="store_true", help="disable seq scans to check index usability")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.user_id, args.no_seqscan)))
@@ -0,0 +1,296 @@
+"""Seeded synthetic dataset for benchmarks: users, catalog and listening history.
+
+The catalog is app.fake_spotify's FakeCatalog, so the ids in the database are the
+ones the fake API serves, and every synthetic user gets a token the fake accepts
+("fake.<user_id>.0"). Track popularity is Zipf-distributed across users and each
+user's plays are Zipf-distributed over their own favourites; artists carry genre
+arrays. Everything is derived from --seed, so a given seed and scale always
+produce the same rows.
+
+    python -m scripts.generate_dataset --scale 1            # ~1k users, ~1M plays
+    python -m scripts.generate_dataset --scale 10 --reset   # replace a previous synthetic load
+    python -m scripts.generate_dataset --scale 1 --export-users 3 --out exports --no-db
+
+Rows are bulk-loaded with COPY (asyncpg copy_records_to_table). Catalog tables go
+through a temporary staging table so existing rows are kept; synthetic users
+(ids starting with "synth") are refused unless --reset removes them first.
+--export-users writes Spotify "Extended streaming history" ZIPs for /upload testing.
+"""
+import argparse, asyncio, json, math, os, random, sys, time, zipfile
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+
+from app.database import DATABASE_URL
+from app.fake_spotify import FakeCatalog, TIME_RANGES
+from app.partitions import create_partition_sql, months_between
+
+
+SYNTH_PREFIX = "synth"
+# Per 1x: users and mean plays per user scale linearly, the catalog with sqrt(scale)
+BASE_USERS = 1_000
+BASE_PLAYS_PER_USER = 1_000
+BASE_TRACKS = 20_000
+COPY_BATCH = 50_000
+EXPORT_FILE_ENTRIES = 10_000  # Spotify splits exports into files of roughly this many plays
+
+# table -> columns, in COPY order
+COLUMNS = {
+    "artists": ["artist_id", "name", "genres", "image_url", "spotify_url", "followers", "popularity", "uri"],
+    "albums": ["album_id", "name", "artist_id", "image_url", "spotify_url", "release_date", "popularity", "total_tracks"],
+    "tracks": [
+        "track_id", "name", "album_id", "artist_id", "artist_name", "spotify_url", "duration_ms", "popularity",
+        "explicit", "track_number", "album_release_date", "album_image_url", "album_name",
+    ],
+    "track_artists": ["track_id", "artist_id", "artist_name"],
+    "users": [
+        "user_id", "display_name", "username", "email", "country", "product", "image_url", "followers",
+        "access_token", "refresh_token", "token_expires", "last_updated",
+    ],
+    "listening_history": ["user_id", "track_id", "played_at"],
+    "users_top_tracks": ["user_id", "track_id", "rank", "time_range", "last_updated"],
+    "users_top_artists": ["user_id", "artist_id", "rank", "time_range", "last_updated"],
+}
+# Tables holding per-user rows, deleted by --reset before the users themselves
+USER_TABLES = ["listening_history", "users_top_tracks", "users_top_artists", "user_top_rank_history", "user_sync_state"]
+
+
+def parse_date(value: str):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def catalog_rows(catalog: FakeCatalog):
+    artists = [
+        (a["id"], a["name"], a["genres"], a["images"][0]["url"], a["external_urls"]["spotify"],
+         a["followers"]["total"], a["popularity"], a["uri"])
+        for a in catalog.artists.values()
+    ]
+    albums = [
+        (a["id"], a["name"], a["artists"][0]["id"], a["images"][0]["url"], a["external_urls"]["spotify"],
+         parse_date(a["release_date"]), None, a["total_tracks"])
+        for a in catalog.albums.values()
+    ]
+    tracks, track_artists = [], []
+    for t in catalog.tracks.values():
+        album = t["album"]
+        tracks.append((
+            t["id"], t["name"], album["id"], t["artists"][0]["id"], ", ".join(a["name"] for a in t["artists"]),
+            t["external_urls"]["spotify"], t["duration_ms"], t["popularity"], t["explicit"], t["track_number"],
+            parse_date(album["release_date"]), album["images"][0]["url"], album["name"],
+        ))
+        track_artists.extend((t["id"], a["id"], a["name"]) for a in t["artists"])
+    return {"artists": artists, "albums": albums, "tracks": tracks, "track_artists": track_artists}
+
+
+def user_ids(count: int) -> list[str]:
+    return [f"{SYNTH_PREFIX}{n:07d}" for n in range(count)]
+
+
+def user_row(user_id: str, seed: int, now: datetime):
+    rng = random.Random(f"{seed}:user:{user_id}")
+    return (
+        user_id, f"Listener {user_id.removeprefix(SYNTH_PREFIX)}", user_id, f"{user_id}@example.com",
+        rng.choice(["GE", "US", "GB", "DE", "BR", "JP", "IN", "SE"]), rng.choice(["premium", "premium", "free"]),
+        f"https://picsum.photos/seed/{user_id}/300", str(rng.randrange(500)),
+        f"fake.{user_id}.0", f"fake-refresh.{user_id}",
+        # Spread expiries over the next hour so the token scheduler sees a steady stream
+        now + timedelta(seconds=rng.randrange(3600)), now.replace(tzinfo=None),
+    )
+
+
+def generate_plays(catalog: FakeCatalog, user_id: str, seed: int, mean_plays: int, start: datetime, end: datetime):
+    """[(track_id, played_at)] for one user, oldest first. Play counts per user are lognormal (a few heavy listeners)."""
+    rng = random.Random(f"{seed}:plays:{user_id}")
+    count = max(10, int(rng.lognormvariate(math.log(mean_plays) - 0.5, 1.0)))
+    span = int((end - start).total_seconds())
+    count = min(count, span // 60)
+    pool = catalog.user_pool(user_id)
+    seconds = sorted(rng.sample(range(span), count))
+    return [(catalog.zipf_pick(rng, pool), start + timedelta(seconds=s)) for s in seconds]
+
+
+def export_entries(catalog: FakeCatalog, user_id: str, plays, seed: int):
+    """Plays in the Extended streaming history format, with the odd podcast episode mixed in."""
+    rng = random.Random(f"{seed}:export:{user_id}")
+    entries = []
+    for track_id, played_at in plays:
+        track = catalog.tracks[track_id]
+        skipped = rng.random() < 0.2
+        entry = {
+            "ts": played_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "username": user_id,
+            "platform": rng.choice(["android", "ios", "windows", "osx", "web_player"]),
+            "ms_played": rng.randrange(1000, 30_000) if skipped else track["duration_ms"],
+            "conn_country": "GE",
+            "ip_addr_decrypted": None,
+            "user_agent_decrypted": None,
+            "master_metadata_track_name": track["name"],
+            "master_metadata_album_artist_name": track["artists"][0]["name"],
+            "master_metadata_album_album_name": track["album"]["name"],
+            "spotify_track_uri": track["uri"],
+            "episode_name": None,
+            "episode_show_name": None,
+            "spotify_episode_uri": None,
+            "reason_start": "trackdone",
+            "reason_end": "fwdbtn" if skipped else "trackdone",
+            "shuffle": rng.random() < 0.4,
+            "skipped": skipped,
+            "offline": False,
+            "offline_timestamp": None,
+            "incognito_mode": False,
+        }
+        if rng.random() < 0.02:
+            entry.update({
+                "master_metadata_track_name": None, "master_metadata_album_artist_name": None,
+                "master_metadata_album_album_name": None, "spotify_track_uri": None,
+                "episode_name": "Episode", "episode_show_name": "Podcast",
+                "spotify_episode_uri": f"spotify:episode:{track_id}",
+            })
+        entries.append(entry)
+    return entries
+
+
+def write_export(path: str, entries: list[dict]):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for index in range(0, len(entries), EXPORT_FILE_ENTRIES):
+            chunk = entries[index:index + EXPORT_FILE_ENTRIES]
+            years = f"{chunk[0]['ts'][:4]}-{chunk[-1]['ts'][:4]}"
+            name = f"Spotify Extended Streaming History/Streaming_History_Audio_{years}_{index // EXPORT_FILE_ENTRIES}.json"
+            zf.writestr(name, json.dumps(chunk))
+
+
+async def copy_upsert(conn, table: str, rows):
+    """COPY into a staging table, then insert what is not there yet."""
+    columns = ", ".join(COLUMNS[table])
+    async with conn.transaction():
+        await conn.execute(f"CREATE TEMP TABLE _stage_{table} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        await conn.copy_records_to_table(f"_stage_{table}", records=rows, columns=COLUMNS[table])
+        status = await conn.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM _stage_{table} ON CONFLICT DO NOTHING"
+        )
+    return int(status.split()[-1])
+
+
+async def reset_synthetic(conn):
+    async with conn.transaction():
+        for table in USER_TABLES:
+            await conn.execute(f"DELETE FROM {table} WHERE user_id LIKE '{SYNTH_PREFIX}%'")
+        await conn.execute(f"DELETE FROM users WHERE user_id LIKE '{SYNTH_PREFIX}%'")
+
+
+async def load(args, catalog: FakeCatalog, users: list[str], start: datetime, end: datetime):
+    conn = await asyncpg.connect(DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://"))
+    try:
+        existing = await conn.fetchval(f"SELECT count(*) FROM users WHERE user_id LIKE '{SYNTH_PREFIX}%'")
+        if existing and not args.reset:
+            print(f"{existing} synthetic users already loaded; rerun with --reset to replace them.")
+            return 1
+        if existing:
+            started = time.perf_counter()
+            await reset_synthetic(conn)
+            print(f"Removed {existing} synthetic users and their rows in {time.perf_counter() - started:.1f}s")
+
+        started = time.perf_counter()
+        for table, rows in catalog_rows(catalog).items():
+            inserted = await copy_upsert(conn, table, rows)
+            print(f"  {table:<18} {inserted:>12,} new of {len(rows):,}")
+
+        now = datetime.now(timezone.utc)
+        await conn.copy_records_to_table("users", records=[user_row(u, args.seed, now) for u in users], columns=COLUMNS["users"])
+        print(f"  {'users':<18} {len(users):>12,}")
+
+        for month in months_between(start, end):
+            await conn.execute(create_partition_sql(month))
+
+        # Rows are generated user by user and copied in COPY_BATCH chunks, so memory stays flat at any scale
+        stamp = now.replace(tzinfo=None)
+        batches = {"listening_history": [], "users_top_tracks": [], "users_top_artists": []}
+        totals = dict.fromkeys(batches, 0)
+
+        async def flush(table):
+            await conn.copy_records_to_table(table, records=batches[table], columns=COLUMNS[table])
+            totals[table] += len(batches[table])
+            batches[table] = []
+
+        for number, user_id in enumerate(users, start=1):
+            batches["listening_history"].extend(
+                (user_id, track_id, played_at)
+                for track_id, played_at in generate_plays(catalog, user_id, args.seed, args.plays_per_user, start, end)
+            )
+            if not args.skip_top_items:
+                for time_range in TIME_RANGES:
+                    batches["users_top_tracks"].extend(
+                        (user_id, t["id"], rank, time_range, stamp)
+                        for rank, t in enumerate(catalog.top_tracks(user_id, time_range, 50), start=1)
+                    )
+                    batches["users_top_artists"].extend(
+                        (user_id, a["id"], rank, time_range, stamp)
+                        for rank, a in enumerate(catalog.top_artists(user_id, time_range, 50), start=1)
+                    )
+            catalog.forget_user(user_id)
+
+            for table, rows in batches.items():
+                if len(rows) >= COPY_BATCH:
+                    await flush(table)
+            if number % 100 == 0:
+                print(f"\r  {number:,} users, {totals['listening_history']:,} plays copied", end="", flush=True)
+        for table, rows in batches.items():
+            if rows:
+                await flush(table)
+        print()
+        for table, count in totals.items():
+            print(f"  {table:<18} {count:>12,}")
+        total = totals["listening_history"]
+
+        elapsed = time.perf_counter() - started
+        print(f"Loaded in {elapsed:.1f}s ({total / elapsed:,.0f} plays/s). Running ANALYZE...")
+        for table in COLUMNS:
+            await conn.execute(f"ANALYZE {table}")
+        return 0
+    finally:
+        await conn.close()
+
+
+def main(args):
+    scale = args.scale
+    users = user_ids(args.users or int(BASE_USERS * scale))
+    tracks = args.tracks or int(BASE_TRACKS * math.sqrt(scale))
+    args.plays_per_user = args.plays_per_user or BASE_PLAYS_PER_USER
+
+    started = time.perf_counter()
+    catalog = FakeCatalog(seed=args.seed, artists=max(tracks // 10, 50), albums=max(tracks // 4, 100), tracks=tracks)
+    print(f"Catalog: {len(catalog.artists):,} artists, {len(catalog.albums):,} albums, {len(catalog.tracks):,} tracks "
+          f"(seed {args.seed}, built in {time.perf_counter() - started:.1f}s)")
+
+    # History ends at the start of today so reruns on the same day produce identical rows
+    end = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+    start = end - timedelta(days=30 * args.months)
+
+    if args.export_users:
+        os.makedirs(args.out, exist_ok=True)
+        for user_id in users[:args.export_users]:
+            plays = generate_plays(catalog, user_id, args.seed, args.plays_per_user, start, end)
+            path = os.path.join(args.out, f"{user_id}_streaming_history.zip")
+            write_export(path, export_entries(catalog, user_id, plays, args.seed))
+            print(f"Wrote {path} ({len(plays):,} plays)")
+
+    if args.no_db:
+        return 0
+    print(f"Loading {len(users):,} users, ~{len(users) * args.plays_per_user:,} plays over {args.months} months")
+    return asyncio.run(load(args, catalog, users, start, end))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=1, help="dataset size multiplier: 1, 10, 100 (default 1)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, help=f"override the user count (default {BASE_USERS} x scale)")
+    parser.add_argument("--plays-per-user", type=int, help=f"mean plays per user (default {BASE_PLAYS_PER_USER})")
+    parser.add_argument("--tracks", type=int, help=f"override the catalog size (default {BASE_TRACKS} x sqrt(scale))")
+    parser.add_argument("--months", type=int, default=24, help="months of history to generate (default 24)")
+    parser.add_argument("--reset", action="store_true", help="delete previously generated users and their rows first")
+    parser.add_argument("--skip-top-items", action="store_true", help="do not fill users_top_tracks / users_top_artists")
+    parser.add_argument("--export-users", type=int, default=0, help="write export ZIPs for the first N users")
+    parser.add_argument("--out", default="exports", help="directory for export ZIPs (default ./exports)")
+    parser.add_argument("--no-db", action="store_true", help="only build the catalog and write export ZIPs")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,68 @@
+"""Run SpotifyClient against the fake Spotify app through a simulated outage.
+
+The fake is mounted in-process (SPOTIFY_FAKE_IN_PROCESS), so no server or network is
+needed and every run takes the same path:
+
+    python -m scripts.outage_drill
+
+1. warm the response cache while Spotify is healthy
+2. break the "top" family and fire concurrent requests until the breaker opens
+3. check that requests now return stale data immediately, and other families still work
+4. heal the outage, wait for the half-open probe, and check the breaker closes
+"""
+import asyncio, os, sys, time
+
+# Short windows so the drill finishes in seconds; must be set before the app modules load
+os.environ.setdefault("BREAKER_MIN_REQUESTS", "5")
+os.environ.setdefault("BREAKER_OPEN_SECONDS", "5")
+os.environ.setdefault("SPOTIFY_CACHE_TTL_TOP", "0")
+os.environ["SPOTIFY_FAKE_IN_PROCESS"] = "1"
+
+from app import spotify_api
+from app.circuit_breaker import get_breaker, get_breaker_states
+from app.fake_spotify import request_counts, set_outage
+from app.spotify_api import SpotifyClient, response_cache
+
+
+def check(condition: bool, message: str):
+    print(f"  [{'ok' if condition else 'FAIL'}] {message}")
+    if not condition:
+        raise SystemExit(1)
+
+
+async def main():
+    clients = [SpotifyClient(f"token-{n}", user_id=f"user-{n}") for n in range(10)]
+
+    print("Healthy: warming the cache")
+    for client in clients:
+        await client.get_top_tracks("short_term")
+    check(get_breaker("top").state == "closed", "top breaker closed")
+
+    print("Outage: top endpoints return 503")
+    await set_outage("top", "error", 503)
+    await asyncio.gather(*(c.get_top_tracks("short_term") for c in clients))
+    check(get_breaker("top").state == "open", "top breaker opened")
+
+    sent = request_counts["top"]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(c.get_top_tracks("short_term") for c in clients))
+    elapsed = time.perf_counter() - started
+    check(request_counts["top"] == sent, "no requests reached Spotify while open")
+    check(all(r and r.get("items") for r in results), "stale top tracks served to every caller")
+    check(elapsed < 0.1, f"answered in {elapsed * 1000:.1f} ms")
+    check(await clients[0].get_spotify_user_profile() is not None, "profile family unaffected")
+
+    print("Recovery: outage cleared")
+    await set_outage("all", "off")
+    await asyncio.sleep(get_breaker("top").stats()["next_probe_in"] + 0.1)
+    await clients[0].get_top_tracks("short_term")
+    check(get_breaker("top").state == "closed", "half-open probe succeeded and closed the breaker")
+
+    print("\nBreakers:", get_breaker_states())
+    print("Cache:", response_cache.stats())
+    await spotify_api.close_http_client()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))